@@ -0,0 +1,372 @@
+import argparse
+import itertools
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import os
+from typing import Callable, Dict, List
+
+import numpy as np
+
+import fortnite_spotify as fs
+import lib.fortnite_lib as fl
+from lib import metrics
+from lib.config import compile_plans, validate
+from lib.fortnite_lib import GameState
+from lib.dispatch import ActionDispatcher
+from lib.frame_source import Frame
+from lib.mock_spotify import MockSpotifyServer
+from lib.recording import FrameRecorder, ReplayFrameSource
+from lib.rigs import RigAgent, RigServer
+from lib.scheduler import PollScheduler
+from lib.spotify_lib import SpotifyClient
+from lib.synthetic import STATE_KEYS, ScriptedFrameSource, synthetic_frame
+
+# The longest acceptable time from launch to the first poll, in seconds
+STARTUP_TARGET = 0.5
+
+# Run in a fresh interpreter, so that no module is imported already
+_STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+import json, sys
+import fortnite_spotify as fs
+import lib.fortnite_lib as fl
+from lib.frame_source import Frame
+imported = time.perf_counter()
+fl.StateMachine().update(Frame(fl.LAYOUT))
+polled = time.perf_counter()
+print(json.dumps({'import_s': imported - start, 'first_poll_s': polled - start, 'requests_imported': 'requests' in sys.modules,
+                  'numpy_imported': 'numpy' in sys.modules}))
+'''
+
+# One round of a match, in the order the states are entered
+_MATCH = [GameState.IN_MENU, GameState.WAITING, GameState.LAUNCHING, GameState.CAN_PARACHUTE, GameState.STORM_WAITING]
+
+
+def _time_call(func: Callable, repeat: int = 5, number: int = 2000) -> Dict[str, float]:
+    """
+    Time a function without arguments
+    :return: The median and best time per call, in microseconds
+    """
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        runs.append((time.perf_counter() - start) / number * 1e6)
+    return {'median_us': round(statistics.median(runs), 3), 'best_us': round(min(runs), 3)}
+
+
+def bench_detection(frames: Dict[str, Frame], number: int) -> dict:
+    checks = {
+        'in_menu': fl._in_menu,
+        'waiting': fl._waiting,
+        'launching': fl._launching,
+        'can_parachute': fl._can_parachute,
+        'storm_waiting': fl._storm_waiting,
+    }
+    results = {}
+    for name, frame in frames.items():
+        results[name] = {'get_state': _time_call(lambda: fl.get_state(frame), number=number)}
+        for check_name, check in checks.items():
+            results[name][check_name] = _time_call(lambda: check(frame), number=number)
+    return results
+
+
+def bench_state_machine(number: int) -> dict:
+    """
+    Cost of a poll with the transition-aware state machine in each steady state, on an unchanged screen and on a
+    screen where a pixel of the current state flickers (so its check has to run again every poll)
+    """
+    results = {}
+    for state in _MATCH:
+        frame = synthetic_frame(state)
+        flicker = Frame(frame.layout, bytearray(frame.buffer))
+        x, y = fl._PIXELS[STATE_KEYS[state][0]][0]
+        flicker.buffer[fl.LAYOUT.index(x, y)] ^= 1  # Still within the tolerance
+        frames = itertools.cycle((frame, flicker))
+
+        machine = fl.StateMachine()
+        machine.update(frame)
+        unchanged = _time_call(lambda: machine.update(frame), number=number)
+        changed = _time_call(lambda: machine.update(next(frames)), number=number)
+        results[state.name.lower()] = {'unchanged': unchanged, 'changed': changed}
+    return results
+
+
+def bench_classifier(count: int) -> dict:
+    states = list(STATE_KEYS)
+    frames = [synthetic_frame(states[i % len(states)]) for i in range(len(states))]
+    samples = np.tile(fl.sample(frames), (count // len(frames) + 1, 1, 1))[:count]
+
+    start = time.perf_counter()
+    fl.classify(samples)
+    batched = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'benchmark.rec')
+        with FrameRecorder(path, fl.SAMPLE_LAYOUT) as recorder:
+            for i in range(count):
+                frame = frames[i % len(frames)]
+                frame.timestamp = i * 0.25
+                recorder.write(frame)
+        recording = ReplayFrameSource(path)
+        start = time.perf_counter()
+        fl.classify_recording(recording)
+        replayed = time.perf_counter() - start
+
+        recording.position = 0
+        start = time.perf_counter()
+        for _ in range(count):
+            fl.get_state(recording.grab())
+        one_by_one = time.perf_counter() - start
+        recording.close()
+
+    return {
+        'frames': count,
+        'batched_fps': round(count / batched),
+        'recording_fps': round(count / replayed),
+        'replay_get_state_fps': round(count / one_by_one),
+    }
+
+
+def bench_end_to_end(rounds: int, hold: float, latency_budget: float, response_delay: float) -> dict:
+    """
+    Latency from a state change on screen to the completion of the Spotify actions of that state,
+    through the real polling loop and action dispatcher, against a local stand-in Spotify API
+    """
+    source = ScriptedFrameSource()
+    fl.set_frame_source(source)
+    completed: List[float] = []
+    machine = fl.StateMachine()
+
+    with MockSpotifyServer(connect_delay=0.05, response_delay=response_delay) as server:
+        server.start()
+        token_directory = tempfile.TemporaryDirectory()
+        client = SpotifyClient('benchmark', 'benchmark', ['user-modify-playback-state'], api_url=f'{server.url}/v1', accounts_url=server.url,
+                               token_path=os.path.join(token_directory.name, 'refresh.token'))
+        client.refresh_token = 'benchmark'
+        client.refresh()
+        client.prewarm()
+        client.resolve_device().result()
+
+        def action(func):
+            def run(*args):
+                func(*args).result()
+                completed.append(time.monotonic())
+            return run
+
+        steps, _ = validate(fs.DEFAULT_CONFIG, fs.STATE_MAP.values())
+        fs.PLANS = compile_plans(steps, fs.STATE_MAP)
+        fs.CFG_MAP = {
+            'set_volume': {'func': action(client.set_volume), 'handled_errors': []},
+            'play': {'func': action(client.play), 'handled_errors': []},
+            'pause': {'func': action(client.pause), 'handled_errors': []},
+        }
+
+        async def script() -> List[float]:
+            latencies = []
+            scheduler = PollScheduler(hot_states=[GameState.WAITING, GameState.LAUNCHING, GameState.CAN_PARACHUTE],
+                                      latency_budget=latency_budget, idle_interval=max(latency_budget, 2.0))
+            dispatcher = ActionDispatcher(fs.run_action, maxsize=4)
+            fs.client_ready(dispatcher)
+            tasks = [asyncio.ensure_future(fs.detect(scheduler, dispatcher, state_machine=machine)), asyncio.ensure_future(dispatcher.run())]
+            await asyncio.sleep(hold)
+            for _ in range(rounds):
+                for state in _MATCH:
+                    actions = fs.PLANS[state]
+                    done_before = len(completed)
+                    changed_at = time.monotonic()
+                    source.current = source.frames[state]
+                    if actions:
+                        while len(completed) < done_before + len(actions):
+                            await asyncio.sleep(0.001)
+                        latencies.append(completed[-1] - changed_at)
+                    await asyncio.sleep(max(0.0, hold - (time.monotonic() - changed_at)))
+            for task in tasks:
+                task.cancel()
+            return latencies
+
+        latencies = asyncio.run(script())
+        client.close()
+        token_directory.cleanup()
+        server.stop()
+    fl.set_frame_source(None)
+
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    return {
+        'events': len(latencies_ms),
+        'latency_budget_ms': latency_budget * 1000,
+        'mean_ms': round(statistics.mean(latencies_ms), 3),
+        'median_ms': round(statistics.median(latencies_ms), 3),
+        'p95_ms': round(latencies_ms[int(0.95 * (len(latencies_ms) - 1))], 3),
+        'max_ms': round(latencies_ms[-1], 3),
+        'skip_rate': round(machine.skipped / machine.polls, 3),
+    }
+
+
+def bench_rigs(rigs: int, hold: float, interval: float, server_interval: float) -> dict:
+    """
+    Simulated agents on this host stream synthetic frames to a rig server over local sockets. Every rig walks through a match;
+    measures the latency from a state change on a rig to the server seeing the transition, and the cost of the batched pass
+    """
+    transitions: List[float] = []
+    changed_at: Dict[str, float] = {}
+
+    def on_transition(rig, previous, state):
+        transitions.append(time.monotonic() - changed_at[rig.name])
+
+    async def script() -> RigServer:
+        server = RigServer(on_transition, interval=server_interval)
+        address = await server.start()
+        classifying = asyncio.ensure_future(server.run())
+        stop = threading.Event()
+        sources = [ScriptedFrameSource() for _ in range(rigs)]
+        agents = [RigAgent(address, f'rig-{i}', 'benchmark', source) for i, source in enumerate(sources)]
+
+        def stream(agent: RigAgent):
+            agent.connect()
+            while not stop.is_set():
+                agent.send()
+                time.sleep(interval)
+            agent.close()
+
+        threads = [threading.Thread(target=stream, args=(agent,), daemon=True) for agent in agents]
+        for thread in threads:
+            thread.start()
+        await asyncio.sleep(hold)
+        for state in _MATCH:
+            for i, source in enumerate(sources):
+                changed_at[f'rig-{i}'] = time.monotonic()
+                source.current = source.frames[state]
+            await asyncio.sleep(hold)
+        stop.set()
+        for thread in threads:
+            await asyncio.get_running_loop().run_in_executor(None, thread.join)
+        classifying.cancel()
+        return server
+
+    server = asyncio.run(script())
+
+    frame = synthetic_frame(GameState.IN_MENU)
+    samples = fl.sample([frame] * rigs)
+    batched = _time_call(lambda: fl.classify(samples, fl.LAYOUT), number=200)
+    one_by_one = _time_call(lambda: [fl.get_state(frame) for _ in range(rigs)], number=200)
+
+    latencies_ms = sorted(latency * 1000 for latency in transitions)
+    return {
+        'rigs': rigs,
+        'transitions': len(latencies_ms),
+        'expected_transitions': rigs * len(_MATCH),
+        'batches': server.batches,
+        'median_ms': round(statistics.median(latencies_ms), 3) if latencies_ms else None,
+        'max_ms': round(latencies_ms[-1], 3) if latencies_ms else None,
+        'batched_pass_us': batched,
+        'one_by_one_us': one_by_one,
+    }
+
+
+def bench_startup(runs: int = 5, connect_delay: float = 0.1) -> dict:
+    """
+    Time from launch to the first poll in a fresh interpreter, and the cost of authenticating with and without a saved access token
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    launches = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT], capture_output=True, text=True, cwd=root, check=True).stdout
+        launches.append(json.loads(output))
+    first_poll = statistics.median(launch['first_poll_s'] for launch in launches)
+
+    authentication = {}
+    with tempfile.TemporaryDirectory() as directory, MockSpotifyServer(connect_delay=connect_delay) as server:
+        server.start()
+        token_path = os.path.join(directory, 'refresh.token')
+        with open(token_path, 'w') as token_file:
+            print('mock-refresh-token', file=token_file)
+        for name in ('refresh', 'saved_access_token'):
+            client = SpotifyClient('benchmark', 'benchmark', ['user-modify-playback-state'], api_url=f'{server.url}/v1', accounts_url=server.url,
+                                   token_path=token_path)
+            start = time.perf_counter()
+            client.authenticate()  # The first run saves the access token that the second run reuses
+            authentication[f'{name}_ms'] = round((time.perf_counter() - start) * 1000, 3)
+            client.close()
+        server.stop()
+
+    return {
+        'target_s': STARTUP_TARGET,
+        'import_s': round(statistics.median(launch['import_s'] for launch in launches), 4),
+        'first_poll_s': round(first_poll, 4),
+        'meets_target': first_poll <= STARTUP_TARGET,
+        'requests_imported_before_first_poll': any(launch['requests_imported'] for launch in launches),
+        'numpy_imported_before_first_poll': any(launch['numpy_imported'] for launch in launches),
+        'authentication': authentication,
+    }
+
+
+def _version() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark state detection and end-to-end action latency')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='Where to write the JSON results')
+    parser.add_argument('--recording', help='Also time detection on the frames of this recording')
+    parser.add_argument('--number', type=int, default=2000, help='Calls per timing run')
+    parser.add_argument('--frames', type=int, default=100000, help='Frames for the classifier throughput benchmarks')
+    parser.add_argument('--rounds', type=int, default=5, help='Simulated matches for the end-to-end benchmark')
+    parser.add_argument('--hold', type=float, default=0.5, help='Seconds each simulated state is held')
+    parser.add_argument('--latency_budget', type=float, default=0.1, help='Polling latency budget for the end-to-end benchmark')
+    parser.add_argument('--response_delay', type=float, default=0.01, help='Simulated Spotify response time, in seconds')
+    parser.add_argument('--skip_end_to_end', action='store_true', help='Skip the end-to-end benchmark')
+    parser.add_argument('--rigs', type=int, default=32, help='Simulated agents for the rig server benchmark. 0 skips it')
+    args = parser.parse_args()
+
+    frames = {state.name.lower(): synthetic_frame(state) for state in STATE_KEYS}
+    results = {
+        'version': _version(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'detection': {'synthetic': bench_detection(frames, args.number)},
+        'state_machine': bench_state_machine(args.number),
+        'classifier': bench_classifier(args.frames),
+        'startup': bench_startup(),
+    }
+    if args.recording:
+        recording = ReplayFrameSource(args.recording)
+        # Copy a spread of recorded frames so that the memory map can be closed afterwards
+        step = max(1, len(recording) // 10)
+        recorded = {}
+        for i in range(0, len(recording), step):
+            recording.position = i
+            frame = Frame(recording.layout)
+            recorded[f'frame_{i}'] = recording.grab(frame)
+        recording.close()
+        results['detection']['recorded'] = bench_detection(recorded, args.number)
+    if not args.skip_end_to_end:
+        results['end_to_end'] = bench_end_to_end(args.rounds, args.hold, args.latency_budget, args.response_delay)
+    if args.rigs:
+        results['rigs'] = bench_rigs(args.rigs, args.hold, interval=args.latency_budget, server_interval=0.05)
+    # Last, as metrics cannot be disabled again. Shows the cost of instrumentation compared to 'synthetic'
+    metrics.enable()
+    results['detection']['synthetic_with_metrics'] = bench_detection(frames, args.number)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f'Wrote results to "{args.output}"')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+import argparse
+import logging
+import sys
+
+import lib.fortnite_lib as fl
+from lib.recording import RecordingError, ReplayFrameSource
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Learn the colors of each game state from recordings and save them as a calibration profile')
+    parser.add_argument('recordings', nargs='+', help='Recordings made with fortnite_spotify.py --record_file. Together they should cover every state')
+    parser.add_argument('-o', '--output', default='calibration', help='Where to save the profile, without an extension (default: calibration)')
+    parser.add_argument('--search_distance', type=int, default=24, help='How far a pixel may be from the default color and still be learned from')
+    parser.add_argument('--max_tolerance', type=int, default=12, help='The largest tolerance that will be learned')
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    try:
+        recordings = [ReplayFrameSource(path) for path in args.recordings]
+    except (OSError, RecordingError) as e:
+        sys.exit(f'Unable to open recording: {e}')
+
+    profile = fl.calibrate(recordings, search_distance=args.search_distance, max_tolerance=args.max_tolerance)
+    for recording in recordings:
+        recording.close()
+    try:
+        profile.save(args.output)
+    except OSError as e:
+        sys.exit(f'Unable to save the profile: {e}')
+    print(f'Saved calibration profile to "{args.output}.json" and "{args.output}.npy"')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import signal
+import sys
+
+import fortnite_spotify as fs
+import lib.fortnite_lib as fl
+from lib import config as cfg
+from lib import metrics
+from lib.dispatch import ActionDispatcher
+from lib.frame_source import FileFrameSource, GdiFrameSource, ppm_size, screen_size
+from lib.journal import Journal
+from lib.recording import ReplayFrameSource
+from lib.rigs import RigAgent, RigError, RigServer
+
+
+def load_users(path: str) -> dict:
+    """
+    Load the users rigs may control
+    :param path: A JSON file mapping each user name to its settings, e.g. {"alice": {"token_path": "tokens/alice.token", "device": "Desk"}}
+    :return: The settings of each user
+    :raises OSError: If the file could not be read
+    :raises ValueError: If the file is invalid
+    """
+    with open(path, 'r') as users_file:
+        users = json.load(users_file)
+    if not isinstance(users, dict) or not users:
+        raise ValueError(f'"{path}" must map at least one user name to its settings')
+    return users
+
+
+async def serve(users: dict, host: str, port: int, interval: float):
+    import lib.spotify_lib as sl
+
+    client_id, client_secret = fs.load_client_info()
+    # One connection pool for every user, so the server keeps a handful of connections open no matter how many users there are
+    session = sl.create_session(pool_size=min(len(users), 16))
+    dispatchers = {}
+    clients = {}
+    for name, settings in users.items():
+        print(f'Authenticating "{name}"')
+        cl = sl.SpotifyClient(client_id, client_secret, fs.SCOPES, session=session,
+                              token_path=settings.get('token_path', f'{name}.token'), preferred_device=settings.get('device'))
+        cl.authenticate()
+        cl.resolve_device()
+        cl.start_auto_refresh()
+        cl.start_player_sync()
+        clients[name] = cl
+        dispatchers[name] = ActionDispatcher(fs.run_action, maxsize=4, on_outcome=functools.partial(fs.record_outcome, user=name))
+    action_plans = {name: fs.bind_plans(fs.PLANS, fs.action_map(cl)) for name, cl in clients.items()}
+
+    def on_transition(rig, previous, state):
+        if fs.JOURNAL is not None:
+            fs.JOURNAL.record('transition', rig=rig.name, user=rig.user, from_state=previous.name, to_state=state.name)
+        dispatchers[rig.user].submit(fs.STATE_MAP[state], action_plans[rig.user][state])
+
+    def on_config_change():
+        nonlocal action_plans
+        if fs.reload_config(fs.CONFIG_PATH):
+            # Replaced as a whole, so a transition never sees the plans of some users updated and others not
+            action_plans = {name: fs.bind_plans(fs.PLANS, fs.action_map(cl)) for name, cl in clients.items()}
+
+    server = RigServer(on_transition, users=users, interval=interval)
+    await server.start(host, port)
+    tasks = [asyncio.ensure_future(dispatcher.run()) for dispatcher in dispatchers.values()]
+    tasks.append(asyncio.ensure_future(cfg.watch(fs.CONFIG_PATH, on_config_change)))
+    print('Serving. Press Ctrl+C to quit.')
+    try:
+        await server.run()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def agent(address: str, rig: str, user: str, interval: float, frame_file: str = None, replay_file: str = None):
+    host, _, port = address.rpartition(':')
+    if frame_file:
+        fl.set_display(*ppm_size(frame_file))
+        source = FileFrameSource(fl.display().layout, frame_file)
+    elif replay_file:
+        source = ReplayFrameSource(replay_file, speed=1.0)
+    else:
+        try:
+            fl.set_display(*screen_size())
+            source = GdiFrameSource(fl.display().layout)
+        except OSError:
+            sys.exit('Capturing the screen is only possible on Windows')
+
+    rig_agent = RigAgent((host or '127.0.0.1', int(port)), rig, user, source)
+    try:
+        rig_agent.connect()
+        print('Running. Press Ctrl+C to quit.')
+        rig_agent.run(interval)
+    except (OSError, RigError) as e:
+        sys.exit(f'Unable to stream to {address}: {e}')
+    finally:
+        rig_agent.close()
+        source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Control the Spotify playback of many rigs from one process')
+    parser.add_argument('-d', '--debug_level', type=int, nargs='?', const=3, default=3, help='1: Debug, 2: Info, 3 (default): Warning, 4: Error, 5: Critical, 6: None')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    serve_parser = commands.add_parser('serve', help='Classify the frames of every rig and run the actions of each user')
+    serve_parser.add_argument('--users', default='users.cfg', help='JSON file of the users rigs may control (default: users.cfg)')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Use 0.0.0.0 to accept rigs on the local network')
+    serve_parser.add_argument('--port', type=int, default=7777, help='Port to listen on (default: 7777)')
+    serve_parser.add_argument('--interval', type=float, default=0.05, help='Seconds between classification passes')
+    serve_parser.add_argument('--profile', default='calibration', help='Calibration profile made with calibrate.py, without an extension')
+    serve_parser.add_argument('--metrics_port', type=int, help='Serve timings and counters in the Prometheus format at http://localhost:PORT/metrics')
+    serve_parser.add_argument('--journal', default='journal', help='Directory of the session journal of transitions and actions (default: journal)')
+
+    agent_parser = commands.add_parser('agent', help='Send the checked pixels of this rig to a server')
+    agent_parser.add_argument('--server', default='127.0.0.1:7777', help='HOST:PORT of the server (default: 127.0.0.1:7777)')
+    agent_parser.add_argument('--rig', required=True, help='The name of this rig')
+    agent_parser.add_argument('--user', required=True, help='The Spotify user this rig controls')
+    agent_parser.add_argument('--interval', type=float, default=0.25, help='Seconds between frames (default: 0.25)')
+    agent_parser.add_argument('--frame_file', help='Read frames from a binary PPM screenshot instead of the screen')
+    agent_parser.add_argument('--replay_file', help='Read frames from a recording instead of the screen')
+    args = parser.parse_args()
+    log_listener = fs.start_logging(logging.StreamHandler(sys.stderr), args.debug_level * 10)
+    signal.signal(signal.SIGINT, fs.handle_sigint)
+    try:
+        if args.command == 'agent':
+            agent(args.server, args.rig, args.user, args.interval, args.frame_file, args.replay_file)
+        else:
+            run_server(args)
+    finally:
+        log_listener.stop()
+
+
+def run_server(args: argparse.Namespace):
+    try:
+        users = load_users(args.users)
+    except (OSError, ValueError) as e:
+        sys.exit(f'Unable to load users: {e}')
+    fs.load_profile(args.profile)
+    fs.load_config()
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
+    try:
+        fs.JOURNAL = Journal(args.journal)
+    except OSError as e:
+        logging.error(f'Journal: Unable to use "{args.journal}". Transitions and actions will not be recorded')
+        logging.debug(e)
+    try:
+        asyncio.run(serve(users, args.host, args.port, args.interval))
+    finally:
+        if fs.JOURNAL is not None:
+            fs.JOURNAL.close()
+
+
+if __name__ == '__main__':
+    main()
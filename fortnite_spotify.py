@@ -1,20 +1,91 @@
 import time
+# Taken before the other imports, for measuring startup time
+STARTED_AT = time.perf_counter()
+import asyncio
 import logging
 import argparse
+import queue
 import signal
 import sys
-import json
-from typing import Callable
+import functools
+import os
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import TYPE_CHECKING, Callable, Dict, Tuple
 
 import lib.fortnite_lib as fl
 from lib.fortnite_lib import GameState
-import lib.spotify_lib as sl
+from lib import config as cfg
+from lib import metrics
+from lib.capture import CaptureThread, FrameRing
+from lib.dispatch import ActionDispatcher
+from lib.frame_source import FileFrameSource, GdiFrameSource, ppm_size, screen_size
+from lib.journal import Journal
+from lib.scheduler import PollScheduler
 
+if TYPE_CHECKING:
+    # Imported on the authentication thread instead, as requests takes a while to import
+    import lib.spotify_lib as sl
+    # Imported when a recording or a calibration profile is used, as they need NumPy, which takes a while to import
+    from lib.recording import FrameRecorder
 
-CONFIG: dict = {}
+
+SCOPES = ['user-modify-playback-state', 'user-read-playback-state']
+
+CONFIG_PATH = 'fortnite_spotify.cfg'
+
+# Reasonable defaults, for when the config file could not be loaded
+DEFAULT_CONFIG = {
+    'main_menu': {'actions': [["set_volume", 70], ["play"]]},
+    'waiting_for_players': {'actions': []},
+    'waiting_to_drop': {'actions': [["set_volume", 50]]},
+    'parachuting': {'actions': []},
+    'landed': {'actions': [["pause"]]},
+    'unknown': {'actions': []},
+    'polling': {'latency_budget': 0.25, 'idle_interval': 2.0, 'cpu_budget': 0.02},
+}
+
+# The steps of every state, compiled from the config, and the polling settings
+PLANS: Dict[GameState, Tuple[cfg.Step, ...]] = {}
+POLLING: dict = {}
+
+# PLANS bound to the client. None until the client is ready
+ACTION_PLANS: Dict[GameState, Tuple[Callable, ...]] = None
+
+# The newest state with actions entered before the client was ready
+_pending_state: GameState = None
+
+# Where transitions and the outcome of every action are recorded. None if they are not
+JOURNAL: Journal = None
+
+_DISPATCH_SECONDS = metrics.Histogram('fortnite_dispatch_seconds', 'Time spent handing the actions of an event to the dispatcher')
+_TRANSITIONS = metrics.Counter('fortnite_state_transitions_total', 'State changes seen while polling', ['from_state', 'to_state'])
 
 CFG_MAP: dict = {}
 
+STATE_MAP = {
+    GameState.UNKNOWN: 'unknown',
+    GameState.IN_MENU: 'main_menu',
+    GameState.WAITING: 'waiting_for_players',
+    GameState.LAUNCHING: 'waiting_to_drop',
+    GameState.CAN_PARACHUTE: 'parachuting',
+    GameState.STORM_WAITING: 'landed',
+}
+
+
+def start_logging(handler: logging.Handler, level: int) -> QueueListener:
+    """
+    Send every log record through a queue to a background thread that writes it, so that logging never waits for the disk
+    :param handler: Writes the records, e.g. a FileHandler
+    :param level: The lowest level that is logged
+    :return: The background writer. Stop it before exiting, so that every queued record is written
+    """
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler)
+    logging.basicConfig(level=level, handlers=[QueueHandler(records)])
+    listener.start()
+    return listener
+
 
 def handle_sigint(sig, frame):
     logging.info('Recieved SIGINT')
@@ -22,36 +93,210 @@ def handle_sigint(sig, frame):
     exit(0)
 
 
-def try_spotify_function(func: Callable, handled_errors: list, func_args=None):
+def try_spotify_function(func: Callable, handled_errors: list, func_args=None) -> str:
+    """
+    :return: The error of the request if it failed, None otherwise
+    """
+    import lib.spotify_lib as sl
+
     if func_args is None:
         func_args = []
     try:
-        func(*func_args)
+        future = func(*func_args)
+        if future is not None:
+            future.result()  # Wait, so that the actions of an event run in order and can be skipped when superseded
     except sl.RequestFailedError as e:
         if str(e) in handled_errors:
             pass
         else:
             logging.error('Spotify: An unhandled error has been raised')
             logging.debug(e)
+        return str(e)
+    return None
 
 
-def handle_event(event_name: str):
-    global CFG_MAP
+def run_action(action: Callable) -> str:
+    """
+    Run one step of a bound action plan
+    :return: The error of the step if it failed, None otherwise
+    """
+    return action()
+
+
+def record_outcome(event_name: str, action: Callable, outcome, seconds: float, **fields):
+    """
+    Record the outcome of one step of an action plan in the journal
+    :param event_name: The event the step belongs to
+    :param action: The step
+    :param outcome: What the step returned, or the exception it raised
+    :param seconds: How long after the event was dispatched the step finished
+    :param fields: More values to record, e.g. the user the step ran for
+    """
+    if JOURNAL is None:
+        return
+    if isinstance(action, functools.partial) and action.func is try_spotify_function:
+        name, args = action.args[0].__name__, action.args[2]
+    else:
+        name, args = getattr(action, '__name__', repr(action)), []
+    if isinstance(outcome, Exception):
+        outcome = str(outcome) or type(outcome).__name__
+    JOURNAL.record('action', event=event_name, action=name, args=args, error=outcome, latency=round(seconds, 6), **fields)
+
+
+def bind_plans(plans: Dict[GameState, Tuple[cfg.Step, ...]], cfg_map: dict) -> Dict[GameState, Tuple[Callable, ...]]:
+    """
+    Bind every step of the action plans to the function of its action, so that running a step needs no lookups
+    :param plans: The steps of every state
+    :param cfg_map: The function and the handled errors of every action name, as returned by action_map
+    :return: The bound steps of every state
+    """
+    return {
+        state: tuple(functools.partial(try_spotify_function, cfg_map[step.name]['func'], cfg_map[step.name]['handled_errors'], list(step.args))
+                     for step in steps)
+        for state, steps in plans.items()
+    }
+
+
+@metrics.timed(_DISPATCH_SECONDS)
+def handle_event(state: GameState, dispatcher: ActionDispatcher):
+    global _pending_state
+
+    action_plans = ACTION_PLANS
+    if action_plans is None:
+        if PLANS.get(state):  # States without actions override nothing, like in ActionDispatcher.submit
+            _pending_state = state  # The actions of the newest state run once the client is ready
+        return
+    dispatcher.submit(STATE_MAP[state], action_plans[state])
 
-    for action in CONFIG[event_name]['actions']:
+
+def client_ready(dispatcher: ActionDispatcher):
+    """
+    Bind the action plans to the client, and run the actions of the newest state with actions entered while it was authenticating
+    """
+    global ACTION_PLANS, _pending_state
+
+    ACTION_PLANS = bind_plans(PLANS, CFG_MAP)
+    if _pending_state is not None:
+        state, _pending_state = _pending_state, None
+        handle_event(state, dispatcher)
+
+
+async def detect(scheduler: PollScheduler, dispatcher: ActionDispatcher, recorder: 'FrameRecorder' = None,
+                 state_machine: fl.StateMachine = None):
+    """
+    Classify the newest captured frame whenever one arrives, until the frames run out.
+    Frames are captured on their own thread, at the interval the scheduler asks for
+    :param state_machine: Tracks the state, e.g. to read its counts afterwards. A new one is used if this is not set
+    :raises OSError: If the screen could not be captured
+    """
+    loop = asyncio.get_running_loop()
+    frame_ready = asyncio.Event()
+
+    def on_frame():
         try:
-            action_name, *action_args = action
-            func = CFG_MAP[action_name]['func']
-            handled_errors = CFG_MAP[action_name]['handled_errors']
+            loop.call_soon_threadsafe(frame_ready.set)
+        except RuntimeError:  # The event loop was closed in the meantime
+            pass
+
+    if state_machine is None:
+        state_machine = fl.StateMachine()
+    ring = FrameRing(fl.source_layout())
+    capture = CaptureThread(fl.capture, ring, interval=scheduler.interval, on_frame=on_frame)
+    capture.start()
+    last_state = None
+    try:
+        while True:
+            frame_ready.clear()
+            closed = ring.closed
+            taken = ring.take()
+            if taken is None:
+                if closed:
+                    if ring.error is not None:
+                        raise ring.error
+                    return
+                await frame_ready.wait()
+                continue
+
+            frame, captured_at = taken
+            start = time.monotonic()
+            cur_state = state_machine.update(frame)
+            if recorder is not None:
+                recorder.write(frame)
+            # Capturing counts towards the cost of a poll, even though it happens on another thread
+            duration = capture.cost + time.monotonic() - start
+            capture.set_interval(scheduler.poll_finished(cur_state, duration, now=captured_at) + duration)
+            if last_state is None:
+                last_state = cur_state
+                logging.info(f'Fortnite: Initial state: {cur_state} ({start - STARTED_AT:.3f} seconds after start)')
+            elif cur_state != last_state:
+                _TRANSITIONS.inc(last_state.name, cur_state.name)
+                if JOURNAL is not None:
+                    JOURNAL.record('transition', from_state=last_state.name, to_state=cur_state.name,
+                                   latency=round(scheduler.last_latency, 6))
+                last_state = cur_state
+                logging.info(f'Fortnite: Changed state: {cur_state}')
+                logging.debug(f'Fortnite: Detection latency: {scheduler.report()}')
+                handle_event(cur_state, dispatcher)
+    finally:
+        capture.stop()
+
+
+def in_background(func: Callable) -> asyncio.Future:
+    """
+    Run a function on a daemon thread, which may block on user input without holding up shutdown
+    :param func: The function to run
+    :return: A future of the result
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
 
-            try_spotify_function(func, handled_errors=handled_errors, func_args=action_args)
-        except ValueError:  # A null event was passed (bad config)
+    def settle(result, error):
+        if future.done():  # Cancelled while the function was running
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def target():
+        try:
+            result, error = func(), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(settle, result, error)
+        except RuntimeError:  # The event loop was closed in the meantime
             pass
 
+    threading.Thread(target=target, name='background', daemon=True).start()
+    return future
 
-def setup() -> sl.SpotifyClient:
-    signal.signal(signal.SIGINT, handle_sigint)
 
+async def run(scheduler: PollScheduler, recorder: 'FrameRecorder' = None, connect: Callable = None, config_path: str = None):
+    # Detection and Spotify actions run as separate tasks, so a slow Spotify request never delays a poll
+    dispatcher = ActionDispatcher(run_action, maxsize=4, on_outcome=record_outcome)
+    actions = asyncio.ensure_future(dispatcher.run())
+    detection = asyncio.ensure_future(detect(scheduler, dispatcher, recorder))
+    tasks = [actions, detection]
+    if config_path is not None:
+        tasks.append(asyncio.ensure_future(cfg.watch(config_path, functools.partial(reload_config, config_path, scheduler))))
+    try:
+        if connect is not None:
+            # Polling starts right away. Only the newest state with actions entered in the meantime has its actions run once the client is ready
+            await in_background(connect)
+            client_ready(dispatcher)
+        await detection
+        await dispatcher.queue.join()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def load_client_info() -> tuple:
+    """
+    Load the credentials of the Spotify application, asking for them if they were not saved yet
+    :return: A tuple in the format (client ID, client secret)
+    """
     try:
         with open('spotify_secret.key', 'r') as secret_file:
             client_id = secret_file.readline().rstrip()
@@ -71,81 +316,189 @@ def setup() -> sl.SpotifyClient:
         except (OSError, IOError) as e:
             logging.error('Unable to write to "spotify_secret.key" file. Client info will not persist')
             logging.debug(e)
+    return client_id, client_secret
+
 
-    cl = sl.SpotifyClient(client_id, client_secret, ['user-modify-playback-state'])
+def setup(preferred_device: str = None) -> 'sl.SpotifyClient':
+    """
+    :param preferred_device: The name or ID of the device to transfer playback to when no device is active
+    """
+    import lib.spotify_lib as sl
+
+    client_id, client_secret = load_client_info()
+    cl = sl.SpotifyClient(client_id, client_secret, SCOPES, preferred_device=preferred_device)
+    cl.prewarm()
     cl.authenticate()
+    cl.resolve_device()  # In the background, so that the first action does not wait for it
+    cl.start_auto_refresh()
+    cl.start_player_sync()
+    logging.info(f'Spotify: Ready {time.perf_counter() - STARTED_AT:.3f} seconds after start')
     return cl
 
 
-def load_config():
-    global CONFIG
+def connect(preferred_device: str = None):
+    """
+    Authenticate with Spotify and map the actions of the config to the client
+    :param preferred_device: See setup
+    """
+    global CFG_MAP
+
+    CFG_MAP = action_map(setup(preferred_device))
+
+
+def action_map(cl: 'sl.SpotifyClient') -> dict:
+    """
+    :param cl: The client to run actions with
+    :return: The function and the handled errors of every action name
+    """
+    return {
+        'set_volume': {'func': cl.set_volume, 'handled_errors': ['Unable to set volume']},
+        'play': {'func': cl.play, 'handled_errors': ['Unable to play']},
+        'pause': {'func': cl.pause, 'handled_errors': ['Unable to pause']},
+    }
+
+
+def load_config(path: str = CONFIG_PATH):
+    global PLANS, POLLING
 
     try:
-        with open('fortnite_spotify.cfg', 'r') as cfg_file:
-            CONFIG = json.load(cfg_file)
-            CONFIG['unknown'] = {'actions': []}
-            logging.info('Successfully loaded "fortnite_spotify.cfg"')
-            return
-    except json.JSONDecodeError as e:
-        logging.info('"fortnite_spotify.cfg" is invalid.')
-        logging.debug(e)
+        steps, POLLING = cfg.load(path, STATE_MAP.values())
+        PLANS = cfg.compile_plans(steps, STATE_MAP)
+        logging.info(f'Successfully loaded "{path}"')
+        return
+    except cfg.ConfigError as e:
+        logging.error(f'"{path}" is invalid: {e}')
     except (OSError, IOError, FileNotFoundError) as e:
-        logging.info('Could not access "fortnite_spotify.cfg".')
+        logging.info(f'Could not access "{path}".')
         logging.debug(e)
 
-    # Load reasonable defaults if the config file could not be loaded
-    CONFIG = {
-        'main_menu': {'actions': [["set_volume", 70], ["play"]]},
-        'waiting_for_players': {'actions': []},
-        'waiting_to_drop': {'actions': [["set_volume", 50]]},
-        'parachuting': {'actions': []},
-        'landed': {'actions': [["pause"]]},
-        'unknown': {'actions': []},
-    }
+    steps, POLLING = cfg.validate(DEFAULT_CONFIG, STATE_MAP.values())
+    PLANS = cfg.compile_plans(steps, STATE_MAP)
 
 
-def main():
-    global CFG_MAP
+def reload_config(path: str = CONFIG_PATH, scheduler: PollScheduler = None) -> bool:
+    """
+    Load the config again and swap it in. The client and the polling loop keep running, and an invalid config is ignored
+    :param path: The path of the config
+    :param scheduler: A scheduler to apply the new polling settings to
+    :return: True if the new config is in use, false otherwise
+    """
+    global PLANS, POLLING, ACTION_PLANS
+
+    try:
+        steps, polling = cfg.load(path, STATE_MAP.values())
+    except (cfg.ConfigError, OSError) as e:
+        logging.error(f'Config: Keeping the current config, as "{path}" could not be loaded: {e}')
+        return False
+    plans = cfg.compile_plans(steps, STATE_MAP)
+    action_plans = bind_plans(plans, CFG_MAP) if ACTION_PLANS is not None else None
+
+    # Every structure is built before anything is replaced, so an event never sees half of the new config
+    PLANS, POLLING = plans, polling
+    if action_plans is not None:
+        ACTION_PLANS = action_plans
+    if scheduler is not None:
+        scheduler.configure(**polling)
+    logging.info(f'Config: Reloaded "{path}"')
+    return True
+
+
+def load_profile(path: str):
+    if not os.path.exists(f'{path}.json'):
+        logging.info(f'Could not load calibration profile "{path}". Using default colors')
+        return
+    from lib.calibration import CalibrationProfile
+    try:
+        fl.load_profile(CalibrationProfile.load(path))
+        logging.info(f'Successfully loaded calibration profile "{path}"')
+    except (OSError, ValueError) as e:
+        logging.info(f'Could not load calibration profile "{path}". Using default colors')
+        logging.debug(e)
+
+
+def main(frame_file: str = None, replay_file: str = None, record_file: str = None, profile: str = 'calibration',
+         metrics_port: int = None, journal_dir: str = None, device: str = None):
+    global JOURNAL
+
+    signal.signal(signal.SIGINT, handle_sigint)
+
+    if metrics_port is not None:
+        try:
+            metrics.serve(metrics_port)
+        except OSError as e:
+            logging.error(f'Metrics: Unable to listen on port {metrics_port}')
+            logging.debug(e)
+
+    load_profile(profile)
+
+    if frame_file:
+        try:
+            fl.set_display(*ppm_size(frame_file))
+        except (OSError, ValueError) as e:
+            sys.exit(f'Unable to read "{frame_file}": {e}')
+        fl.set_frame_source(FileFrameSource(fl.display().layout, frame_file))
+    elif replay_file:
+        from lib.recording import ReplayFrameSource
+        recording = ReplayFrameSource(replay_file, speed=1.0)
+        fl.set_display(*(recording.layout.display or fl.REFERENCE_DISPLAY))
+        fl.set_frame_source(recording)
+    else:
+        try:
+            fl.set_display(*screen_size())
+            fl.set_frame_source(GdiFrameSource(fl.display().layout))
+        except OSError:
+            sys.exit('This script is only compatible with Windows')
+    logging.info('Fortnite: Display is {}x{}'.format(*fl.display().display))
 
     load_config()
 
-    cl = setup()
+    scheduler = PollScheduler(hot_states=[GameState.WAITING, GameState.LAUNCHING, GameState.CAN_PARACHUTE])
+    scheduler.configure(**POLLING)
 
-    CFG_MAP = {
-        'set_volume': {'func': cl.set_volume, 'handled_errors': ['Unable to set volume']},
-        'play': {'func': cl.play, 'handled_errors': ['Unable to play']},
-        'pause': {'func': cl.pause, 'handled_errors': ['Unable to pause']},
-    }
+    recorder = None
+    if record_file:
+        from lib.recording import FrameRecorder
+        recorder = FrameRecorder(record_file, fl.display().sample_layout)
 
-    state_map = {
-        GameState.UNKNOWN: 'unknown',
-        GameState.IN_MENU: 'main_menu',
-        GameState.WAITING: 'waiting_for_players',
-        GameState.LAUNCHING: 'waiting_to_drop',
-        GameState.CAN_PARACHUTE: 'parachuting',
-        GameState.STORM_WAITING: 'landed',
-    }
+    if journal_dir:
+        try:
+            JOURNAL = Journal(journal_dir)
+            JOURNAL.record('session', display=list(fl.display().display))
+        except OSError as e:
+            logging.error(f'Journal: Unable to use "{journal_dir}". Transitions and actions will not be recorded')
+            logging.debug(e)
 
     print('Running. Press Ctrl+C to quit.')
-    last_state = fl.get_state()
-    logging.info(f'Fortnite: Initial state: {last_state}')
-    while True:
-        cur_state = fl.get_state()
-        if cur_state != last_state:
-            last_state = cur_state
-            logging.info(f'Fortnite: Changed state: {cur_state}')
-            handle_event(state_map[cur_state])
-        time.sleep(1)
-    pass
+    try:
+        asyncio.run(run(scheduler, recorder, connect=functools.partial(connect, device), config_path=CONFIG_PATH))
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if JOURNAL is not None:
+            JOURNAL.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Automatically control Spotify when playing Fortnite')
     parser.add_argument('-d', '--debug_level', type=int, nargs='?', const=3, default=3, help='1: Debug, 2: Info, 3 (default): Warning, 4: Error, 5: Critical, 6: None')
     parser.add_argument('--debug_stderr', action='store_true', help='Send debug to stderr instead of log file')
+    parser.add_argument('--frame_file', help='Read frames from a binary PPM screenshot instead of the screen')
+    parser.add_argument('--replay_file', help='Read frames from a recording instead of the screen')
+    parser.add_argument('--record_file', help='Record the checked pixels of every poll to this file')
+    parser.add_argument('--profile', default='calibration', help='Calibration profile made with calibrate.py, without an extension (default: calibration)')
+    parser.add_argument('--metrics_port', type=int, help='Serve timings and counters in the Prometheus format at http://localhost:PORT/metrics')
+    parser.add_argument('--journal', default='journal', help='Directory of the session journal of transitions and actions (default: journal)')
+    parser.add_argument('--no_journal', action='store_true', help='Do not record a session journal')
+    parser.add_argument('--device', help='Name or ID of the Spotify device to start playback on when no device is active')
     args = parser.parse_args()
     if args.debug_stderr:
-        logging.basicConfig(stream=sys.stderr, level=args.debug_level * 10)
+        log_handler = logging.StreamHandler(sys.stderr)
     else:
-        logging.basicConfig(filename='fortnite_spotify.log', filemode='w', level=args.debug_level * 10)
-    main()
+        log_handler = logging.FileHandler('fortnite_spotify.log', mode='w')
+    log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    log_listener = start_logging(log_handler, args.debug_level * 10)
+    try:
+        main(frame_file=args.frame_file, replay_file=args.replay_file, record_file=args.record_file, profile=args.profile,
+             metrics_port=args.metrics_port, journal_dir=None if args.no_journal else args.journal, device=args.device)
+    finally:
+        log_listener.stop()
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+_LUT_SIZE = 1 << 24
+
+
+def _fingerprint(colors: dict, tolerances: dict) -> str:
+    data = json.dumps([{key: list(color) for key, color in colors.items()}, tolerances], sort_keys=True)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def compile_lut(colors: Dict[str, Tuple[int, int, int]], tolerances: Dict[str, int], keys: Sequence[str]) -> np.ndarray:
+    """
+    Compile reference colors into a lookup table from every color to the color keys it matches
+    :param colors: Maps a color key to its reference color in the format (R, G, B)
+    :param tolerances: Maps a color key to the maximum allowed distance of each color value (exclusive)
+    :param keys: The color keys, in bit order
+    :return: An array indexed by colors in the byte format 0xBBGGRR. Bit i of an entry is set if the color matches keys[i]
+    """
+    if len(keys) > 8:
+        raise ValueError('At most 8 color keys fit in the lookup table')
+    lut = np.zeros(_LUT_SIZE, dtype=np.uint8).reshape(256, 256, 256)  # Indexed as [B, G, R]
+    values = np.arange(256)
+    for bit, key in enumerate(keys):
+        r, g, b = colors[key]
+        tolerance = tolerances[key]
+        match_r = np.abs(values - r) < tolerance
+        match_g = np.abs(values - g) < tolerance
+        match_b = np.abs(values - b) < tolerance
+        lut[np.ix_(match_b, match_g, match_r)] |= np.uint8(1 << bit)
+    return lut.reshape(-1)
+
+
+def learn(samples: Dict[str, np.ndarray], colors: Dict[str, Tuple[int, int, int]],
+          search_distance: int = 24, max_tolerance: int = 12, min_frames: int = 10) -> Tuple[dict, dict]:
+    """
+    Learn the reference color and tolerance of each color key from sampled frames
+    :param samples: Maps a color key to an array of shape (frames, pixels of the key, channels) in BGR(X) order
+    :param colors: The current reference colors in the format (R, G, B), used to find frames that show each key
+    :param search_distance: How far from the current reference color a pixel may be and still count as showing the key
+    :param max_tolerance: The largest tolerance that will be learned
+    :param min_frames: How many frames must show a key before it is calibrated. Keys seen less often keep their color
+    :return: The learned colors and tolerances, by color key
+    """
+    learned_colors = {}
+    learned_tolerances = {}
+    for key, key_samples in samples.items():
+        rgb = key_samples[..., 2::-1].astype(np.int16)  # (frames, pixels, RGB)
+        near = (np.abs(rgb - np.array(colors[key], dtype=np.int16)) < search_distance).all(axis=-1)
+        # A frame shows the key under the same rule as detection: at most one pixel may be off
+        showing = near.sum(axis=1) >= rgb.shape[1] - 1
+        if showing.sum() < min_frames:
+            logging.warning(f'Calibration: Only {int(showing.sum())} frames show "{key}". Keeping its reference color')
+            continue
+        inliers = rgb[showing][near[showing]]
+        reference = np.median(inliers, axis=0).round().astype(np.int16)
+        deviation = int(np.abs(inliers - reference).max())
+        learned_colors[key] = tuple(int(value) for value in reference)
+        learned_tolerances[key] = int(min(max(deviation + 1, 2), max_tolerance))
+        logging.info(f'Calibration: "{key}" is {learned_colors[key]} +/- {learned_tolerances[key]} ({int(showing.sum())} frames)')
+    return learned_colors, learned_tolerances
+
+
+class CalibrationProfile:
+    def __init__(self, colors: Dict[str, Tuple[int, int, int]], tolerances: Dict[str, int], lut: np.ndarray = None):
+        """
+        Reference colors and tolerances for every color key, compiled into a color lookup table
+        :param colors: Maps a color key to its reference color in the format (R, G, B)
+        :param tolerances: Maps a color key to the maximum allowed distance of each color value (exclusive)
+        :param lut: A lookup table compiled from the colors and tolerances. It is compiled if this is not set
+        """
+        self.colors: Dict[str, Tuple[int, int, int]] = {key: tuple(color) for key, color in colors.items()}
+        self.tolerances: Dict[str, int] = dict(tolerances)
+        self.keys: List[str] = sorted(self.colors)
+        self.bits: Dict[str, int] = {key: 1 << i for i, key in enumerate(self.keys)}
+        self.lut: np.ndarray = lut if lut is not None else compile_lut(self.colors, self.tolerances, self.keys)
+
+    def save(self, path: str):
+        """
+        Save the profile as path.json and its lookup table as path.npy
+        :param path: The path of the profile, without an extension
+        :raises OSError: If the files could not be written
+        """
+        np.save(f'{path}.npy', self.lut)
+        with open(f'{path}.json', 'w') as profile_file:
+            json.dump({'colors': self.colors, 'tolerances': self.tolerances, 'keys': self.keys,
+                       'fingerprint': _fingerprint(self.colors, self.tolerances)}, profile_file, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> 'CalibrationProfile':
+        """
+        Load a saved profile. The lookup table is memory-mapped rather than read, and is only compiled again if it is missing
+        or was compiled for other keys
+        :param path: The path of the profile, without an extension
+        :return: The profile
+        :raises OSError: If path.json could not be read
+        :raises ValueError: If path.json is invalid
+        """
+        with open(f'{path}.json', 'r') as profile_file:
+            data = json.load(profile_file)
+        try:
+            colors, tolerances, keys = data['colors'], data['tolerances'], data['keys']
+        except KeyError as e:
+            raise ValueError(f'"{path}.json" is not a calibration profile') from e
+
+        try:
+            lut = np.load(f'{path}.npy', mmap_mode='r')
+            if lut.shape != (_LUT_SIZE,) or lut.dtype != np.uint8 or keys != sorted(colors):
+                raise ValueError('Lookup table does not match the profile')
+            if data.get('fingerprint') != _fingerprint(colors, tolerances):
+                raise ValueError('Profile was edited after the lookup table was compiled')
+        except (OSError, ValueError) as e:
+            logging.info(f'Calibration: Compiling the lookup table of "{path}" again')
+            logging.debug(e)
+            profile = cls(colors, tolerances)
+            try:
+                profile.save(path)
+            except OSError as e:
+                logging.warning(f'Unable to write to "{path}.npy". The lookup table will be compiled again on the next start')
+                logging.debug(e)
+            return profile
+        return cls(colors, tolerances, lut)
@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from lib import metrics
+from lib.frame_source import Frame, FrameLayout
+
+_DROPPED = metrics.Counter('fortnite_frames_dropped_total', 'Captured frames that were replaced by a newer frame before being classified')
+
+
+class FrameRing:
+    def __init__(self, layout: FrameLayout, slots: int = 4):
+        """
+        A fixed number of frames backed by one preallocated buffer, filled by a capture thread and read by the classifier.
+        The buffer of every frame is a memoryview into the shared buffer, so nothing is allocated or copied once the ring exists.
+        Readers always get the newest frame. Unread frames that are older are dropped, and the capture thread overwrites
+        the oldest unread frame when every other slot is taken
+        :param layout: The layout of the frames
+        :param slots: How many frames the ring holds. At least 3: one being captured, one being read and the newest
+        """
+        if slots < 3:
+            raise ValueError('A frame ring needs at least 3 slots')
+        self.layout: FrameLayout = layout
+        self._memory: bytearray = bytearray(layout.size * slots)
+        view = memoryview(self._memory)
+        self.frames: List[Frame] = [Frame(layout, view[i * layout.size:(i + 1) * layout.size]) for i in range(slots)]
+        self.published: int = 0
+        self.dropped: int = 0
+        self.closed: bool = False
+        self.error: Exception = None  # Why capturing stopped, if it failed
+        self._sequence: List[int] = [0] * slots  # When each slot was published. 0 if it holds no unread frame
+        self._captured_at: List[float] = [0.0] * slots
+        self._writing: int = None
+        self._reading: int = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def acquire(self) -> Frame:
+        """
+        Get a frame to capture into. Only the capture thread may call this
+        :return: A frame that is neither being read nor the newest unread frame
+        """
+        with self._lock:
+            slots = [i for i in range(len(self.frames)) if i != self._reading]
+            slot = min(slots, key=self._sequence.__getitem__)  # A free slot if there is one, otherwise the oldest unread frame
+            if self._sequence[slot]:
+                self._sequence[slot] = 0
+                self._drop(1)
+            self._writing = slot
+        return self.frames[slot]
+
+    def publish(self, captured_at: float):
+        """
+        Make the acquired frame available to readers
+        :param captured_at: The monotonic time the capture started
+        """
+        with self._lock:
+            self.published += 1
+            self._sequence[self._writing] = self.published
+            self._captured_at[self._writing] = captured_at
+            self._writing = None
+
+    def take(self) -> Optional[Tuple[Frame, float]]:
+        """
+        Get the newest unread frame, dropping every older unread frame. It is not overwritten until the next call
+        :return: The frame and the monotonic time its capture started, or None if no frame was published since the last call
+        """
+        with self._lock:
+            self._reading = None
+            newest = max(range(len(self.frames)), key=self._sequence.__getitem__)
+            if not self._sequence[newest]:
+                return None
+            stale = [i for i, sequence in enumerate(self._sequence) if sequence and i != newest]
+            for slot in stale:
+                self._sequence[slot] = 0
+            self._drop(len(stale))
+            self._sequence[newest] = 0
+            self._reading = newest
+        return self.frames[newest], self._captured_at[newest]
+
+    def close(self, error: Exception = None):
+        """
+        Mark the end of the frames. Frames published before remain readable
+        :param error: Why capturing stopped, if it failed
+        """
+        with self._lock:
+            self.error = error
+            self.closed = True
+
+    def _drop(self, count: int):
+        if count:
+            self.dropped += count
+            _DROPPED.inc(amount=count)
+
+
+class CaptureThread:
+    def __init__(self, capture: Callable[[Frame], Frame], ring: FrameRing, interval: float = 0.25,
+                 on_frame: Callable[[], None] = None):
+        """
+        Captures frames into a ring on its own thread, so a slow capture never holds up classification and the other way round
+        :param capture: Fills the given frame, e.g. fortnite_lib.capture. May raise EOFError when there are no more frames
+        :param ring: Where the frames are captured into
+        :param interval: How long to wait (in seconds) from the start of one capture to the start of the next
+        :param on_frame: Called on the capture thread after each frame is published, and once more when capturing stops
+        """
+        self.capture: Callable[[Frame], Frame] = capture
+        self.ring: FrameRing = ring
+        self.interval: float = interval
+        self.on_frame: Callable[[], None] = on_frame
+        self.cost: float = 0.0  # Moving average of how long a capture takes
+        self._stopping: bool = False
+        self._wake: threading.Event = threading.Event()
+        self._thread: threading.Thread = threading.Thread(target=self._run, name='capture', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def set_interval(self, interval: float):
+        """
+        Change the interval, including the wait that is in progress
+        :param interval: How long to wait (in seconds) from the start of one capture to the start of the next
+        """
+        self.interval = interval
+        self._wake.set()
+
+    def stop(self, timeout: float = None):
+        """
+        Stop capturing after the capture in progress
+        :param timeout: How long to wait (in seconds) for the thread to finish. It is not waited for if this is not set
+        """
+        self._stopping = True
+        self._wake.set()
+        if timeout is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self):
+        error = None
+        try:
+            while not self._stopping:
+                start = time.monotonic()
+                frame = self.ring.acquire()
+                if self.capture(frame) is not frame:
+                    raise TypeError('The frame source did not capture into the given frame')
+                self.ring.publish(start)
+                duration = time.monotonic() - start
+                self.cost = duration if self.cost == 0.0 else 0.8 * self.cost + 0.2 * duration
+                self._notify()
+
+                # Woken early when the interval changes, as the new one may already have passed
+                while not self._stopping:
+                    self._wake.clear()
+                    remaining = start + self.interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._wake.wait(remaining)
+        except EOFError:
+            logging.info('Fortnite: Reached the end of the frames')
+        except Exception as e:
+            if not self._stopping:  # The frame source may be closed while a capture is in progress
+                logging.error('Fortnite: Unable to capture the screen')
+                logging.debug(repr(e))
+                error = e
+        finally:
+            self.ring.close(error)
+            self._notify()
+
+    def _notify(self):
+        if self.on_frame is not None:
+            self.on_frame()
@@ -0,0 +1,190 @@
+import operator
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Sequence, Tuple
+
+from lib.frame_source import BYTES_PER_PIXEL, Frame, FrameLayout
+
+if TYPE_CHECKING:
+    # Imported when a batch is first classified instead, as NumPy takes a while to import and single frames do not need it
+    import numpy as np
+
+
+class Classifier:
+    def __init__(self, pixels: Dict[str, List[Tuple[int, int]]], colors: Dict[str, Tuple[int, int, int]],
+                 distance: int, states: Sequence[Tuple[Any, Sequence[str]]], default: Any, max_errors: int = 1,
+                 tolerances: Dict[str, int] = None, lut: 'np.ndarray' = None, key_bits: Dict[str, int] = None):
+        """
+        Compiles the pixel and color tables into arrays so that every state can be scored with one batched comparison.
+        The arrays are built on the first batch, so classifying single frames does not import NumPy
+        :param pixels: Maps a color key to the (x, y) coordinates that should have that color
+        :param colors: Maps a color key to its reference color in the format (R, G, B)
+        :param distance: The maximum allowed distance of each color value (exclusive)
+        :param states: (state, color keys) pairs in the order the states should be preferred
+        :param default: The state to return if no other state matches
+        :param max_errors: How many pixels of a state may fail to match before the state is rejected
+        :param tolerances: Maps a color key to its own distance, overriding distance
+        :param lut: A lookup table from colors in the byte format 0xBBGGRR to the color keys they match (see lib.calibration).
+                    If set, pixels are matched with one read from it instead of comparing against colors
+        :param key_bits: Maps a color key to its bit in the lookup table
+        """
+        self.states: list = [state for state, _ in states]
+
+        coordinates = []
+        coordinate_ids = {}
+        entry_coordinates = []
+        entry_colors = []
+        entry_tolerances = []
+        entry_bits = []
+        entry_states = []
+        for state_id, (_, keys) in enumerate(states):
+            for key in keys:
+                r, g, b = colors[key]
+                for pair in pixels[key]:
+                    if pair not in coordinate_ids:
+                        coordinate_ids[pair] = len(coordinates)
+                        coordinates.append(pair)
+                    entry_coordinates.append(coordinate_ids[pair])
+                    entry_colors.append((b, g, r))  # Frames are stored as BGRX
+                    entry_tolerances.append(tolerances.get(key, distance) if tolerances else distance)
+                    entry_bits.append(key_bits[key] if key_bits else 0)
+                    entry_states.append(state_id)
+
+        # Each unique coordinate is sampled once, even if several states check it
+        self._coordinates: List[Tuple[int, int]] = coordinates
+        # One entry per (state, coordinate) check
+        self._entries: Tuple[list, list, list, list, list] = (entry_coordinates, entry_colors, entry_tolerances, entry_bits, entry_states)
+        self.lut: 'np.ndarray' = lut
+        self.max_errors: int = max_errors
+        self.default: Any = default
+        # Per state, the entries a single frame is checked against: (entry index, B, G, R, tolerance)
+        self._state_entries: List[Tuple[Any, List[Tuple[int, int, int, int, int]]]] = [
+            (state, [(i, *entry_colors[i], entry_tolerances[i]) for i in range(len(entry_states)) if entry_states[i] == state_id])
+            for state_id, state in enumerate(self.states)
+        ]
+        self._entry_readers: Dict[FrameLayout, Callable] = {}
+
+        # The arrays of the batched path, built by _compile()
+        self.coordinates: 'np.ndarray' = None
+        self.entry_coordinates: 'np.ndarray' = None
+        self.references: 'np.ndarray' = None
+        self.tolerances: 'np.ndarray' = None
+        self.entry_bits: 'np.ndarray' = None
+        self.membership: 'np.ndarray' = None
+        self._labels: 'np.ndarray' = None
+        self._pixel_indices: Dict[FrameLayout, 'np.ndarray'] = {}
+
+    def _compile(self):
+        """
+        Build the arrays of the batched path, on first use
+        """
+        if self._labels is not None:
+            return
+        import numpy as np
+        entry_coordinates, entry_colors, entry_tolerances, entry_bits, entry_states = self._entries
+        self.coordinates = np.array(self._coordinates, dtype=np.int32)
+        self.entry_coordinates = np.array(entry_coordinates, dtype=np.intp)
+        self.references = np.array(entry_colors, dtype=np.int16)
+        self.tolerances = np.array(entry_tolerances, dtype=np.int16)
+        self.entry_bits = np.array(entry_bits, dtype=np.uint8)
+        self.membership = np.zeros((len(self.states), len(entry_colors)), dtype=np.int32)
+        self.membership[entry_states, np.arange(len(entry_states))] = 1
+        labels = np.empty(len(self.states) + 1, dtype=object)
+        labels[:] = self.states + [self.default]
+        self._labels = labels  # Set last, as it marks the arrays as built
+
+    def pixel_indices(self, layout: FrameLayout) -> 'np.ndarray':
+        """
+        Find where each coordinate is stored in frames of a layout. The result is computed once per layout
+        :param layout: The layout of the frames
+        :return: The pixel index of each coordinate
+        """
+        indices = self._pixel_indices.get(layout)
+        if indices is None:
+            import numpy as np
+            indices = np.array([layout.index(x, y) // BYTES_PER_PIXEL for x, y in self._coordinates], dtype=np.intp)
+            self._pixel_indices[layout] = indices
+        return indices
+
+    def sample(self, frame: Frame) -> 'np.ndarray':
+        """
+        Read every coordinate the classifier needs from a frame
+        :param frame: The frame to sample
+        :return: An array of shape (coordinates, 4) in BGRX order
+        """
+        import numpy as np
+        pixels = np.frombuffer(frame.buffer, dtype=np.uint8, count=frame.layout.size)
+        return pixels.reshape(-1, BYTES_PER_PIXEL)[self.pixel_indices(frame.layout)]
+
+    def sample_many(self, frames: Sequence[Frame]) -> 'np.ndarray':
+        """
+        Sample a sequence of frames into one stack
+        :param frames: The frames to sample
+        :return: An array of shape (frames, coordinates, 4) in BGRX order
+        """
+        import numpy as np
+        stack = np.empty((len(frames), len(self._coordinates), BYTES_PER_PIXEL), dtype=np.uint8)
+        for i, frame in enumerate(frames):
+            stack[i] = self.sample(frame)
+        return stack
+
+    def scores(self, samples: 'np.ndarray') -> 'np.ndarray':
+        """
+        Count how many pixels of each state do not match
+        :param samples: An array of shape (frames, coordinates, channels) or (coordinates, channels) in BGR(X) order
+        :return: An array of shape (frames, states) holding the error count of each state
+        """
+        import numpy as np
+        self._compile()
+        samples = np.asarray(samples)
+        samples = samples.reshape(-1, len(self._coordinates), samples.shape[-1])
+        if self.lut is not None:
+            colors = samples[..., 2].astype(np.uint32) | (samples[..., 1].astype(np.uint32) << 8) | (samples[..., 0].astype(np.uint32) << 16)
+            mismatches = (self.lut[colors][:, self.entry_coordinates] & self.entry_bits) == 0
+        else:
+            diff = np.abs(samples[:, self.entry_coordinates, :3].astype(np.int16) - self.references)
+            mismatches = (diff >= self.tolerances[:, None]).any(axis=-1)
+        return mismatches.astype(np.int32) @ self.membership.T
+
+    def classify(self, samples: 'np.ndarray') -> 'np.ndarray':
+        """
+        Classify a stack of sampled frames. States are preferred in the order they were given
+        :param samples: An array of shape (frames, coordinates, channels) or (coordinates, channels) in BGR(X) order
+        :return: An object array of shape (frames,) holding the state of each frame
+        """
+        import numpy as np
+        matches = self.scores(samples) <= self.max_errors
+        # The extra column always matches, so frames that match no state fall through to the default
+        matches = np.concatenate([matches, np.ones((len(matches), 1), dtype=bool)], axis=1)
+        return self._labels[matches.argmax(axis=1)]
+
+    def _entry_reader(self, layout: FrameLayout) -> Callable:
+        """
+        Get a function from a frame's buffer to the B, G and R bytes of every entry. The result is computed once per layout
+        :param layout: The layout of the frames
+        """
+        reader = self._entry_readers.get(layout)
+        if reader is None:
+            offsets = [layout.index(*self._coordinates[coordinate]) for coordinate in self._entries[0]]
+            reader = self._entry_readers[layout] = operator.itemgetter(*(offset + channel for offset in offsets for channel in range(3)))
+        return reader
+
+    def classify_frame(self, frame: Frame) -> Any:
+        """
+        Classify a single frame. For one frame, comparing the pixels in plain Python is cheaper than setting up the arrays of
+        classify, and a state is rejected as soon as too many of its pixels fail. The result is the same.
+        The lookup table is not read here, even if there is one: it is compiled from the same colors and tolerances
+        (see lib.calibration), and three comparisons that usually fail at the first are cheaper than assembling its index
+        :param frame: The frame to classify
+        :return: The state of the frame
+        """
+        values = self._entry_reader(frame.layout)(frame.buffer)
+        for state, entries in self._state_entries:
+            errors = 0
+            for i, b, g, r, tolerance in entries:
+                i *= 3
+                if not (abs(values[i] - b) < tolerance and abs(values[i + 1] - g) < tolerance and abs(values[i + 2] - r) < tolerance):
+                    errors += 1
+                    if errors > self.max_errors:
+                        break
+            else:
+                return state
+        return self.default
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Callable, Collection, Dict, List, Mapping, NamedTuple, Tuple
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Step(NamedTuple):
+    name: str
+    args: tuple
+
+
+def _volume(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= 100
+
+
+# The arguments each action takes, as a check per argument
+ACTIONS: Dict[str, List[Callable[[Any], bool]]] = {
+    'set_volume': [_volume],
+    'play': [],
+    'pause': [],
+}
+
+# The settings of the polling section, as a check per setting
+POLLING: Dict[str, Callable[[Any], bool]] = {
+    'latency_budget': lambda value: isinstance(value, (int, float)) and value > 0,
+    'idle_interval': lambda value: isinstance(value, (int, float)) and value > 0,
+    'cpu_budget': lambda value: isinstance(value, (int, float)) and 0 <= value <= 1,
+}
+
+
+def validate(config: Any, events: Collection) -> Tuple[Dict[str, Tuple[Step, ...]], dict]:
+    """
+    Check a config and convert the actions of every event into steps
+    :param config: The parsed config file
+    :param events: The event names the config may contain
+    :return: The steps of every event (events missing from the config have none), and the polling settings
+    :raises ConfigError: If anything in the config is invalid. The message lists every problem
+    """
+    if not isinstance(config, dict):
+        raise ConfigError('The config must be a JSON object')
+    problems = []
+    steps = {event: () for event in events}
+    for key, value in config.items():
+        if key == 'polling':
+            if not isinstance(value, dict):
+                problems.append('"polling" must be an object')
+                continue
+            for setting, setting_value in value.items():
+                if setting not in POLLING:
+                    problems.append(f'"polling" has an unknown setting "{setting}"')
+                elif not POLLING[setting](setting_value):
+                    problems.append(f'"polling.{setting}" has an invalid value {setting_value!r}')
+            continue
+        if key not in steps:
+            problems.append(f'Unknown event "{key}". Expected one of {", ".join(sorted(steps))}')
+            continue
+        if not isinstance(value, dict) or not isinstance(value.get('actions'), list):
+            problems.append(f'"{key}" must be an object with a list of "actions"')
+            continue
+        event_steps = []
+        for i, action in enumerate(value['actions']):
+            if not isinstance(action, list) or not action or action[0] not in ACTIONS:
+                problems.append(f'"{key}" action {i + 1} must start with one of {", ".join(ACTIONS)}, not {action!r}')
+                continue
+            name, *args = action
+            checks = ACTIONS[name]
+            if len(args) != len(checks) or not all(check(arg) for check, arg in zip(checks, args)):
+                problems.append(f'"{key}" action {i + 1} has invalid arguments: {action!r}')
+                continue
+            event_steps.append(Step(name, tuple(args)))
+        steps[key] = tuple(event_steps)
+    if problems:
+        raise ConfigError('; '.join(problems))
+    return steps, dict(config.get('polling', {}))
+
+
+def load(path: str, events: Collection) -> Tuple[Dict[str, Tuple[Step, ...]], dict]:
+    """
+    Read and validate a config file
+    :raises OSError: If the file could not be read
+    :raises ConfigError: If the file is not valid JSON, or the config is invalid
+    See validate for more information
+    """
+    with open(path, 'r') as cfg_file:
+        try:
+            config = json.load(cfg_file)
+        except json.JSONDecodeError as e:
+            raise ConfigError(f'"{path}" is not valid JSON: {e}') from e
+    return validate(config, events)
+
+
+def compile_plans(steps: Mapping[str, Tuple[Step, ...]], state_map: Mapping[Any, str]) -> Dict[Any, Tuple[Step, ...]]:
+    """
+    :param steps: The steps of every event, as returned by validate
+    :param state_map: Maps each state to its event name
+    :return: The steps of every state
+    """
+    return {state: steps[event] for state, event in state_map.items()}
+
+
+async def watch(path: str, on_change: Callable[[], None], interval: float = 1.0):
+    """
+    Call a function whenever a file is modified, until cancelled. The modification time is polled,
+    which works the same on every OS and costs one stat call per interval
+    :param path: The file to watch
+    :param on_change: Called after each modification
+    :param interval: How long to wait (in seconds) between checks
+    """
+    def modified_at():
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    last = modified_at()
+    while True:
+        await asyncio.sleep(interval)
+        current = modified_at()
+        if current != last and current is not None:
+            last = current
+            try:
+                on_change()
+            except Exception as e:
+                logging.error(f'Config: Unable to apply the changes to "{path}"')
+                logging.debug(repr(e))
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Sequence
+
+
+class ActionDispatcher:
+    def __init__(self, run_action: Callable, maxsize: int = 4, on_outcome: Callable[[str, Any, Any, float], None] = None):
+        """
+        Runs the actions of game events on a worker thread, so that slow actions never hold up state detection.
+        Only the newest event matters: submitting an event drops every event still waiting in the queue,
+        and the remaining actions of an event that is already running are skipped. An event without actions overrides nothing
+        :param run_action: Called with each action. It may block
+        :param maxsize: The size of the event queue
+        :param on_outcome: Called on the event loop after each action with the event name, the action, what run_action returned
+                           (or the exception it raised) and how long after the event was submitted the action finished
+        """
+        self.run_action: Callable = run_action
+        self.on_outcome: Callable[[str, Any, Any, float], None] = on_outcome
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.generation: int = 0
+        self.superseded: int = 0  # How many actions were dropped because a newer event arrived
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='actions')
+
+    def submit(self, event_name: str, actions: Sequence):
+        """
+        Queue the actions of an event without waiting for them to run
+        :param event_name: The name of the event, for logging
+        :param actions: The actions to run, in order
+        """
+        if not actions:
+            return
+        self.generation += 1
+        while not self.queue.empty():
+            _, stale_name, stale_actions, _ = self.queue.get_nowait()
+            self.queue.task_done()
+            self.superseded += len(stale_actions)
+            logging.info(f'Dispatch: Dropped pending actions of "{stale_name}"')
+        try:
+            self.queue.put_nowait((self.generation, event_name, actions, time.monotonic()))
+        except asyncio.QueueFull:  # The queue was just emptied, but a full queue must never end detection
+            self.superseded += len(actions)
+            logging.error(f'Dispatch: The queue is full. Dropped the actions of "{event_name}"')
+
+    async def run(self):
+        """
+        Run queued actions until cancelled
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                generation, event_name, actions, submitted_at = await self.queue.get()
+                for i, action in enumerate(actions):
+                    if generation != self.generation:
+                        self.superseded += len(actions) - i
+                        logging.info(f'Dispatch: Skipped remaining actions of "{event_name}"')
+                        break
+                    try:
+                        outcome = await loop.run_in_executor(self._executor, self.run_action, action)
+                    except Exception as e:
+                        logging.error(f'Dispatch: Action {action} of "{event_name}" failed')
+                        logging.debug(repr(e))
+                        outcome = e
+                    if self.on_outcome is not None:
+                        self.on_outcome(event_name, action, outcome, time.monotonic() - submitted_at)
+                self.queue.task_done()
+        finally:
+            self._executor.shutdown(wait=False)
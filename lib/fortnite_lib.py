@@ -1,15 +1,19 @@
-import sys
+import functools
+import operator
 from enum import Enum, auto
-from typing import Tuple
+from typing import TYPE_CHECKING, Dict, List, Sequence, Tuple
 
-try:
-    from ctypes import windll
-except ImportError:
-    sys.exit('This script is only compatible with Windows')
+from lib import metrics
+from lib.classifier import Classifier
+from lib.frame_source import BYTES_PER_PIXEL, Frame, FrameLayout, FrameSource, GdiFrameSource, Region
 
-_DC = windll.user32.GetDC(0)
+if TYPE_CHECKING:
+    # Imported where they are used instead, as they need NumPy, which takes a while to import and polling does not need
+    import numpy as np
+    from lib.calibration import CalibrationProfile
+    from lib.recording import ReplayFrameSource
 
-# TODO write calibration tool to accommodate different brightness settings
+# The defaults below assume a brightness of .50. Other settings need a calibration profile (see calibrate.py)
 
 _COLORS = {  # (RRR, GGG, BBB)
     'menu_left': (16, 28, 41),  # (16, 28, 41)
@@ -20,6 +24,7 @@ _COLORS = {  # (RRR, GGG, BBB)
     'storm_waiting': (0, 211, 246),  # (0,211,246)
 }
 
+# Measured on a 1920x1080 display. Use display_index() for the coordinates on other displays
 _PIXELS = {
     'menu_left': [(0, 1022), (4, 1022), (9, 1022), (10, 1022)],
     'menu_middle': [(500, 1022), (800, 1022), (1600, 1022), (1919, 1022)],
@@ -30,18 +35,223 @@ _PIXELS = {
 
 }
 
+REFERENCE_DISPLAY = (1920, 1080)
+
+# The smallest and the largest display sizes that are supported
+MIN_DISPLAY = (320, 200)
+MAX_DISPLAY = (15360, 8640)
+
+# How many display sizes the coordinates, pixel offsets and classifiers are kept for
+_CACHED_DISPLAYS = 16
+
+# How the pixels of each color key move with the display size. The menu bar sticks to the bottom edge, with its left end
+# fixed to the left edge and the rest spread across the width. The HUD sticks to the top-right corner.
+# Fixed-size elements scale with min(width / 1920, height / 1080)
+_ANCHORS = {
+    'menu_left': 'bottom_left',
+    'menu_middle': 'bottom_stretch',
+    'waiting': 'top_right',
+    'launching': 'top_right',
+    'can_parachute': 'top_right',
+    'storm_waiting': 'top_right',
+}
+
+# The color keys whose pixels are captured together in one region. Each region is captured once per poll
+_REGION_GROUPS = [
+    (['menu_left', 'menu_middle'], True),  # The bottom menu bar, captured across the full width
+    (['waiting', 'launching', 'can_parachute', 'storm_waiting'], False),  # The HUD box under the minimap
+]
+
 _DISTANCE = 3
 
 
-def _get_pixel(x: int, y: int) -> int:
+def _normalize(anchor: str, x: int, y: int) -> Tuple[float, float]:
+    """
+    Convert a coordinate on the reference display into the normalized form of its anchor
+    :return: Distances from the anchor, in reference display heights (or a fraction of the width for stretched coordinates)
+    """
+    ref_width, ref_height = REFERENCE_DISPLAY
+    if anchor == 'bottom_left':
+        return x / ref_height, (ref_height - y) / ref_height
+    if anchor == 'bottom_stretch':
+        return x / (ref_width - 1), (ref_height - y) / ref_height
+    if anchor == 'top_right':
+        return (ref_width - x) / ref_height, y / ref_height
+    raise ValueError(f'Unknown anchor "{anchor}"')
+
+
+def _expand(anchor: str, u: float, v: float, width: int, height: int) -> Tuple[int, int]:
+    """
+    Convert a normalized coordinate into a pixel coordinate on a display
+    """
+    ref_width, ref_height = REFERENCE_DISPLAY
+    size = min(width / ref_width, height / ref_height) * ref_height  # One reference display height, scaled
+    if anchor == 'bottom_left':
+        x, y = u * size, height - v * size
+    elif anchor == 'bottom_stretch':
+        x, y = u * (width - 1), height - v * size
+    else:
+        x, y = width - u * size, v * size
+    return min(max(int(round(x)), 0), width - 1), min(max(int(round(y)), 0), height - 1)
+
+
+_NORMALIZED = {key: [_normalize(_ANCHORS[key], x, y) for x, y in pairs] for key, pairs in _PIXELS.items()}
+
+
+class DisplayIndex:
+    def __init__(self, width: int, height: int):
+        """
+        The pixel coordinates and capture regions for one display size, expanded once from the normalized coordinates
+        :param width: The width of the display
+        :param height: The height of the display
+        """
+        self.display: Tuple[int, int] = (width, height)
+        self.pixels: Dict[str, List[Tuple[int, int]]] = {
+            key: [_expand(_ANCHORS[key], u, v, width, height) for u, v in coordinates] for key, coordinates in _NORMALIZED.items()
+        }
+
+        regions = []
+        for keys, full_width in _REGION_GROUPS:
+            pairs = [pair for key in keys for pair in self.pixels[key]]
+            top, bottom = min(y for _, y in pairs), max(y for _, y in pairs)
+            left, right = (0, width - 1) if full_width else (min(x for x, _ in pairs), max(x for x, _ in pairs))
+            regions.append(Region(left, top, right - left + 1, bottom - top + 1))
+        self.layout: FrameLayout = FrameLayout(regions, self.display)
+
+        # Only the checked pixels, one 1x1 region each. Used for compact recordings
+        unique = list(dict.fromkeys(pair for pairs in self.pixels.values() for pair in pairs))
+        self.sample_layout: FrameLayout = FrameLayout([Region(x, y, 1, 1) for x, y in unique], self.display)
+
+
+def valid_display(width: int, height: int) -> bool:
+    """
+    :return: True if the display size is supported, false otherwise
+    """
+    return MIN_DISPLAY[0] <= width <= MAX_DISPLAY[0] and MIN_DISPLAY[1] <= height <= MAX_DISPLAY[1]
+
+
+@functools.lru_cache(maxsize=_CACHED_DISPLAYS)
+def display_index(width: int, height: int) -> DisplayIndex:
+    """
+    Get the coordinates for a display size. They are computed on the first call for each size,
+    and kept for the most recently used sizes
+    :param width: The width of the display
+    :param height: The height of the display
+    :return: The index of the display
+    :raises ValueError: If the display size is not supported
+    """
+    if not valid_display(width, height):
+        raise ValueError(f'Unsupported display size {width}x{height}')
+    return DisplayIndex(width, height)
+
+
+LAYOUT = display_index(*REFERENCE_DISPLAY).layout
+
+SAMPLE_LAYOUT = display_index(*REFERENCE_DISPLAY).sample_layout
+
+_display: DisplayIndex = display_index(*REFERENCE_DISPLAY)
+
+# The byte offset of every checked pixel in frames of each layout, by color key
+_offsets: Dict[FrameLayout, Dict[str, List[int]]] = {}
+
+_source: FrameSource = None
+
+_CAPTURE_SECONDS = metrics.Histogram('fortnite_capture_seconds', 'Time spent capturing a frame')
+_CHECK_SECONDS = metrics.Histogram('fortnite_state_check_seconds', 'Time spent in a single state check', ['check'])
+_GET_STATE_SECONDS = metrics.Histogram('fortnite_get_state_seconds', 'Time spent determining the state of a frame')
+_POLLS = metrics.Counter('fortnite_polls_total', 'Polls of the state machine. "skipped" polls ran no check because no checked pixel changed', ['result'])
+
+_profile: 'CalibrationProfile' = None
+_profile_lut: memoryview = None
+_profile_generation: int = 0  # Changes whenever the colors change, so remembered check results can be dropped
+
+
+def set_display(width: int, height: int):
+    """
+    Change the size of the display that is captured. Defaults to 1920x1080
+    :param width: The width of the display
+    :param height: The height of the display
+    """
+    global _display
+    _display = display_index(width, height)
+
+
+def display() -> DisplayIndex:
+    """
+    :return: The index of the display that is captured
+    """
+    return _display
+
+
+def set_frame_source(source: FrameSource):
+    """
+    Change where frames are captured from. By default, the screen is captured with GDI
+    :param source: A frame source using display().layout
+    """
+    global _source
+    _source = source
+
+
+def source_layout() -> FrameLayout:
+    """
+    :return: The layout of the frames capture() returns
+    """
+    return _source.layout if _source is not None else _display.layout
+
+
+@metrics.timed(_CAPTURE_SECONDS)
+def capture(frame: Frame = None) -> Frame:
+    """
+    Capture every region needed to determine the state
+    :param frame: A frame with the layout of source_layout() to capture into. A frame is allocated if this is not set
+    :return: The captured frame
+    :raises OSError: If no frame source was set and the screen cannot be captured (not running on Windows)
+    """
+    global _source
+    if _source is None:
+        _source = GdiFrameSource(_display.layout)
+    return _source.grab(frame)
+
+
+def _index(layout: FrameLayout) -> DisplayIndex:
+    return display_index(*(layout.display or REFERENCE_DISPLAY))
+
+
+def _remember(cache: dict, key, value, limit: int = 2 * _CACHED_DISPLAYS):
+    """
+    Store a value in a cache, dropping the oldest entry once the cache is full
+    :param limit: How many entries the cache holds. Each display size has two layouts by default
+    :return: The value
+    """
+    if len(cache) >= limit:
+        cache.pop(next(iter(cache)), None)
+    cache[key] = value
+    return value
+
+
+def _pixel_offsets(layout: FrameLayout) -> Dict[str, List[int]]:
+    """
+    Find where the pixels of every color key are stored in frames of a layout. The result is computed once per layout
+    :param layout: The layout of the frames
+    :return: The byte offsets of the pixels of each color key
+    """
+    offsets = _offsets.get(layout)
+    if offsets is None:
+        pixels = _index(layout).pixels
+        offsets = _remember(_offsets, layout, {key: [layout.index(x, y) for x, y in pairs] for key, pairs in pixels.items()})
+    return offsets
+
+
+def _get_pixel(frame: Frame, offset: int) -> int:
     """
-    Get a pixel from the screen at (x, y)
-    :param x: The x-coordinate
-    :param y: The y-coordinate
+    Get a pixel from a captured frame
+    :param frame: The frame to read from
+    :param offset: The byte offset of the pixel in the frame's buffer
     :return: An integer in the byte format 0xBBGGRR
     :note: These integers are calculated by taking the hex values of the RGB, then converting 0xBBGGRR to base 10
     """
-    return windll.gdi32.GetPixel(_DC, x, y)
+    buf = frame.buffer
+    return buf[offset + 2] | (buf[offset + 1] << 8) | (buf[offset] << 16)
 
 
 def _pixel_to_rgb(pixel: int) -> Tuple[int, int, int]:
@@ -71,58 +281,85 @@ def _in_acceptable_range(color_to_check: Tuple[int, int, int], color_ref: Tuple[
     return False
 
 
-def _in_menu() -> bool:
+def _matches(pixel: int, key: str) -> bool:
+    """
+    Check if a pixel has the color of a color key. With a calibration profile loaded, this is a single table read
+    :param pixel: A pixel in the byte format 0xBBGGRR
+    :param key: The color key
+    :return: True if the pixel matches, false otherwise
+    """
+    if _profile_lut is not None:
+        return bool(_profile_lut[pixel] & _profile.bits[key])
+    return _in_acceptable_range(_pixel_to_rgb(pixel), _COLORS[key], distance=_DISTANCE)
+
+
+@metrics.timed(_CHECK_SECONDS, 'in_menu')
+def _in_menu(frame: Frame) -> bool:
     """
     Check if the Fortnite main menu is visible
+    :param frame: The frame to check
     :return: True if the main menu is visible, false otherwise
     """
+    offsets = _pixel_offsets(frame.layout)
     # Check the bottom menu bar at the far left.
-    errors = len([pair for pair in _PIXELS['menu_left']
-                  if not _in_acceptable_range(_pixel_to_rgb(_get_pixel(*pair)), _COLORS['menu_left'], distance=_DISTANCE)])
+    errors = len([offset for offset in offsets['menu_left']
+                  if not _matches(_get_pixel(frame, offset), 'menu_left')])
     # and check the the middle to the end of the bar
-    errors += len([pair for pair in _PIXELS['menu_middle']
-                   if not _in_acceptable_range(_pixel_to_rgb(_get_pixel(*pair)), _COLORS['menu_middle'], distance=_DISTANCE)])
+    errors += len([offset for offset in offsets['menu_middle']
+                   if not _matches(_get_pixel(frame, offset), 'menu_middle')])
     # Allow one error because the mouse may be covering one of the spots
     return errors < 2
 
 
-def _waiting() -> bool:
+@metrics.timed(_CHECK_SECONDS, 'waiting')
+def _waiting(frame: Frame) -> bool:
     """
     Check if the Fortnite is waiting for players
+    :param frame: The frame to check
     :return: True if the game is in the waiting state, false otherwise
     """
-    errors = len([pair for pair in _PIXELS['waiting']
-                  if not _in_acceptable_range(_pixel_to_rgb(_get_pixel(*pair)), _COLORS['waiting'], distance=_DISTANCE)])
+    offsets = _pixel_offsets(frame.layout)
+    errors = len([offset for offset in offsets['waiting']
+                  if not _matches(_get_pixel(frame, offset), 'waiting')])
     return errors < 2
 
 
-def _launching() -> bool:
+@metrics.timed(_CHECK_SECONDS, 'launching')
+def _launching(frame: Frame) -> bool:
     """
     Check if the Battle Bus is launching
+    :param frame: The frame to check
     :return: True if the Battle Bus is launching, false otherwise
     """
-    errors = len([pair for pair in _PIXELS['launching']
-                  if not _in_acceptable_range(_pixel_to_rgb(_get_pixel(*pair)), _COLORS['launching'], distance=_DISTANCE)])
+    offsets = _pixel_offsets(frame.layout)
+    errors = len([offset for offset in offsets['launching']
+                  if not _matches(_get_pixel(frame, offset), 'launching')])
     return errors < 2
 
 
-def _can_parachute() -> bool:
+@metrics.timed(_CHECK_SECONDS, 'can_parachute')
+def _can_parachute(frame: Frame) -> bool:
     """
     Check if the game is in the parachuting state
+    :param frame: The frame to check
     :return: True if players can still parachute, false otherwise
     """
-    errors = len([pair for pair in _PIXELS['can_parachute']
-                  if not _in_acceptable_range(_pixel_to_rgb(_get_pixel(*pair)), _COLORS['can_parachute'], distance=_DISTANCE)])
+    offsets = _pixel_offsets(frame.layout)
+    errors = len([offset for offset in offsets['can_parachute']
+                  if not _matches(_get_pixel(frame, offset), 'can_parachute')])
     return errors < 2
 
 
-def _storm_waiting() -> bool:
+@metrics.timed(_CHECK_SECONDS, 'storm_waiting')
+def _storm_waiting(frame: Frame) -> bool:
     """
     Check if the storm is currently not closing
+    :param frame: The frame to check
     :return: True if the storm is stopped, false otherwise
     """
-    errors = len([pair for pair in _PIXELS['storm_waiting']
-                  if not _in_acceptable_range(_pixel_to_rgb(_get_pixel(*pair)), _COLORS['storm_waiting'], distance=_DISTANCE)])
+    offsets = _pixel_offsets(frame.layout)
+    errors = len([offset for offset in offsets['storm_waiting']
+                  if not _matches(_get_pixel(frame, offset), 'storm_waiting')])
     return errors < 2
 
 
@@ -136,15 +373,287 @@ class GameState(Enum):
     STORM_WAITING = auto()
 
 
-def get_state() -> GameState:
-    if _waiting():
-        return GameState.WAITING
-    if _launching():
-        return GameState.LAUNCHING
-    if _can_parachute():
-        return GameState.CAN_PARACHUTE
-    if _storm_waiting():
-        return GameState.STORM_WAITING
-    if _in_menu():
-        return GameState.IN_MENU
-    return GameState.UNKNOWN
+# The states in the order they are checked, and the color keys each of them checks
+_STATE_CHECKS = [
+    (GameState.WAITING, ['waiting']),
+    (GameState.LAUNCHING, ['launching']),
+    (GameState.CAN_PARACHUTE, ['can_parachute']),
+    (GameState.STORM_WAITING, ['storm_waiting']),
+    (GameState.IN_MENU, ['menu_left', 'menu_middle']),
+]
+
+# The classifier of each display size, compiled with the current colors
+_classifiers: Dict[Tuple[int, int], Classifier] = {}
+
+
+def _classifier(layout: FrameLayout = None) -> Classifier:
+    """
+    Get the classifier for frames of a layout
+    :param layout: The layout of the frames. Defaults to the captured display
+    :return: The classifier, compiled on first use
+    """
+    index = _index(layout) if layout is not None else _display
+    classifier = _classifiers.get(index.display)
+    if classifier is None:
+        if _profile is None:
+            classifier = Classifier(index.pixels, _COLORS, _DISTANCE, _STATE_CHECKS, default=GameState.UNKNOWN)
+        else:
+            classifier = Classifier(index.pixels, _profile.colors, _DISTANCE, _STATE_CHECKS, default=GameState.UNKNOWN,
+                                    tolerances=_profile.tolerances, lut=_profile.lut, key_bits=_profile.bits)
+        _remember(_classifiers, index.display, classifier, _CACHED_DISPLAYS)
+    return classifier
+
+
+def load_profile(profile: 'CalibrationProfile'):
+    """
+    Detect states with calibrated colors instead of the defaults
+    :param profile: The calibration profile. None restores the defaults
+    """
+    global _profile, _profile_lut, _profile_generation
+    _profile = profile
+    _profile_lut = memoryview(profile.lut) if profile is not None else None
+    _profile_generation += 1
+    _classifiers.clear()
+
+
+def calibrate(recordings: Sequence['ReplayFrameSource'], **kwargs) -> 'CalibrationProfile':
+    """
+    Learn the reference color and tolerance of each color key from recordings of every state
+    :param recordings: The recordings to learn from
+    :param kwargs: Passed on to lib.calibration.learn
+    :return: A profile holding the learned colors, and the defaults for keys that were not seen often enough
+    """
+    import numpy as np
+    from lib.calibration import CalibrationProfile, learn
+    samples = {}
+    for key in _PIXELS:
+        samples[key] = np.concatenate([
+            recording.records()['pixels'][:, [offset // BYTES_PER_PIXEL for offset in _pixel_offsets(recording.layout)[key]]]
+            for recording in recordings
+        ])
+    colors, tolerances = learn(samples, _COLORS, **kwargs)
+    return CalibrationProfile({**_COLORS, **colors}, {**{key: _DISTANCE for key in _COLORS}, **tolerances})
+
+
+def sample(frames: Sequence[Frame]) -> 'np.ndarray':
+    """
+    Read the checked pixels of many frames into one stack, e.g. to re-label a recorded session
+    :param frames: The frames to sample. They must all have the same layout
+    :return: An array of shape (frames, pixels, 4) in BGRX order
+    """
+    return _classifier(frames[0].layout if len(frames) else None).sample_many(frames)
+
+
+def classify(samples: 'np.ndarray', layout: FrameLayout = None) -> 'np.ndarray':
+    """
+    Determine the state of a whole stack of sampled frames in one call
+    :param samples: An array of shape (frames, pixels, channels) in BGR(X) order, as returned by sample()
+    :param layout: The layout of the sampled frames. Defaults to the captured display
+    :return: An array of shape (frames,) holding the GameState of each frame
+    """
+    return _classifier(layout).classify(samples)
+
+
+def classify_recording(recording: 'ReplayFrameSource', chunk_size: int = 65536) -> Tuple['np.ndarray', 'np.ndarray']:
+    """
+    Determine the state of every frame of a recording, reading the records straight from the memory map
+    :param recording: The recording to classify
+    :param chunk_size: How many frames to classify per batch, to bound memory use
+    :return: The timestamp and the GameState of each frame
+    """
+    import numpy as np
+    records = recording.records()
+    classifier = _classifier(recording.layout)
+    indices = classifier.pixel_indices(recording.layout)
+    states = np.empty(len(records), dtype=object)
+    for start in range(0, len(records), chunk_size):
+        states[start:start + chunk_size] = classifier.classify(records['pixels'][start:start + chunk_size, indices])
+    return records['timestamp'].copy(), states
+
+
+@metrics.timed(_GET_STATE_SECONDS)
+def get_state(frame: Frame = None) -> GameState:
+    """
+    Determine the state of the game
+    :param frame: The frame to check. A new frame is captured if this is not set
+    :return: The current state
+    """
+    if frame is None:
+        frame = capture()
+    return _classifier(frame.layout).classify_frame(frame)
+
+
+_CHECKS = {}
+
+
+def _build_checks():
+    # Looked up by name, so the checks are timed once metrics are enabled
+    _CHECKS.update({
+        GameState.WAITING: _waiting,
+        GameState.LAUNCHING: _launching,
+        GameState.CAN_PARACHUTE: _can_parachute,
+        GameState.STORM_WAITING: _storm_waiting,
+        GameState.IN_MENU: _in_menu,
+    })
+
+
+_build_checks()
+metrics.on_enable(_build_checks)
+
+# Per layout, reads the bytes of every checked pixel in one call, and the slice of the result each state check depends on
+_signatures: Dict[FrameLayout, Tuple[operator.itemgetter, List[Tuple[GameState, slice]]]] = {}
+
+
+def _signature(layout: FrameLayout) -> Tuple[operator.itemgetter, List[Tuple[GameState, slice]]]:
+    """
+    Get the reader of the checked pixels of frames of a layout. The result is computed once per layout
+    :param layout: The layout of the frames
+    :return: A function from a frame's buffer to the B, G and R bytes of every checked pixel,
+             and the slice of those bytes each state check reads
+    """
+    signature = _signatures.get(layout)
+    if signature is None:
+        offsets = _pixel_offsets(layout)
+        indices = []
+        slices = []
+        for state, keys in _STATE_CHECKS:
+            start = len(indices)
+            indices.extend(offset + channel for key in keys for offset in offsets[key] for channel in range(3))
+            slices.append((state, slice(start, len(indices))))
+        signature = _remember(_signatures, layout, (operator.itemgetter(*indices), slices))
+    return signature
+
+
+# The states that can legally follow each state, most likely first. A frame that matches none of them is classified
+# as a whole, so jumps the graph does not expect (e.g. dying while parachuting) are still seen on the same poll.
+# Any state can also fall back to UNKNOWN (loading screens, the storm closing, the map being open...)
+_TRANSITIONS = {
+    GameState.UNKNOWN: [state for state, _ in _STATE_CHECKS],
+    GameState.IN_MENU: [GameState.WAITING],
+    GameState.WAITING: [GameState.LAUNCHING, GameState.IN_MENU],
+    GameState.LAUNCHING: [GameState.CAN_PARACHUTE],
+    GameState.CAN_PARACHUTE: [GameState.STORM_WAITING],
+    GameState.STORM_WAITING: [GameState.IN_MENU],
+}
+
+
+class StateMachine:
+    def __init__(self, sweep_interval: int = 30):
+        """
+        Tracks the state of the game across polls. Only the last confirmed state and its legal successors are checked.
+        Every state is swept when none of them matches, and every few polls to catch jumps between states that do match.
+        The result of each check is reused until one of the pixels it reads changes, so a stable screen costs one read
+        of the checked pixels per poll
+        :param sweep_interval: How many polls may pass between full sweeps
+        """
+        self.state: GameState = None
+        self.sweep_interval: int = sweep_interval
+        self.polls: int = 0
+        self.checks: int = 0  # How many single-state checks have been run, for comparing against full sweeps
+        self.reused: int = 0  # How many check results were reused because none of their pixels changed
+        self.skipped: int = 0  # How many polls ran no check at all
+        self._since_sweep: int = 0
+        # The result of each state check, kept until one of the pixels it reads changes
+        self._results: Dict[GameState, bool] = {}
+        self._pixels: tuple = None
+        self._layout: FrameLayout = None
+        self._generation: int = None
+
+    def update(self, frame: Frame = None) -> GameState:
+        """
+        Determine the state of the game, starting from the last confirmed state
+        :param frame: The frame to check. A new frame is captured if this is not set
+        :return: The current state
+        """
+        if frame is None:
+            frame = capture()
+        self.polls += 1
+        self._since_sweep += 1
+        checks = self.checks
+        changed = self._forget_changed(frame)
+
+        if not changed and self._since_sweep < self.sweep_interval and self._results.get(self.state):
+            # Nothing moved and the state was confirmed by its own check, so it is still the same
+            self.reused += 1
+            self.skipped += 1
+            _POLLS.inc('skipped')
+            return self.state
+        if self.state is None or self._since_sweep >= self.sweep_interval:
+            self._since_sweep = 0
+            self.state = self._sweep(frame)
+        else:
+            candidates = _TRANSITIONS[self.state]
+            if self.state in _CHECKS:
+                candidates = [self.state] + candidates
+            new_state = None
+            for candidate in candidates:
+                if self._check(candidate, frame):
+                    new_state = candidate
+                    break
+            if new_state is None:
+                # Only UNKNOWN if no other state matches either. The candidates that were just checked are reused
+                self._since_sweep = 0
+                new_state = self._sweep(frame)
+            self.state = new_state
+
+        if self.checks == checks:
+            self.skipped += 1
+            _POLLS.inc('skipped')
+        else:
+            _POLLS.inc('checked')
+        return self.state
+
+    def _forget_changed(self, frame: Frame) -> bool:
+        """
+        Drop the remembered result of every state check whose pixels differ from the previous frame
+        :return: True if any checked pixel changed, false otherwise
+        """
+        read, slices = _signature(frame.layout)
+        pixels = read(frame.buffer)
+        if frame.layout is not self._layout or _profile_generation != self._generation:
+            self._layout, self._generation = frame.layout, _profile_generation
+            self._results.clear()
+            changed = True
+        else:
+            changed = pixels != self._pixels
+            if changed and self._results:
+                previous = self._pixels
+                for state, part in slices:
+                    if pixels[part] != previous[part]:
+                        self._results.pop(state, None)
+        self._pixels = pixels
+        return changed
+
+    def _check(self, state: GameState, frame: Frame) -> bool:
+        result = self._results.get(state)
+        if result is None:
+            self.checks += 1
+            result = self._results[state] = _CHECKS[state](frame)
+        else:
+            self.reused += 1
+        return result
+
+    def _sweep(self, frame: Frame) -> GameState:
+        """
+        Check every state in order of preference. Remembered results are used if there is one for every state that
+        needs checking, otherwise the frame is classified as a whole
+        """
+        for i, (state, _) in enumerate(_STATE_CHECKS):
+            result = self._results.get(state)
+            if result is None:
+                break
+            if result:
+                self.reused += i + 1
+                return state
+        else:
+            self.reused += len(_STATE_CHECKS)
+            return GameState.UNKNOWN
+
+        self.checks += len(_CHECKS)
+        new_state = get_state(frame)
+        # The classifier prefers states in the same order, so every state before the result did not match
+        for state, _ in _STATE_CHECKS:
+            self._results[state] = state == new_state
+            if state == new_state:
+                break
+        return new_state
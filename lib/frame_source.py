@@ -0,0 +1,295 @@
+import os
+import time
+import ctypes
+from typing import List, NamedTuple, Sequence, Tuple
+
+try:
+    from ctypes import windll, wintypes
+except (ImportError, ValueError):
+    windll = None
+
+# Frames store pixels the way a 32-bit top-down DIB does: 4 bytes per pixel in the order B, G, R, X
+BYTES_PER_PIXEL = 4
+
+
+class Region(NamedTuple):
+    left: int
+    top: int
+    width: int
+    height: int
+
+
+class FrameLayout:
+    def __init__(self, regions: Sequence[Region], display: Tuple[int, int] = None):
+        """
+        Describes how a set of screen regions is packed, row by row and region after region, into one contiguous buffer
+        :param regions: The regions of the screen to capture
+        :param display: The (width, height) of the display the regions were laid out for, if known
+        """
+        self.regions: tuple = tuple(regions)
+        self.display: Tuple[int, int] = tuple(display) if display else None
+        self.offsets: List[int] = []  # The pixel offset of each region inside the buffer
+        pixels = 0
+        for region in self.regions:
+            self.offsets.append(pixels)
+            pixels += region.width * region.height
+        self.pixels: int = pixels
+        self.size: int = pixels * BYTES_PER_PIXEL
+
+    def index(self, x: int, y: int) -> int:
+        """
+        Find where a screen coordinate is stored in the buffer
+        :param x: The x-coordinate
+        :param y: The y-coordinate
+        :return: The byte offset of the pixel inside the buffer
+        :raises IndexError: If no region of the layout covers (x, y)
+        """
+        for region, offset in zip(self.regions, self.offsets):
+            if region.left <= x < region.left + region.width and region.top <= y < region.top + region.height:
+                return (offset + (y - region.top) * region.width + (x - region.left)) * BYTES_PER_PIXEL
+        raise IndexError(f'({x}, {y}) is not covered by the frame layout')
+
+
+class Frame:
+    __slots__ = ('layout', 'buffer', 'timestamp')
+
+    def __init__(self, layout: FrameLayout, buffer: bytearray = None, timestamp: float = 0.0):
+        """
+        A single capture of every region in a layout
+        :param layout: The layout of the buffer
+        :param buffer: The pixel data. A zeroed buffer is allocated if this is not set
+        :param timestamp: When the frame was captured
+        """
+        self.layout: FrameLayout = layout
+        self.buffer: bytearray = bytearray(layout.size) if buffer is None else buffer
+        self.timestamp: float = timestamp
+
+    def pixel(self, x: int, y: int) -> int:
+        """
+        Get a captured pixel at (x, y)
+        :param x: The x-coordinate
+        :param y: The y-coordinate
+        :return: An integer in the byte format 0xBBGGRR, the same as GDI's GetPixel
+        """
+        i = self.layout.index(x, y)
+        buf = self.buffer
+        return buf[i + 2] | (buf[i + 1] << 8) | (buf[i] << 16)
+
+
+class FrameSource:
+    def __init__(self, layout: FrameLayout):
+        """
+        Base class for everything that can produce frames
+        :param layout: The regions to capture on every grab
+        """
+        self.layout: FrameLayout = layout
+
+    def grab(self, frame: Frame = None) -> Frame:
+        """
+        Capture every region of the layout
+        :param frame: A frame to capture into. Its buffer is overwritten. A new frame is allocated if this is not set
+        :return: The captured frame
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _BitmapInfoHeader(ctypes.Structure):
+    _fields_ = [
+        ('biSize', ctypes.c_uint32),
+        ('biWidth', ctypes.c_int32),
+        ('biHeight', ctypes.c_int32),
+        ('biPlanes', ctypes.c_uint16),
+        ('biBitCount', ctypes.c_uint16),
+        ('biCompression', ctypes.c_uint32),
+        ('biSizeImage', ctypes.c_uint32),
+        ('biXPelsPerMeter', ctypes.c_int32),
+        ('biYPelsPerMeter', ctypes.c_int32),
+        ('biClrUsed', ctypes.c_uint32),
+        ('biClrImportant', ctypes.c_uint32),
+    ]
+
+
+_SRCCOPY = 0x00CC0020
+_DIB_RGB_COLORS = 0
+_BI_RGB = 0
+
+
+class GdiFrameSource(FrameSource):
+    def __init__(self, layout: FrameLayout):
+        """
+        Capture the screen with GDI. Each region is copied with a single BitBlt and read back with a single GetDIBits
+        :param layout: The regions to capture on every grab
+        :raises OSError: If GDI is not available (not running on Windows)
+        """
+        if windll is None:
+            raise OSError('GDI capture is only available on Windows')
+        super().__init__(layout)
+
+        user32, gdi32 = windll.user32, windll.gdi32
+        user32.GetDC.restype = wintypes.HDC
+        user32.GetDC.argtypes = [wintypes.HWND]
+        user32.ReleaseDC.argtypes = [wintypes.HWND, wintypes.HDC]
+        gdi32.CreateCompatibleDC.restype = wintypes.HDC
+        gdi32.CreateCompatibleDC.argtypes = [wintypes.HDC]
+        gdi32.CreateCompatibleBitmap.restype = wintypes.HBITMAP
+        gdi32.CreateCompatibleBitmap.argtypes = [wintypes.HDC, ctypes.c_int, ctypes.c_int]
+        gdi32.SelectObject.restype = wintypes.HGDIOBJ
+        gdi32.SelectObject.argtypes = [wintypes.HDC, wintypes.HGDIOBJ]
+        gdi32.BitBlt.argtypes = [wintypes.HDC, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                 wintypes.HDC, ctypes.c_int, ctypes.c_int, wintypes.DWORD]
+        gdi32.GetDIBits.argtypes = [wintypes.HDC, wintypes.HBITMAP, wintypes.UINT, wintypes.UINT,
+                                    ctypes.c_void_p, ctypes.c_void_p, wintypes.UINT]
+        gdi32.DeleteObject.argtypes = [wintypes.HGDIOBJ]
+        gdi32.DeleteDC.argtypes = [wintypes.HDC]
+
+        self._screen_dc = user32.GetDC(None)
+        self._mem_dc = gdi32.CreateCompatibleDC(self._screen_dc)
+        self._bitmaps = []
+        self._headers = []
+        for region in layout.regions:
+            self._bitmaps.append(gdi32.CreateCompatibleBitmap(self._screen_dc, region.width, region.height))
+            header = _BitmapInfoHeader()
+            header.biSize = ctypes.sizeof(_BitmapInfoHeader)
+            header.biWidth = region.width
+            header.biHeight = -region.height  # Negative height means top-down rows
+            header.biPlanes = 1
+            header.biBitCount = BYTES_PER_PIXEL * 8
+            header.biCompression = _BI_RGB
+            self._headers.append(header)
+
+    def grab(self, frame: Frame = None) -> Frame:
+        gdi32 = windll.gdi32
+        if frame is None:
+            frame = Frame(self.layout)
+        address = ctypes.addressof((ctypes.c_char * self.layout.size).from_buffer(frame.buffer))
+        for region, offset, bitmap, header in zip(self.layout.regions, self.layout.offsets, self._bitmaps, self._headers):
+            previous = gdi32.SelectObject(self._mem_dc, bitmap)
+            gdi32.BitBlt(self._mem_dc, 0, 0, region.width, region.height, self._screen_dc, region.left, region.top, _SRCCOPY)
+            # The bitmap may not be selected into a DC while GetDIBits reads it
+            gdi32.SelectObject(self._mem_dc, previous)
+            gdi32.GetDIBits(self._mem_dc, bitmap, 0, region.height, address + offset * BYTES_PER_PIXEL,
+                            ctypes.byref(header), _DIB_RGB_COLORS)
+        frame.timestamp = time.time()
+        return frame
+
+    def close(self):
+        gdi32 = windll.gdi32
+        for bitmap in self._bitmaps:
+            gdi32.DeleteObject(bitmap)
+        self._bitmaps = []
+        if self._mem_dc:
+            gdi32.DeleteDC(self._mem_dc)
+            self._mem_dc = None
+        if self._screen_dc:
+            windll.user32.ReleaseDC(None, self._screen_dc)
+            self._screen_dc = None
+
+
+class FileFrameSource(FrameSource):
+    def __init__(self, layout: FrameLayout, path: str):
+        """
+        Read frames from a binary PPM (P6) screenshot. The file is parsed again whenever it changes on disk,
+        so it can be replaced while the source is in use
+        :param layout: The regions to capture on every grab
+        :param path: The path of the screenshot
+        """
+        super().__init__(layout)
+        self.path: str = path
+        self._mtime: float = None
+        self._cached: bytearray = None
+
+    def grab(self, frame: Frame = None) -> Frame:
+        """
+        :raises OSError: If the screenshot could not be read
+        :raises ValueError: If the screenshot is not a binary PPM or does not cover every region of the layout
+        """
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self._mtime:
+            self._cached = self._load()
+            self._mtime = mtime
+        if frame is None:
+            frame = Frame(self.layout)
+        frame.buffer[:] = self._cached
+        frame.timestamp = time.time()
+        return frame
+
+    def _load(self) -> bytearray:
+        with open(self.path, 'rb') as ppm_file:
+            width, height, pixels = read_ppm(ppm_file)
+        buffer = bytearray(self.layout.size)
+        for region, offset in zip(self.layout.regions, self.layout.offsets):
+            if region.left + region.width > width or region.top + region.height > height:
+                raise ValueError(f'"{self.path}" ({width}x{height}) does not cover {region}')
+            for row in range(region.height):
+                start = ((region.top + row) * width + region.left) * 3
+                rgb = pixels[start:start + region.width * 3]
+                dest = (offset + row * region.width) * BYTES_PER_PIXEL
+                end = dest + region.width * BYTES_PER_PIXEL
+                buffer[dest:end:4] = rgb[2::3]
+                buffer[dest + 1:end:4] = rgb[1::3]
+                buffer[dest + 2:end:4] = rgb[0::3]
+        return buffer
+
+
+def screen_size() -> Tuple[int, int]:
+    """
+    Get the size of the primary display in physical pixels
+    :return: A tuple in the format (width, height)
+    :raises OSError: If not running on Windows
+    """
+    if windll is None:
+        raise OSError('The screen size is only available on Windows')
+    windll.user32.SetProcessDPIAware()  # Otherwise scaled displays report their logical size
+    return windll.user32.GetSystemMetrics(0), windll.user32.GetSystemMetrics(1)
+
+
+def ppm_size(path: str) -> Tuple[int, int]:
+    """
+    Get the size of a binary PPM (P6) image
+    :param path: The path of the image
+    :return: A tuple in the format (width, height)
+    :raises OSError: If the image could not be read
+    :raises ValueError: If the file is not an 8-bit binary PPM
+    """
+    with open(path, 'rb') as ppm_file:
+        width, height, _ = read_ppm(ppm_file)
+    return width, height
+
+
+def read_ppm(ppm_file) -> tuple:
+    """
+    Parse a binary PPM (P6) image with 8-bit channels
+    :param ppm_file: A file opened in binary mode
+    :return: A tuple in the format (width, height, RGB bytes)
+    :raises ValueError: If the file is not an 8-bit binary PPM
+    """
+    data = ppm_file.read()
+    tokens = []
+    pos = 0
+    while len(tokens) < 4:
+        while pos < len(data) and data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b'#':
+            pos = data.index(b'\n', pos) + 1
+            continue
+        start = pos
+        while pos < len(data) and not data[pos:pos + 1].isspace():
+            pos += 1
+        tokens.append(data[start:pos])
+    pos += 1  # A single whitespace byte separates the header from the pixels
+    if tokens[0] != b'P6' or int(tokens[3]) != 255:
+        raise ValueError('Only 8-bit binary PPM (P6) images are supported')
+    width, height = int(tokens[1]), int(tokens[2])
+    pixels = data[pos:pos + width * height * 3]
+    if len(pixels) != width * height * 3:
+        raise ValueError('PPM image is truncated')
+    return width, height, pixels
@@ -0,0 +1,265 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Iterator, List
+
+# A journal is a directory of segments and an index:
+#   segment-<start in ms>.jsonl: one JSON object per line, in the order the records were made. Every record has the
+#                                wall-clock time "t" (seconds since the epoch) and a "kind", e.g. "transition" or "action"
+#   index.json:                  the file name, first and last "t" and record count of every segment, oldest first.
+#                                "end" is null while a segment is being written
+# Queries only read the segments whose time range overlaps the one asked for
+_INDEX = 'index.json'
+_INDEX_VERSION = 1
+
+_STOP = object()
+
+
+def _segment_name(directory: str, start: float) -> str:
+    # Segments started within the same millisecond get the next free one, so names stay unique and in order
+    milliseconds = int(start * 1000)
+    while os.path.exists(os.path.join(directory, f'segment-{milliseconds}.jsonl')):
+        milliseconds += 1
+    return f'segment-{milliseconds}.jsonl'
+
+
+def _scan(path: str) -> dict:
+    """
+    Read the time range of a segment from the segment itself, e.g. after a crash
+    :return: The index entry of the segment
+    """
+    start = end = None
+    records = 0
+    with open(path, 'r') as segment_file:
+        for line in segment_file:
+            try:
+                t = json.loads(line)['t']
+            except (ValueError, KeyError, TypeError):  # A line cut short by a crash
+                continue
+            start = t if start is None else start
+            end = t
+            records += 1
+    return {'file': os.path.basename(path), 'start': start, 'end': end, 'records': records}
+
+
+def load_index(directory: str) -> List[dict]:
+    """
+    Read the index of a journal, rebuilding it from the segments if it is missing or unreadable
+    :param directory: The directory of the journal
+    :return: The index entry of every segment, oldest first
+    """
+    try:
+        with open(os.path.join(directory, _INDEX), 'r') as index_file:
+            index = json.load(index_file)
+        if index.get('version') != _INDEX_VERSION:
+            raise ValueError(f'Unknown index version {index.get("version")}')
+        return index['segments']
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, AttributeError) as e:
+        logging.warning(f'Journal: The index of "{directory}" is unreadable. Rebuilding it')
+        logging.debug(repr(e))
+    try:
+        names = sorted((name for name in os.listdir(directory) if re.fullmatch(r'segment-\d+\.jsonl', name)),
+                       key=lambda name: int(name[8:-6]))
+    except FileNotFoundError:
+        return []
+    return [_scan(os.path.join(directory, name)) for name in names]
+
+
+def query(directory: str, since: float = None, until: float = None, kind: str = None, **fields) -> Iterator[dict]:
+    """
+    Find the records of a journal, oldest first. Only the segments that overlap the time range are read
+    :param directory: The directory of the journal
+    :param since: The earliest time (seconds since the epoch) to include. Defaults to the beginning
+    :param until: The latest time (seconds since the epoch) to include. Defaults to now
+    :param kind: Only include records of this kind
+    :param fields: Only include records with these values, e.g. from_state='LAUNCHING'
+    :return: The matching records
+    """
+    for entry in load_index(directory):
+        end = entry['end'] if entry['end'] is not None else float('inf')  # Still being written
+        if entry['start'] is None or (since is not None and end < since) or (until is not None and entry['start'] > until):
+            continue
+        try:
+            segment_file = open(os.path.join(directory, entry['file']), 'r')
+        except FileNotFoundError:  # Rotated away since the index was read
+            continue
+        with segment_file:
+            for line in segment_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if since is not None and record['t'] < since:
+                    continue
+                if until is not None and record['t'] > until:
+                    break
+                if kind is not None and record.get('kind') != kind:
+                    continue
+                if all(record.get(name) == value for name, value in fields.items()):
+                    yield record
+
+
+class Journal:
+    def __init__(self, directory: str = 'journal', max_bytes: int = 4 << 20, max_segments: int = 256):
+        """
+        An append-only record of what happened during every session (state transitions, the outcome of each action...).
+        Records are written on a background thread, so recording never waits for the disk. Every session starts a new
+        segment, and segments are rotated at max_bytes. The oldest segments are deleted beyond max_segments
+        :param directory: Where the segments and the index are kept. Created if it does not exist
+        :param max_bytes: The size at which a segment is closed and the next one started
+        :param max_segments: How many segments are kept
+        :raises OSError: If the directory could not be created
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.max_segments: int = max_segments
+        self.records: int = 0
+        self.failed: bool = False
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._segments: List[dict] = load_index(directory)
+        # Segments that were still open when the last session ended were not closed cleanly
+        for i, entry in enumerate(self._segments):
+            if entry['end'] is None:
+                try:
+                    self._segments[i] = _scan(os.path.join(directory, entry['file']))
+                except OSError:
+                    pass
+        self._file = None
+        self._entry: dict = None
+        self._thread: threading.Thread = threading.Thread(target=self._run, name='journal', daemon=True)
+        self._thread.start()
+
+    def record(self, kind: str, **fields):
+        """
+        Add a record. Returns right away
+        :param kind: What kind of record this is, e.g. "transition"
+        :param fields: The values of the record. They must be JSON serializable
+        """
+        if self.failed:
+            return
+        self._queue.put({'t': round(time.time(), 6), 'kind': kind, **fields})
+
+    def close(self, timeout: float = 5.0):
+        """
+        Write every queued record and close the current segment
+        :param timeout: How long to wait (in seconds) for the records to be written
+        """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            while True:
+                record = self._queue.get()
+                # Write everything that is queued, then flush once
+                while record is not _STOP:
+                    self._write(record)
+                    try:
+                        record = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if self._file is not None:
+                    self._file.flush()
+                if record is _STOP:
+                    break
+        except (OSError, TypeError, ValueError) as e:
+            self.failed = True
+            logging.error(f'Journal: Unable to write to "{self.directory}". Nothing more will be recorded this session')
+            logging.debug(repr(e))
+        finally:
+            self._close_segment()
+
+    def _write(self, record: dict):
+        if self._file is None:
+            self._open_segment(record['t'])
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        self._file.write(line)
+        self.records += 1
+        self._entry['records'] += 1
+        self._entry['last'] = record['t']
+        if self._file.tell() >= self.max_bytes:
+            self._close_segment()
+
+    def _open_segment(self, start: float):
+        self._entry = {'file': _segment_name(self.directory, start), 'start': start, 'end': None, 'records': 0}
+        self._file = open(os.path.join(self.directory, self._entry['file']), 'a')
+        self._segments.append(self._entry)
+        while len(self._segments) > self.max_segments:
+            oldest = self._segments.pop(0)
+            try:
+                os.remove(os.path.join(self.directory, oldest['file']))
+            except FileNotFoundError:
+                pass
+        self._save_index()
+
+    def _close_segment(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self._entry['end'] = self._entry.pop('last', self._entry['start'])
+        self._entry = None
+        self._save_index()
+
+    def _save_index(self):
+        # Replaced as a whole, so a reader never sees half an index
+        path = os.path.join(self.directory, _INDEX)
+        segments = [{key: value for key, value in entry.items() if key != 'last'} for entry in self._segments]
+        with open(path + '.tmp', 'w') as index_file:
+            json.dump({'version': _INDEX_VERSION, 'segments': segments}, index_file)
+        os.replace(path + '.tmp', path)
+
+
+def parse_time(text: str) -> float:
+    """
+    :param text: A time before now (e.g. "7d", "12h", "30m") or a local date and time (e.g. "2024-05-01" or "2024-05-01 18:30")
+    :return: The time in seconds since the epoch
+    :raises ValueError: If the text is neither
+    """
+    relative = re.fullmatch(r'(\d+(?:\.\d+)?)([smhd])', text.strip())
+    if relative:
+        return time.time() - float(relative.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[relative.group(2)]
+    return datetime.fromisoformat(text.strip()).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the records of a session journal as JSON lines')
+    parser.add_argument('--journal', default='journal', help='The directory of the journal (default: journal)')
+    parser.add_argument('--since', type=parse_time, help='Earliest record, e.g. 7d, 12h or 2024-05-01')
+    parser.add_argument('--until', type=parse_time, help='Latest record, in the same format as --since')
+    parser.add_argument('--kind', help='Only print records of this kind, e.g. transition or action')
+    parser.add_argument('--where', action='append', default=[], metavar='FIELD=VALUE',
+                        help='Only print records with this value, e.g. from_state=LAUNCHING. May be repeated')
+    parser.add_argument('--count', action='store_true', help='Print how many records match instead of the records')
+    args = parser.parse_args()
+
+    fields = {}
+    for condition in args.where:
+        name, separator, value = condition.partition('=')
+        if not separator:
+            sys.exit(f'"{condition}" is not in the format FIELD=VALUE')
+        try:
+            fields[name] = json.loads(value)
+        except ValueError:
+            fields[name] = value  # Plain strings do not need quotes
+    records = query(args.journal, args.since, args.until, args.kind, **fields)
+    if args.count:
+        print(sum(1 for _ in records))
+        return
+    for record in records:
+        print(json.dumps(record))
+
+
+if __name__ == '__main__':
+    main()
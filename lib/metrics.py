@@ -0,0 +1,251 @@
+import bisect
+import functools
+import logging
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Upper bounds (in seconds) of the histogram buckets, from a fast state check to a slow Spotify request
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                     for name, value in zip(names, values))
+    return f'{{{pairs}}}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        """
+        :param name: The name of the metric, in Prometheus style (e.g. spotify_http_request_seconds)
+        :param documentation: A one-line description
+        :param labels: The names of the labels every observation is made with
+        """
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labels: Tuple[str, ...] = tuple(labels)
+        self._lock: threading.Lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, label_values: Sequence) -> tuple:
+        if len(label_values) != len(self.labels):
+            raise ValueError(f'{self.name} takes the labels {self.labels}')
+        return tuple(map(str, label_values))
+
+    def expose(self) -> List[str]:
+        """
+        :return: The lines of the metric in the Prometheus text format
+        """
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        """
+        A count that only goes up, kept per combination of label values. Nothing is counted until metrics are enabled
+        """
+        super().__init__(name, documentation, labels)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        if not REGISTRY.enabled:
+            return
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(self._key(label_values), 0.0)
+
+    def expose(self) -> List[str]:
+        lines = super().expose()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labels, key)} {value:g}')
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        A distribution of observed values, kept per combination of label values. Nothing is observed until metrics are enabled
+        :param buckets: The upper bounds of the buckets, in increasing order
+        """
+        super().__init__(name, documentation, labels)
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+        self._series: Dict[tuple, list] = {}  # Label values -> [bucket counts, sum, count]
+
+    def observe(self, value: float, *label_values):
+        if not REGISTRY.enabled:
+            return
+        key = self._key(label_values)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *label_values) -> int:
+        series = self._series.get(self._key(label_values))
+        return series[2] if series is not None else 0
+
+    def sum(self, *label_values) -> float:
+        series = self._series.get(self._key(label_values))
+        return series[1] if series is not None else 0.0
+
+    def expose(self) -> List[str]:
+        lines = super().expose()
+        names = self.labels + ('le',)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    lines.append(f'{self.name}_bucket{_format_labels(names, key + (le,))} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {total:g}')
+                lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        """
+        Every metric, and the functions that are timed once metrics are enabled.
+        While disabled, timed functions are left exactly as they are written, so instrumentation costs nothing
+        """
+        self.enabled: bool = False
+        self.metrics: Dict[str, _Metric] = {}
+        self._timed: List[Tuple[Callable, Histogram, tuple]] = []
+        self._hooks: List[Callable] = []
+
+    def register(self, metric: _Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'A metric named {metric.name} already exists')
+        self.metrics[metric.name] = metric
+
+    def timed(self, histogram: Histogram, *label_values) -> Callable:
+        """
+        Decorate a module-level function or a method, so that its run time is observed once metrics are enabled
+        :param histogram: Where to observe the run time
+        :param label_values: The label values of the observations
+        :return: The decorator
+        """
+        def decorator(func: Callable) -> Callable:
+            self._timed.append((func, histogram, label_values))
+            if self.enabled:
+                self._install(func, histogram, label_values)
+            return func
+        return decorator
+
+    def on_enable(self, hook: Callable):
+        """
+        Call a function when metrics are enabled, e.g. to rebuild a table that holds references to timed functions
+        """
+        self._hooks.append(hook)
+        if self.enabled:
+            hook()
+
+    def enable(self):
+        """
+        Swap every timed function for its instrumented version. Cannot be undone
+        """
+        if self.enabled:
+            return
+        self.enabled = True
+        for func, histogram, label_values in self._timed:
+            self._install(func, histogram, label_values)
+        for hook in self._hooks:
+            hook()
+        logging.info(f'Metrics: Timing {len(self._timed)} functions')
+
+    @staticmethod
+    def _install(func: Callable, histogram: Histogram, label_values: tuple):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *label_values)
+
+        # Rebind the name the function was defined under, so every call through the module or class is timed
+        owner = sys.modules[func.__module__]
+        *path, name = func.__qualname__.split('.')
+        for part in path:
+            owner = getattr(owner, part)
+        setattr(owner, name, timed)
+
+    def expose(self) -> str:
+        """
+        :return: Every metric in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def timed(histogram: Histogram, *label_values) -> Callable:
+    return REGISTRY.timed(histogram, *label_values)
+
+
+def on_enable(hook: Callable):
+    REGISTRY.on_enable(hook)
+
+
+def enable():
+    REGISTRY.enable()
+
+
+def enabled() -> bool:
+    return REGISTRY.enabled
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = REGISTRY.expose().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """
+    Enable metrics and serve them at http://host:port/metrics on a background thread
+    :param port: The port to listen on. 0 picks a free port
+    :param host: The address to listen on. Only this computer can connect by default
+    :return: The server. Call shutdown() on it to stop serving
+    :raises OSError: If the port is not available
+    """
+    enable()
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f'Metrics: Serving at http://{host}:{server.server_address[1]}/metrics')
+    return server
@@ -0,0 +1,247 @@
+"""
+A local stand-in for the Spotify Web API and accounts service, for measuring the client without touching the real API.
+Run it directly to compare fresh connections against the pooled session of SpotifyClient:
+    python -m lib.mock_spotify
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive unless the client closes them
+
+    def setup(self):
+        super().setup()
+        # Stands in for the TCP and TLS handshakes of a new connection to api.spotify.com
+        self.server.connections += 1
+        time.sleep(self.server.connect_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: dict = None, headers: dict = None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_HEAD(self):
+        self._reply(200)
+
+    def _authorized(self) -> bool:
+        token = self.headers.get('Authorization', '')[len('Bearer '):]
+        if token in self.server.access_tokens:
+            return True
+        self._reply(401, {'error': {'status': 401, 'message': 'The access token expired'}})
+        return False
+
+    def _scripted(self, path: str) -> bool:
+        responses = self.server.scripted.get(path)
+        if not responses:
+            return False
+        status, headers = responses.pop(0)
+        self._reply(status, {'error': {'status': status, 'message': 'Scripted'}} if status >= 400 else None, headers)
+        return True
+
+    def _device_missing(self, device_id: str) -> bool:
+        if device_id is None:
+            self._reply(404, {'error': {'status': 404, 'message': 'Player command failed: No active device found', 'reason': 'NO_ACTIVE_DEVICE'}})
+            return True
+        if device_id not in self.server.devices:
+            self._reply(404, {'error': {'status': 404, 'message': 'Device not found'}})
+            return True
+        return False
+
+    def do_PUT(self):
+        body = self._read_body()
+        self.server.requests += 1
+        time.sleep(self.server.response_delay)
+        if not self._authorized():
+            return
+        path, _, query = self.path.partition('?')
+        params = parse_qs(query)
+        self.server.log.append((path, params))
+        if self._scripted(path):
+            return
+        player = self.server.player
+        if path == '/v1/me/player':  # Transfer playback
+            device_id = (json.loads(body or b'{}').get('device_ids') or [None])[0]
+            if not self._device_missing(device_id):
+                player['device_id'] = device_id
+                self._reply(204)
+            return
+        if path not in ('/v1/me/player/play', '/v1/me/player/pause', '/v1/me/player/volume'):
+            self._reply(404, {'error': {'status': 404, 'message': 'Not found'}})
+            return
+        # Commands go to the active device unless one is given, which then becomes active
+        device_id = params['device_id'][0] if 'device_id' in params else player['device_id']
+        if self._device_missing(device_id):
+            return
+        player['device_id'] = device_id
+        if path == '/v1/me/player/play':
+            player['is_playing'] = True
+        elif path == '/v1/me/player/pause':
+            player['is_playing'] = False
+        else:
+            player['volume_percent'] = int(params['volume_percent'][0])
+        self._reply(204)
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.response_delay)
+        if not self._authorized():
+            return
+        path = self.path.split('?')[0]
+        if self._scripted(path):
+            return
+        player = self.server.player
+        if path == '/v1/me/player':
+            if player['device_id'] is None:
+                self._reply(204)
+                return
+            self._reply(200, {'is_playing': player['is_playing'], 'device': self._device(player['device_id'])})
+        elif path == '/v1/me/player/devices':
+            self.server.device_reads += 1
+            self._reply(200, {'devices': [self._device(device_id) for device_id in self.server.devices]})
+        else:
+            self._reply(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+    def _device(self, device_id: str) -> dict:
+        return {'id': device_id, 'name': self.server.devices[device_id], 'type': 'Computer', 'is_active': device_id == self.server.player['device_id'],
+                'is_private_session': False, 'is_restricted': False, 'volume_percent': self.server.player['volume_percent']}
+
+    def do_POST(self):
+        self._read_body()
+        self.server.requests += 1
+        time.sleep(self.server.response_delay)
+        if self._scripted(self.path):
+            return
+        if self.path == '/api/token':
+            self.server.tokens_issued += 1
+            access_token = f'mock-access-token-{self.server.tokens_issued}'
+            self.server.access_tokens.add(access_token)
+            self._reply(200, {
+                'access_token': access_token,
+                'token_type': 'Bearer',
+                'scope': ' '.join(self.server.scopes),
+                'expires_in': self.server.expires_in,
+                'refresh_token': 'mock-refresh-token',
+            })
+        else:
+            self._reply(404, {'error': {'status': 404, 'message': 'Not found'}})
+
+
+class MockSpotifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, connect_delay: float = 0.1, response_delay: float = 0.0, scopes=('user-modify-playback-state', 'user-read-playback-state'),
+                 expires_in: int = 3600):
+        """
+        Serve the endpoints SpotifyClient uses on localhost
+        :param port: The port to listen on. 0 picks a free port
+        :param connect_delay: Added once per new connection, standing in for the TCP and TLS handshakes (in seconds)
+        :param response_delay: Added to every request (in seconds)
+        :param scopes: The scopes granted by the token endpoint
+        :param expires_in: The lifetime reported for issued access tokens (in seconds). Tokens only stop working through expire_tokens()
+        """
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.connect_delay: float = connect_delay
+        self.response_delay: float = response_delay
+        self.scopes: tuple = tuple(scopes)
+        self.expires_in: int = expires_in
+        self.access_tokens: set = set()
+        self.tokens_issued: int = 0
+        self.devices: dict = {'mock-device': 'Mock device'}  # The name of every available device, by ID
+        self.player: dict = {'is_playing': False, 'volume_percent': 100, 'device_id': 'mock-device'}  # device_id is the active device
+        self.device_reads: int = 0
+        self.connections: int = 0
+        self.requests: int = 0
+        self.log: list = []  # (path, query params) of every PUT
+        self.scripted: dict = {}
+        self._thread: threading.Thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def script(self, path: str, *responses: tuple):
+        """
+        Answer the next requests to a path with canned responses instead of handling them
+        :param path: The path, e.g. /v1/me/player/volume or /api/token
+        :param responses: (status, headers) tuples, used in order
+        """
+        self.scripted.setdefault(path, []).extend(responses)
+
+    def expire_tokens(self):
+        """
+        Reject every access token issued so far
+        """
+        self.access_tokens.clear()
+
+    def start(self):
+        """
+        Serve on a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='mock-spotify', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _compare(calls: int, connect_delay: float):
+    import requests
+
+    from lib.spotify_lib import SpotifyClient, TokenBucket
+
+    with tempfile.TemporaryDirectory() as directory, MockSpotifyServer(connect_delay=connect_delay) as server:
+        server.start()
+
+        client = SpotifyClient('mock-id', 'mock-secret', ['user-modify-playback-state'], api_url=f'{server.url}/v1', accounts_url=server.url,
+                               token_path=os.path.join(directory, 'refresh.token'))
+        client.refresh_token = 'mock-refresh-token'
+        client.refresh()
+
+        start = time.perf_counter()
+        for _ in range(calls):
+            requests.put(f'{server.url}/v1/me/player/play', headers={'Authorization': f'Bearer {client.access_token}', 'Connection': 'close'})
+        fresh = (time.perf_counter() - start) / calls
+
+        client.prewarm()
+        client.scheduler.bucket = TokenBucket(rate=1e9, capacity=calls)  # Time the connections, not the client-side rate limit
+        start = time.perf_counter()
+        for i in range(calls):
+            # Alternate, so the player state cache never skips a call
+            if i % 2 == 0:
+                client.play().result()
+            else:
+                client.pause().result()
+        pooled = (time.perf_counter() - start) / calls
+        client.close()
+        server.stop()
+
+    print(f'Fresh connection per call: {fresh * 1000:.1f} ms/call')
+    print(f'Pooled keep-alive session: {pooled * 1000:.1f} ms/call')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare fresh connections against the pooled SpotifyClient session on a local mock API')
+    parser.add_argument('-n', '--calls', type=int, default=20, help='Number of calls to time for each variant')
+    parser.add_argument('--connect_delay', type=float, default=0.1, help='Simulated handshake cost per new connection, in seconds')
+    args = parser.parse_args()
+    _compare(args.calls, args.connect_delay)
@@ -0,0 +1,185 @@
+import mmap
+import struct
+import time
+from typing import List, Tuple
+
+import numpy as np
+
+from lib.frame_source import BYTES_PER_PIXEL, Frame, FrameLayout, FrameSource, Region
+
+# File format (little-endian):
+#   header:  magic (8 bytes), region count (uint32), record size (uint32), display width and height (uint32, 0 if unknown),
+#            then (left, top, width, height) as uint32 per region
+#   records: timestamp (float64), then the frame buffer (layout.size bytes)
+# Every record has the same size, so record i starts at header_size + i * record_size
+_MAGIC = b'FNSREC2\0'
+_HEADER = struct.Struct('<8sIIII')
+_REGION = struct.Struct('<IIII')
+_TIMESTAMP = struct.Struct('<d')
+
+
+class RecordingError(Exception):
+    pass
+
+
+def _copy_plan(source: FrameLayout, target: FrameLayout) -> List[Tuple[int, int, int]]:
+    """
+    Work out how to copy the rows of every target region out of a source frame
+    :param source: The layout of the source frames
+    :param target: The layout to copy into. Each row of each region must lie in a single source region
+    :return: (source offset, target offset, length) byte ranges
+    """
+    plan = []
+    for region, offset in zip(target.regions, target.offsets):
+        for row in range(region.height):
+            start = source.index(region.left, region.top + row)
+            end = source.index(region.left + region.width - 1, region.top + row) + BYTES_PER_PIXEL
+            length = region.width * BYTES_PER_PIXEL
+            if end - start != length:
+                raise ValueError(f'{region} is not contiguous in the source layout')
+            plan.append((start, (offset + row * region.width) * BYTES_PER_PIXEL, length))
+    return plan
+
+
+class FrameRecorder:
+    def __init__(self, path: str, layout: FrameLayout):
+        """
+        Append frames to a recording. Frames of another layout are cut down to this layout, so a recording
+        can hold only the sampled pixels of full captures
+        :param path: The path of the recording. An existing file is overwritten
+        :param layout: The layout of the recorded frames
+        """
+        self.path: str = path
+        self.layout: FrameLayout = layout
+        self.frames: int = 0
+        self._plans: dict = {}
+        self._scratch: bytearray = bytearray(layout.size)
+        self._file = open(path, 'wb')
+        width, height = layout.display or (0, 0)
+        self._file.write(_HEADER.pack(_MAGIC, len(layout.regions), _TIMESTAMP.size + layout.size, width, height))
+        for region in layout.regions:
+            self._file.write(_REGION.pack(*region))
+
+    def write(self, frame: Frame):
+        """
+        Append a frame
+        :param frame: The frame to record
+        """
+        self._file.write(_TIMESTAMP.pack(frame.timestamp))
+        if frame.layout is self.layout:
+            self._file.write(frame.buffer)
+        else:
+            plan = self._plans.get(frame.layout)
+            if plan is None:
+                plan = self._plans[frame.layout] = _copy_plan(frame.layout, self.layout)
+            source = memoryview(frame.buffer)
+            for start, dest, length in plan:
+                self._scratch[dest:dest + length] = source[start:start + length]
+            self._file.write(self._scratch)
+        self.frames += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ReplayFrameSource(FrameSource):
+    def __init__(self, path: str, speed: float = 0.0, loop: bool = False):
+        """
+        Replay a recording through a memory map. Frames are views into the map, so no pixel data is copied
+        unless grab() is given a frame to fill
+        :param path: The path of the recording
+        :param speed: 1.0 replays at wall-clock speed, 2.0 twice as fast, and so on. 0 replays as fast as possible
+        :param loop: Start over at the end of the recording instead of raising EOFError
+        :raises RecordingError: If the file is not a recording
+        """
+        self.path: str = path
+        self.speed: float = speed
+        self.loop: bool = loop
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # An empty file cannot be mapped
+            self._file.close()
+            raise RecordingError(f'"{path}" is not a recording')
+        if self._map[:len(_MAGIC)] != _MAGIC:
+            self.close()
+            raise RecordingError(f'"{path}" is not a recording')
+        _, region_count, self.record_size, width, height = _HEADER.unpack_from(self._map, 0)
+        regions = [Region(*_REGION.unpack_from(self._map, _HEADER.size + i * _REGION.size)) for i in range(region_count)]
+        super().__init__(FrameLayout(regions, (width, height) if width and height else None))
+        self.header_size: int = _HEADER.size + region_count * _REGION.size
+        self.frames: int = (len(self._map) - self.header_size) // self.record_size
+        self.position: int = 0
+
+        self._view = memoryview(self._map)
+        self._frame = Frame(self.layout, self._view[0:0])
+        self._first_timestamp: float = None
+        self._started_at: float = None
+
+    def __len__(self) -> int:
+        return self.frames
+
+    def timestamp(self, index: int) -> float:
+        return _TIMESTAMP.unpack_from(self._map, self.header_size + index * self.record_size)[0]
+
+    def grab(self, frame: Frame = None) -> Frame:
+        """
+        Return the next recorded frame. Without a frame to fill, the same Frame object is returned every time
+        with its buffer pointing at the next record
+        :raises EOFError: If the end of the recording was reached and loop is not set
+        """
+        if self.position >= self.frames:
+            if not self.loop or self.frames == 0:
+                raise EOFError
+            self.position = 0
+            self._first_timestamp = None
+
+        start = self.header_size + self.position * self.record_size
+        timestamp = self.timestamp(self.position)
+        self.position += 1
+
+        if self.speed > 0:
+            if self._first_timestamp is None:
+                self._first_timestamp, self._started_at = timestamp, time.monotonic()
+            delay = (timestamp - self._first_timestamp) / self.speed - (time.monotonic() - self._started_at)
+            if delay > 0:
+                time.sleep(delay)
+
+        pixels = self._view[start + _TIMESTAMP.size:start + self.record_size]
+        if frame is None:
+            frame = self._frame
+            frame.buffer = pixels
+        else:
+            frame.buffer[:] = pixels
+        frame.timestamp = timestamp
+        return frame
+
+    def records(self) -> np.ndarray:
+        """
+        View every record at once, e.g. to classify a whole recording in one call
+        :return: A structured array with the fields 'timestamp' (frames,) and 'pixels' (frames, pixels, 4). No data is copied
+        """
+        dtype = np.dtype([('timestamp', '<f8'), ('pixels', np.uint8, (self.layout.pixels, BYTES_PER_PIXEL))])
+        return np.frombuffer(self._map, dtype=dtype, count=self.frames, offset=self.header_size)
+
+    def close(self):
+        """
+        Unmap the recording. Frames and arrays handed out by this source must not be used afterwards
+        """
+        if getattr(self, '_frame', None) is not None:
+            self._frame.buffer = b''
+            self._view.release()
+        try:
+            self._map.close()
+        except BufferError:  # Views are still alive elsewhere. The map is closed once they are collected
+            pass
+        self._file.close()
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import socket
+import struct
+import time
+from typing import Callable, Collection, Dict, List, Tuple
+
+import numpy as np
+
+import lib.fortnite_lib as fl
+from lib import metrics
+from lib.fortnite_lib import GameState
+from lib.frame_source import BYTES_PER_PIXEL, FrameSource
+
+# Protocol (little-endian), from agent to server:
+#   hello:   magic (8 bytes), display width and height (uint32), pixel count (uint32), rig name and user name lengths (uint16),
+#            then the rig name and the user name (UTF-8)
+#   samples: timestamp (float64), then the checked pixels of a frame in the order of fl.sample() (pixel count * 4 bytes, BGRX)
+# The server answers the hello with one status byte, and closes the connection unless it is HELLO_OK
+_MAGIC = b'FNSRIG1\0'
+_HELLO = struct.Struct('<8sIIIHH')
+_TIMESTAMP = struct.Struct('<d')
+
+HELLO_OK = 0
+HELLO_UNKNOWN_USER = 1
+HELLO_BAD_LAYOUT = 2
+HELLO_BAD_DISPLAY = 3
+
+# How many disconnected rigs the state is kept for, so that a reconnect is not a transition
+_REMEMBERED_RIGS = 256
+
+_BATCH_SECONDS = metrics.Histogram('rigs_batch_seconds', 'Time spent classifying the newest frame of every rig in one pass')
+_FRAMES = metrics.Counter('rigs_frames_total', 'Frames received from rigs', ['rig'])
+
+
+class RigError(Exception):
+    pass
+
+
+class Rig:
+    def __init__(self, name: str, user: str, display: Tuple[int, int], pixels: int):
+        """
+        A gaming rig connected to the server, and the newest frame it sent
+        :param name: The name of the rig. Unique among connected rigs
+        :param user: The Spotify user whose playback the rig controls
+        :param display: The size of the rig's display
+        :param pixels: How many pixels each sample holds
+        """
+        self.name: str = name
+        self.user: str = user
+        self.display: Tuple[int, int] = display
+        self.pixels: int = pixels
+        self.sample: bytes = None
+        self.timestamp: float = None  # When the newest sample was captured, as a time.time() timestamp of the rig
+        self.fresh: bool = False  # Whether the newest sample has not been classified yet
+        self.state: GameState = None
+        self.frames: int = 0
+        self.connected: bool = True
+
+
+class RigServer:
+    def __init__(self, on_transition: Callable[[Rig, GameState, GameState], None], users: Collection[str] = None,
+                 interval: float = 0.05):
+        """
+        Receives sampled frames from many rigs and classifies the newest frame of every rig in one batched pass
+        :param on_transition: Called with the rig, the previous state and the new state whenever a rig changes state.
+                              The first state of a rig is not a transition
+        :param users: The users rigs may control. Any user is accepted if this is not set
+        :param interval: How long to wait (in seconds) between classification passes
+        """
+        self.on_transition: Callable[[Rig, GameState, GameState], None] = on_transition
+        self.users: frozenset = frozenset(users) if users is not None else None
+        self.interval: float = interval
+        self.rigs: Dict[str, Rig] = {}
+        self._disconnected: Dict[str, Rig] = {}  # Recently disconnected rigs, oldest first
+        self.batches: int = 0
+        self.classified: int = 0
+        self._server: asyncio.AbstractServer = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> Tuple[str, int]:
+        """
+        Start accepting rigs
+        :param host: The address to listen on. Only this computer can connect by default
+        :param port: The port to listen on. 0 picks a free port
+        :return: The address the server listens on
+        :raises OSError: If the port is not available
+        """
+        self._server = await asyncio.start_server(self._handle, host, port)
+        address = self._server.sockets[0].getsockname()[:2]
+        logging.info(f'Rigs: Listening on {address[0]}:{address[1]}')
+        return address
+
+    async def run(self):
+        """
+        Classify the newest frames of every rig until cancelled
+        """
+        try:
+            while True:
+                self.classify_pending()
+                await asyncio.sleep(self.interval)
+        finally:
+            if self._server is not None:
+                self._server.close()
+
+    def classify_pending(self) -> int:
+        """
+        Classify every rig that sent a frame since the last pass. Rigs with the same display size are classified together
+        :return: How many rigs were classified
+        """
+        start = time.perf_counter()
+        groups: Dict[Tuple[int, int], List[Rig]] = {}
+        for rig in self.rigs.values():
+            if rig.fresh:
+                rig.fresh = False
+                groups.setdefault(rig.display, []).append(rig)
+        if not groups:
+            return 0
+
+        count = 0
+        for display, rigs in groups.items():
+            samples = np.frombuffer(b''.join(rig.sample for rig in rigs), dtype=np.uint8)
+            states = fl.classify(samples.reshape(len(rigs), rigs[0].pixels, BYTES_PER_PIXEL), fl.display_index(*display).layout)
+            for rig, state in zip(rigs, states):
+                previous, rig.state = rig.state, state
+                if previous is not None and state != previous:
+                    logging.info(f'Rigs: "{rig.name}" changed state: {state}')
+                    try:
+                        self.on_transition(rig, previous, state)
+                    except Exception as e:
+                        logging.error(f'Rigs: Unable to handle the transition of "{rig.name}"')
+                        logging.debug(repr(e))
+            count += len(rigs)
+
+        self.batches += 1
+        self.classified += count
+        _BATCH_SECONDS.observe(time.perf_counter() - start)
+        return count
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        rig = None
+        try:
+            magic, width, height, pixels, name_length, user_length = _HELLO.unpack(await reader.readexactly(_HELLO.size))
+            name = (await reader.readexactly(name_length)).decode()
+            user = (await reader.readexactly(user_length)).decode()
+            if magic != _MAGIC:
+                raise RigError('Not a rig agent')
+
+            if self.users is not None and user not in self.users:
+                logging.warning(f'Rigs: "{name}" asked for unknown user "{user}"')
+                writer.write(bytes((HELLO_UNKNOWN_USER,)))
+                return
+            if not fl.valid_display(width, height):
+                logging.warning(f'Rigs: "{name}" has an unsupported display size ({width}x{height})')
+                writer.write(bytes((HELLO_BAD_DISPLAY,)))
+                return
+            if pixels != len(fl.display_index(width, height).sample_layout.regions) or not pixels:
+                logging.warning(f'Rigs: "{name}" samples {pixels} pixels. Is it running another version?')
+                writer.write(bytes((HELLO_BAD_LAYOUT,)))
+                return
+            writer.write(bytes((HELLO_OK,)))
+
+            previous = self.rigs.get(name) or self._disconnected.pop(name, None)
+            rig = self.rigs[name] = Rig(name, user, (width, height), pixels)
+            if previous is not None and previous.display == rig.display:
+                rig.state = previous.state  # A reconnect is not a transition
+            logging.info(f'Rigs: "{name}" connected for "{user}" ({width}x{height})')
+
+            record_size = _TIMESTAMP.size + pixels * BYTES_PER_PIXEL
+            while True:
+                record = await reader.readexactly(record_size)
+                rig.timestamp = _TIMESTAMP.unpack_from(record)[0]
+                rig.sample = record[_TIMESTAMP.size:]
+                rig.fresh = True
+                rig.frames += 1
+                _FRAMES.inc(name)
+        except (asyncio.IncompleteReadError, ConnectionError, RigError, UnicodeDecodeError) as e:
+            logging.debug(f'Rigs: Connection closed: {e!r}')
+        finally:
+            if rig is not None:
+                rig.connected = False
+                if self.rigs.get(rig.name) is rig:
+                    del self.rigs[rig.name]
+                    if len(self._disconnected) >= _REMEMBERED_RIGS:
+                        self._disconnected.pop(next(iter(self._disconnected)))
+                    self._disconnected[rig.name] = rig
+                logging.info(f'Rigs: "{rig.name}" disconnected')
+            writer.close()
+
+
+class RigAgent:
+    def __init__(self, address: Tuple[str, int], name: str, user: str, source: FrameSource):
+        """
+        Sends the checked pixels of every captured frame to a rig server. The agent does not classify or talk to Spotify
+        :param address: The (host, port) of the server
+        :param name: The name of this rig
+        :param user: The Spotify user whose playback this rig controls
+        :param source: Where frames are captured from. Its layout must have a display size
+        """
+        self.address: Tuple[str, int] = address
+        self.name: str = name
+        self.user: str = user
+        self.source: FrameSource = source
+        self.frames: int = 0
+        self._socket: socket.socket = None
+
+    def connect(self):
+        """
+        :raises OSError: If the server could not be reached
+        :raises RigError: If the server refused the rig
+        """
+        display = self.source.layout.display or fl.REFERENCE_DISPLAY
+        pixels = len(fl.display_index(*display).sample_layout.regions)
+        name, user = self.name.encode(), self.user.encode()
+        self._socket = socket.create_connection(self.address)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket.sendall(_HELLO.pack(_MAGIC, display[0], display[1], pixels, len(name), len(user)) + name + user)
+        status = self._socket.recv(1)
+        if status != bytes((HELLO_OK,)):
+            self.close()
+            raise RigError(f'The server refused the rig (status {status[0] if status else None})')
+
+    def send(self, frame=None):
+        """
+        Capture a frame, unless one is given, and send its checked pixels
+        :raises EOFError: If the frame source has no more frames
+        :raises OSError: If the connection was lost
+        """
+        if frame is None:
+            frame = self.source.grab()
+        sample = fl.sample([frame])
+        self._socket.sendall(_TIMESTAMP.pack(frame.timestamp or time.time()) + sample.tobytes())
+        self.frames += 1
+
+    def run(self, interval: float = 0.25):
+        """
+        Send a frame every interval until the frame source runs out
+        :param interval: How long to wait (in seconds) between frames
+        :raises OSError: If the connection was lost
+        """
+        try:
+            while True:
+                start = time.monotonic()
+                self.send()
+                time.sleep(max(0.0, interval - (time.monotonic() - start)))
+        except EOFError:
+            logging.info('Rigs: Reached the end of the frames')
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
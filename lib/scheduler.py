@@ -0,0 +1,100 @@
+import time
+from typing import Any, Collection
+
+
+class PollScheduler:
+    def __init__(self, hot_states: Collection[Any], latency_budget: float = 0.25, idle_interval: float = 2.0,
+                 cpu_budget: float = 0.02, settle_time: float = 10.0, backoff: float = 1.5):
+        """
+        Decides how long to wait between polls. States that are expected to change soon, and any state that was just
+        entered, are polled at the latency budget. Once a cold state has been stable for settle_time, the interval grows
+        by backoff each poll until it reaches idle_interval
+        :param hot_states: States that are expected to transition soon
+        :param latency_budget: The longest allowed interval (in seconds) while a transition is expected
+        :param idle_interval: The longest allowed interval (in seconds) during long stable states
+        :param cpu_budget: The fraction of one core polling may use. Intervals are stretched to stay under it
+        :param settle_time: How long (in seconds) a cold state must be stable before backing off
+        :param backoff: The factor the interval grows by each poll while backing off
+        """
+        self.hot_states: frozenset = frozenset(hot_states)
+        self.latency_budget: float = latency_budget
+        self.idle_interval: float = max(idle_interval, latency_budget)
+        self.cpu_budget: float = cpu_budget
+        self.settle_time: float = settle_time
+        self.backoff: float = backoff
+
+        self.interval: float = latency_budget
+        self.poll_cost: float = 0.0  # Moving average of how long a poll takes
+        self._state: Any = None
+        self._state_since: float = None
+        self._last_poll: float = None
+
+        self.transitions: int = 0
+        self.last_latency: float = None  # The worst-case detection latency of the newest transition
+        self.total_latency: float = 0.0
+        self.max_latency: float = 0.0
+
+    def configure(self, latency_budget: float = 0.25, idle_interval: float = 2.0, cpu_budget: float = 0.02):
+        """
+        Change the polling settings. Takes effect from the next poll
+        :param latency_budget: The longest allowed interval (in seconds) while a transition is expected
+        :param idle_interval: The longest allowed interval (in seconds) during long stable states
+        :param cpu_budget: The fraction of one core polling may use
+        """
+        self.latency_budget = latency_budget
+        self.idle_interval = max(idle_interval, latency_budget)
+        self.cpu_budget = cpu_budget
+        self.interval = min(max(self.interval, latency_budget), self.idle_interval)
+
+    def poll_finished(self, state: Any, duration: float, now: float = None) -> float:
+        """
+        Record the result of a poll
+        :param state: The state the poll detected
+        :param duration: How long the poll took (in seconds)
+        :param now: The monotonic time the poll started. Defaults to now
+        :return: How long to wait (in seconds) before the next poll
+        """
+        if now is None:
+            now = time.monotonic() - duration
+        self.poll_cost = duration if self.poll_cost == 0.0 else 0.8 * self.poll_cost + 0.2 * duration
+
+        if state != self._state:
+            if self._state is not None and self._last_poll is not None:
+                # The transition happened at some point after the previous poll started
+                latency = now - self._last_poll + duration
+                self.transitions += 1
+                self.last_latency = latency
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            self._state = state
+            self._state_since = now
+            self.interval = self.latency_budget
+        elif state in self.hot_states or now - self._state_since < self.settle_time:
+            self.interval = self.latency_budget
+        else:
+            self.interval = min(self.interval * self.backoff, self.idle_interval)
+        self._last_poll = now
+
+        interval = self.interval
+        if self.cpu_budget > 0:
+            interval = max(interval, self.poll_cost / self.cpu_budget)
+        return max(interval - duration, 0.0)
+
+    @property
+    def mean_latency(self) -> float:
+        """
+        :return: The average worst-case detection latency of the transitions seen so far (in seconds)
+        """
+        return self.total_latency / self.transitions if self.transitions else 0.0
+
+    def report(self) -> dict:
+        """
+        :return: The detection latency achieved so far and the current polling parameters
+        """
+        return {
+            'transitions': self.transitions,
+            'mean_latency': round(self.mean_latency, 4),
+            'max_latency': round(self.max_latency, 4),
+            'interval': round(self.interval, 4),
+            'poll_cost': round(self.poll_cost, 6),
+        }
@@ -1,12 +1,21 @@
+import functools
 import logging
+import os
+import random
+import threading
 import time
-import webbrowser
 import json
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Tuple
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
+from lib import metrics
+
 
 class InvalidTokenError(Exception):
     pass
@@ -24,80 +33,567 @@ class RequestFailedError(Exception):
     pass
 
 
+_HTTP_SECONDS = metrics.Histogram('spotify_http_request_seconds', 'Time until Spotify responded to a request',
+                                  ['method', 'endpoint', 'status'])
+_REQUEST_ERRORS = metrics.Counter('spotify_request_errors_total', 'RequestFailedError raised, by error', ['error'])
+_RETRIES = metrics.Counter('spotify_request_retries_total', 'Requests sent again, by reason', ['reason'])
+_COALESCED = metrics.Counter('spotify_requests_coalesced_total', 'Requests merged into a newer request to the same endpoint')
+_CACHE_LOOKUPS = metrics.Counter('spotify_player_cache_lookups_total', 'Lookups in the playback state cache. A hit skips a request',
+                                 ['field', 'result'])
+
+
+def _observe_response(res: requests.Response, *args, **kwargs):
+    """
+    Response hook that times every HTTP call of a session. Only installed while metrics are enabled
+    """
+    _HTTP_SECONDS.observe(res.elapsed.total_seconds(), res.request.method, urlsplit(res.request.url).path, res.status_code)
+
+
+def _request_failed(error: str) -> RequestFailedError:
+    _REQUEST_ERRORS.inc(error)
+    return RequestFailedError(error)
+
+
+class PlayerStateCache:
+    def __init__(self, ttl: float = 30.0):
+        """
+        What is known about the playback state, learned from our own requests and from syncs with Spotify.
+        Knowledge older than the TTL is not trusted, as the user may have changed something in the Spotify app.
+        Each field has its own age, so learning one field never makes another look fresh
+        :param ttl: How long (in seconds) a known value is trusted
+        """
+        self.ttl: float = ttl
+        self.is_playing: bool = None
+        self.volume: int = None
+        self.updated_at: Dict[str, float] = {}  # When each field was learned, as a time.monotonic() timestamp
+
+    def update(self, **fields):
+        """
+        Record the playback state
+        :param fields: Any of is_playing and volume
+        """
+        now = time.monotonic()
+        for name, value in fields.items():
+            setattr(self, name, value)
+            self.updated_at[name] = now
+
+    def invalidate(self):
+        """
+        Forget the playback state, e.g. after a request failed
+        """
+        self.is_playing = None
+        self.volume = None
+        self.updated_at.clear()
+
+    def lookup(self, name: str, value) -> bool:
+        """
+        Check whether a field is known to have a value already, counting a hit or a miss
+        :param name: The name of the field
+        :param value: The value a request would set
+        :return: True if the request can be skipped, false otherwise
+        """
+        updated_at = self.updated_at.get(name)
+        if updated_at is not None and time.monotonic() - updated_at < self.ttl and getattr(self, name) == value:
+            _CACHE_LOOKUPS.inc(name, 'hit')
+            return True
+        _CACHE_LOOKUPS.inc(name, 'miss')
+        return False
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        """
+        Limits how many requests are sent. Bursts of up to capacity requests go out at once, then rate per second
+        :param rate: How many tokens are added per second
+        :param capacity: The most tokens the bucket holds
+        """
+        self.rate: float = rate
+        self.capacity: int = capacity
+        self.tokens: float = capacity
+        self._updated: float = time.monotonic()
+
+    def reserve(self) -> float:
+        """
+        Take a token, going into debt if there is none
+        :return: How long (in seconds) to wait before using the token
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class _Request:
+    __slots__ = ('method', 'path', 'params', 'parse', 'send', 'futures')
+
+    def __init__(self, method: str, path: str, params: dict, parse: Callable, send: Callable, future: Future):
+        self.method: str = method
+        self.path: str = path
+        self.params: dict = params
+        self.parse: Callable = parse
+        self.send: Callable = send
+        self.futures: List[Future] = [future]
+
+
+class RequestScheduler:
+    def __init__(self, send: Callable[[str, str, dict], requests.Response], closed: threading.Event, rate: float = 5.0,
+                 burst: int = 10, max_retries: int = 5, base_delay: float = 0.5, max_delay: float = 8.0, max_retry_after: float = 60.0):
+        """
+        Sends requests one at a time on a worker thread, within a client-side rate limit.
+        A request that is still waiting is replaced by a newer request to the same endpoint, and both callers get the newer result.
+        Rate limiting (429) waits as long as Spotify asks in Retry-After. Unavailable devices (202), server errors and
+        network errors are retried after an exponential backoff with full jitter
+        :param send: Sends a request given the method, the path and the query params
+        :param closed: Stops the worker once set
+        :param rate: The sustained number of requests per second
+        :param burst: How many requests may be sent at once after a quiet period
+        :param max_retries: How many times a request is sent again before giving up
+        :param base_delay: The backoff (in seconds) before the first retry. It doubles with each retry
+        :param max_delay: The longest backoff (in seconds)
+        :param max_retry_after: The longest wait (in seconds) honored from Retry-After
+        """
+        self.send: Callable[[str, str, dict], requests.Response] = send
+        self.bucket: TokenBucket = TokenBucket(rate, burst)
+        self.max_retries: int = max_retries
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.max_retry_after: float = max_retry_after
+        self._closed: threading.Event = closed
+        self._pending: 'OrderedDict[Tuple[str, str], _Request]' = OrderedDict()
+        self._condition: threading.Condition = threading.Condition()
+        self._thread: threading.Thread = None
+
+    def submit(self, method: str, path: str, parse: Callable[[requests.Response], Any], params: dict = None,
+               send: Callable[[str, str, dict], requests.Response] = None) -> Future:
+        """
+        Queue a request without waiting for it
+        :param method: The HTTP method
+        :param path: The path of the request, relative to the API
+        :param parse: Turns the final response into the result of the future, or raises
+        :param params: A dict of query params
+        :param send: Sends this request instead of the scheduler's send function
+        :return: A future of the parsed response. It raises whatever parse or the request raised
+        """
+        future = Future()
+        if self._closed.is_set():
+            future.set_exception(TimeoutError('The client was closed'))
+            return future
+        key = (method, path)
+        with self._condition:
+            request = self._pending.get(key)
+            if request is not None:
+                # Only the newest call matters, e.g. for a burst of volume changes. It is sent after every call that was
+                # queued before it, so play, pause, play never ends paused
+                request.params, request.parse, request.send = params, parse, send
+                request.futures.append(future)
+                self._pending.move_to_end(key)
+                _COALESCED.inc()
+            else:
+                self._pending[key] = _Request(method, path, params, parse, send, future)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name='spotify-requests', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def _work(self):
+        try:
+            while not self._closed.is_set():
+                with self._condition:
+                    while not self._pending:
+                        self._condition.wait(1.0)
+                        if self._closed.is_set():
+                            return
+                    _, request = self._pending.popitem(last=False)
+                futures = [future for future in request.futures if future.set_running_or_notify_cancel()]
+                if not futures:
+                    continue
+                try:
+                    result, error = request.parse(self.execute(request.method, request.path, request.params, request.send)), None
+                except Exception as e:
+                    result, error = None, e
+                for future in futures:
+                    if error is not None:
+                        future.set_exception(error)
+                    else:
+                        future.set_result(result)
+        finally:
+            with self._condition:
+                for request in self._pending.values():
+                    for future in request.futures:
+                        if future.set_running_or_notify_cancel():
+                            future.set_exception(TimeoutError('The client was closed'))
+                self._pending.clear()
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def execute(self, method: str, path: str, params: dict, send: Callable[[str, str, dict], requests.Response] = None) -> requests.Response:
+        """
+        Send a request on the calling thread, within the rate limit and retrying as long as it makes sense.
+        Queued requests are sent this way. Send functions call it directly for the requests they depend on,
+        as submitting from the worker thread would wait on itself
+        :param method: The HTTP method
+        :param path: The path of the request, relative to the API
+        :param params: A dict of query params
+        :param send: Sends the request instead of the scheduler's send function
+        :return: The final response
+        :raises TimeoutError: If Spotify did not respond in time
+        :raises requests.RequestException: If Spotify could not be reached
+        """
+        send = send or self.send
+        attempt = 0
+        while True:
+            wait = self.bucket.reserve()
+            if wait > 0 and self._closed.wait(wait):
+                raise TimeoutError('The client was closed')
+            try:
+                res = send(method, path, params)
+            except requests.RequestException as e:
+                if attempt >= self.max_retries:
+                    if isinstance(e, requests.Timeout):
+                        logging.error('Spotify: request timed out')
+                        logging.debug(e)
+                        raise TimeoutError from e
+                    raise
+                reason, delay = 'network', self._backoff(attempt)
+            else:
+                if res.status_code == 429 and attempt < self.max_retries:
+                    reason, delay = 'rate_limited', self._retry_after(res, attempt)
+                elif res.status_code == 202 and attempt < self.max_retries:
+                    reason, delay = 'device_unavailable', self._backoff(attempt)
+                elif res.status_code >= 500 and attempt < self.max_retries:
+                    reason, delay = 'server_error', self._backoff(attempt)
+                else:
+                    return res
+            attempt += 1
+            _RETRIES.inc(reason)
+            logging.warning(f'Spotify: {method} {path} failed ({reason}). Trying again in {delay:.1f} seconds')
+            if self._closed.wait(delay):
+                raise TimeoutError('The client was closed')
+
+    def _retry_after(self, res: requests.Response, attempt: int) -> float:
+        try:
+            return min(float(res.headers['Retry-After']), self.max_retry_after)
+        except (KeyError, ValueError):
+            return self._backoff(attempt)
+
+
+def _completed(result: Any = None) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
 class SpotifyClient:
-    def __init__(self, client_id: str, client_secret: str, scopes: List[str]):
+    def __init__(self, client_id: str, client_secret: str, scopes: List[str], pool_size: int = 4,
+                 timeout: Tuple[float, float] = (3.05, 10.0), session: requests.Session = None,
+                 api_url: str = 'https://api.spotify.com/v1', accounts_url: str = 'https://accounts.spotify.com',
+                 token_path: str = 'refresh.token', preferred_device: str = None):
         """
         A client wrapper for the Spotify Web API. Requires a client ID and client secret.
+        All requests go through one pooled keep-alive session, so only the first request to each host pays for the TCP and TLS handshakes
         :param client_id: The client ID of a valid Spotify application
         :param client_secret: The client secret of a valid Spotify application
         :param scopes: A list of required scopes
+        :param pool_size: The maximum number of connections kept open to each host
+        :param timeout: The (connect, read) timeouts of each request, in seconds
+        :param session: A session to use instead of creating one, e.g. to share a connection pool between clients
+        :param api_url: The base URL of the Web API
+        :param accounts_url: The base URL of the accounts service
+        :param token_path: Where the refresh token is kept. The access token is cached in access.token next to it
+        :param preferred_device: The name or ID of the device to transfer playback to when no device is active.
+                                 Defaults to the first available device
         """
         self.authenticated: bool = False
         self.access_token: str = None
         self.refresh_token: str = None
+        self.expires_at: float = None  # When the access token expires, as a time.time() timestamp
         self.scopes: List[str] = scopes
         self.client_id: str = client_id
         self.client_secret: str = client_secret
+        self.timeout: Tuple[float, float] = timeout
+        self.api_url: str = api_url
+        self.accounts_url: str = accounts_url
+        self.token_path: str = token_path
+        self.access_token_path: str = os.path.join(os.path.dirname(token_path), 'access.token')
+        self.session: requests.Session = session if session is not None else create_session(pool_size)
+        if metrics.enabled() and _observe_response not in self.session.hooks['response']:
+            self.session.hooks['response'].append(_observe_response)
+        self._refresh_lock: threading.Lock = threading.Lock()
+        self._closed: threading.Event = threading.Event()
+        self._refresh_wake: threading.Event = threading.Event()  # Set when the access token stopped working before it expired
+        self._refresh_thread: threading.Thread = None
+        self._sync_thread: threading.Thread = None
+        self.player: PlayerStateCache = PlayerStateCache()
+        self.scheduler: RequestScheduler = RequestScheduler(self._send, self._closed)
+        self.preferred_device: str = preferred_device
+        # The device playback requests are sent to. Only used on the request scheduler's thread
+        self.device_id: str = None
+        self.device_resolutions: int = 0  # How many times the devices were read, for comparing against actions
+
+    def prewarm(self):
+        """
+        Open connections to the API and accounts hosts ahead of the first real request.
+        Failures are only logged, as the real request will open its own connection anyway
+        """
+        for url in (self.api_url, self.accounts_url):
+            try:
+                self.session.head(url, timeout=self.timeout)
+                logging.debug(f'Spotify: Opened connection to {url}')
+            except requests.RequestException as e:
+                logging.debug(f'Spotify: Unable to prewarm connection to {url}')
+                logging.debug(e)
 
-    def play(self):
+    def close(self):
         """
-        Try to play Spotify.
+        Stop every background thread and close every pooled connection
         """
-        try:
-            self._send_common_request('api.spotify.com/v1/me/player/play', success_msg='Started playback', error_msg='Unable to play')
-        except (TimeoutError, RequestFailedError, InvalidTokenError, NotAuthenticatedError):
-            raise
+        self._closed.set()
+        self._refresh_wake.set()
+        self.session.close()
 
-    def pause(self):
+    def start_auto_refresh(self, margin: float = 300.0, retry_delay: float = 30.0):
         """
-        Try to pause Spotify.
+        Refresh the access token on a background thread before it expires, so that actions never wait for a refresh.
+        If Spotify rejects the token early and refreshing it right away fails, it is refreshed again after retry_delay
+        :param margin: How long before expiry (in seconds) to refresh
+        :param retry_delay: How long to wait (in seconds) before trying again after a failed refresh
         """
-        try:
-            self._send_common_request('api.spotify.com/v1/me/player/pause', success_msg='Paused playback', error_msg='Unable to pause')
-        except (TimeoutError, RequestFailedError, InvalidTokenError, NotAuthenticatedError):
-            raise
+        if self._refresh_thread is not None and self._refresh_thread.is_alive():
+            return
+        self._refresh_thread = threading.Thread(target=self._auto_refresh, args=(margin, retry_delay), name='token-refresh', daemon=True)
+        self._refresh_thread.start()
+
+    def _auto_refresh(self, margin: float, retry_delay: float):
+        delay = 0.0
+        while True:
+            if self.expires_at is not None:
+                delay = max(delay, self.expires_at - margin - time.time())
+            if self._refresh_wake.wait(delay):
+                self._refresh_wake.clear()
+                if self._closed.is_set():
+                    return
+                delay = retry_delay  # A refresh after a rejection just failed, and expires_at was moved to now
+                continue
+            try:
+                with self._refresh_lock:
+                    if self.expires_at is None or self.expires_at - margin <= time.time():
+                        self.refresh()
+                delay = 0.0
+            except (InvalidClientError, InvalidTokenError, requests.RequestException) as e:
+                logging.warning(f'Spotify: Background token refresh failed. Trying again in {retry_delay} seconds')
+                logging.debug(e)
+                delay = retry_delay
+
+    def start_player_sync(self, interval: float = 15.0):
+        """
+        Keep the player state cache up to date on a background thread, so that changes made in the Spotify app are noticed
+        :param interval: How long to wait (in seconds) between syncs
+        """
+        if self._sync_thread is not None and self._sync_thread.is_alive():
+            return
+        self._sync_thread = threading.Thread(target=self._auto_sync, args=(interval,), name='player-sync', daemon=True)
+        self._sync_thread.start()
+
+    def _auto_sync(self, interval: float):
+        while not self._closed.wait(interval):
+            if not self.authenticated:
+                continue
+            try:
+                self.sync_player_state()
+            except (RequestFailedError, InvalidTokenError, TimeoutError, requests.RequestException) as e:
+                logging.debug('Spotify: Unable to sync player state')
+                logging.debug(e)
 
-    def set_volume(self, volume: int):
+    def sync_player_state(self):
         """
-        Try to set playback volume
+        Fill the player state cache from the current playback state
+        :raises RequestFailedError: If the playback state could not be read
+        """
+        self.scheduler.submit('GET', '/me/player', parse=self._parse_player_state).result()
+
+    def _parse_player_state(self, res: requests.Response):
+        if res.status_code == 204:  # Nothing is playing on any device
+            self.player.update(is_playing=False, volume=None)
+        elif res.status_code == 200:
+            state = res.json()
+            device = state.get('device') or {}
+            self.player.update(is_playing=state.get('is_playing'), volume=device.get('volume_percent'))
+            if device.get('id') and device.get('is_active') and not device.get('is_restricted'):
+                self.device_id = device['id']  # Follow the user to whichever device they switched to, at no extra cost
+        else:
+            self.player.invalidate()
+            logging.debug(f'{res.status_code}: {res.text}')
+            raise _request_failed('Unable to read playback state')
+
+    def resolve_device(self) -> Future:
+        """
+        Find the device to send playback requests to ahead of the first action. Otherwise this happens on the first action
+        :return: A future of the device ID. It raises RequestFailedError if no device is available. See _use_device
+        """
+        return self.scheduler.submit('GET', '/me/player/devices', parse=self._use_device)
+
+    def _use_device(self, res: requests.Response) -> str:
+        """
+        Choose a device from the devices response: the active device, or else the preferred device (or the first available one)
+        after transferring playback to it
+        :param res: The response of /me/player/devices
+        :return: The ID of the device
+        :raises RequestFailedError: If the devices could not be read, no device is available or the transfer failed
+        """
+        if res.status_code != 200:
+            logging.debug(f'{res.status_code}: {res.text}')
+            raise _request_failed('Unable to read devices')
+        self.device_resolutions += 1
+        # Restricted devices do not accept Web API commands
+        devices = [device for device in res.json().get('devices', []) if device.get('id') and not device.get('is_restricted')]
+        if not devices:
+            logging.error('Spotify: No playback device is available. Open Spotify on any device')
+            raise _request_failed('Playback device not found')
+
+        device = next((device for device in devices if device.get('is_active')), None)
+        if device is None:
+            device = next((device for device in devices if self.preferred_device in (device['id'], device.get('name'))), devices[0])
+            res = self.scheduler.execute('PUT', '/me/player', {}, send=functools.partial(self._send, body={'device_ids': [device['id']]}))
+            if res.status_code not in (200, 202, 204):
+                logging.debug(f'{res.status_code}: {res.text}')
+                raise _request_failed('Unable to transfer playback')
+            logging.info(f'Spotify: Transferred playback to "{device.get("name")}"')
+        else:
+            logging.debug(f'Spotify: Using the active device "{device.get("name")}"')
+        self.device_id = device['id']
+        return self.device_id
+
+    def _send_to_device(self, method: str, path: str, params: dict) -> requests.Response:
+        """
+        Send a playback request to the cached device, finding the device first if there is none. If Spotify reports that the
+        device is gone (404), another device is found and the request is sent once more. Runs on the request scheduler's thread,
+        and every request it makes is rate limited and retried like the others
+        :param method: The HTTP method
+        :param path: The path of the request, relative to api_url
+        :param params: A dict of query params, without the device
+        :return: The response
+        :raises RequestFailedError: If no device is available. See _use_device
+        """
+        if self.device_id is None:
+            self._use_device(self.scheduler.execute('GET', '/me/player/devices', {}))
+        res = self._send(method, path, {**params, 'device_id': self.device_id})
+        if res.status_code == 404:
+            logging.info('Spotify: The playback device is gone. Looking for another one')
+            self.device_id = None
+            self._use_device(self.scheduler.execute('GET', '/me/player/devices', {}))
+            res = self._send(method, path, {**params, 'device_id': self.device_id})  # Retried by the caller like the first attempt
+        return res
+
+    def play(self) -> Future:
+        """
+        Try to play Spotify. Does nothing if Spotify is known to be playing already
+        :return: A future that completes once the request did. See _send_common_request
+        """
+        if self.player.lookup('is_playing', True):
+            logging.debug('Spotify: Already playing')
+            return _completed()
+        return self._remember(self._send_common_request('/me/player/play', success_msg='Started playback', error_msg='Unable to play'),
+                              is_playing=True)
+
+    def pause(self) -> Future:
+        """
+        Try to pause Spotify. Does nothing if Spotify is known to be paused already
+        :return: A future that completes once the request did. See _send_common_request
+        """
+        if self.player.lookup('is_playing', False):
+            logging.debug('Spotify: Already paused')
+            return _completed()
+        return self._remember(self._send_common_request('/me/player/pause', success_msg='Paused playback', error_msg='Unable to pause'),
+                              is_playing=False)
+
+    def set_volume(self, volume: int) -> Future:
+        """
+        Try to set playback volume. Does nothing if the volume is known to be set already
         :param volume: Integer from 0 to 100, inclusive
+        :return: A future that completes once the request did. See _send_common_request
         """
-        try:
-            self._send_common_request('api.spotify.com/v1/me/player/volume',
-                                      params={'volume_percent': volume}, success_msg=f'Set volume to {volume}', error_msg='Unable to set volume')
-        except (TimeoutError, RequestFailedError, InvalidTokenError, NotAuthenticatedError):
-            raise
+        if self.player.lookup('volume', volume):
+            logging.debug(f'Spotify: Volume is already {volume}')
+            return _completed()
+        return self._remember(self._send_common_request('/me/player/volume', params={'volume_percent': volume},
+                                                        success_msg=f'Set volume to {volume}', error_msg='Unable to set volume'),
+                              volume=volume)
+
+    def _remember(self, future: Future, **fields) -> Future:
+        """
+        Record the playback state once a request succeeds, or forget it if the request failed
+        :param future: The future of the request
+        :param fields: The playback state after the request, see PlayerStateCache.update
+        :return: The future
+        """
+        def done(completed: Future):
+            if completed.cancelled() or completed.exception() is not None:
+                self.player.invalidate()
+            else:
+                self.player.update(**fields)
 
-    def _send_common_request(self, base_url, success_msg: str, error_msg: str, params=None):
+        future.add_done_callback(done)
+        return future
+
+    def _send_common_request(self, path: str, success_msg: str, error_msg: str, params=None) -> Future:
         """
-        Wrapper to handle the majority of requests to the Spotify API
-        :param base_url: The base URL of the request
+        Wrapper to handle the majority of requests to the Spotify API. The request is sent by the request scheduler
+        :param path: The path of the request, relative to api_url
         :param success_msg: The message to log on success
         :param error_msg: The message to log on error, as well as the text of the thrown error
         :param params: A dict of query params to send along with the request
+        :return: A future that completes once the request did. Its result() raises:
+                 TimeoutError: If Spotify did not respond in time
+                 See _parse_common_status for more exception information
         :raises NotAuthenticatedError: If the client is not currently authenticated
-        See _parse_common_status for more exception information
         """
         if params is None:
             params = {}
-        if self.authenticated:
-            res = requests.put(f'https://{base_url}', params=params, headers={'Authorization': f'Bearer {self.access_token}'})
-            if res.status_code == 202:
-                for tries in range(5):
-                    logging.warning('Spotify: device temporarily unavailable. Trying again in 5 seconds')
-                    time.sleep(5)
-                    res = requests.put(f'https://{base_url}', headers={'Authorization': f'Bearer {self.access_token}'})
-                    if res.status_code == 204:
-                        break
-                    if tries == 4:
-                        raise TimeoutError
+        if not self.authenticated:
+            raise NotAuthenticatedError
+        return self.scheduler.submit('PUT', path, params=params, send=self._send_to_device,
+                                     parse=lambda res: self._parse_common_status(res, success_msg=success_msg, error_msg=error_msg))
 
+    def _send(self, method: str, path: str, params: dict, body: dict = None) -> requests.Response:
+        """
+        Send a request with the access token, refreshing the token once if Spotify rejects it
+        :param method: The HTTP method
+        :param path: The path of the request, relative to api_url
+        :param params: A dict of query params
+        :param body: A JSON body
+        :return: The response
+        """
+        access_token = self.access_token
+        res = self.session.request(method, f'{self.api_url}{path}', params=params, json=body,
+                                   headers={'Authorization': f'Bearer {access_token}'}, timeout=self.timeout)
+        if res.status_code == 401 and self._refresh_after_rejection(access_token):
+            res = self.session.request(method, f'{self.api_url}{path}', params=params, json=body,
+                                       headers={'Authorization': f'Bearer {self.access_token}'}, timeout=self.timeout)
+        return res
+
+    def _refresh_after_rejection(self, rejected_token: str) -> bool:
+        """
+        Refresh the access token after Spotify rejected it, unless another thread already did.
+        If the refresh fails, the token is treated as expired and the background refresh tries again
+        :param rejected_token: The access token that was rejected
+        :return: True if a new access token is available, false otherwise
+        """
+        with self._refresh_lock:
+            if self.access_token != rejected_token:
+                return True
+            logging.warning('Spotify: access_token was rejected. Refreshing')
             try:
-                self._parse_common_status(res, success_msg=success_msg, error_msg=error_msg)
-            except (RequestFailedError, InvalidTokenError):
-                raise
-        else:
-            raise NotAuthenticatedError
+                self.refresh()
+                return True
+            except (InvalidClientError, InvalidTokenError, requests.RequestException) as e:
+                logging.warning('Spotify: Unable to refresh the rejected access_token')
+                logging.debug(e)
+                self.expires_at = time.time()
+                self._refresh_wake.set()
+                return False
 
     def _parse_common_status(self, res: requests.Response, success_msg: str, error_msg: str):
         """
@@ -111,47 +607,56 @@ class SpotifyClient:
         """
         if res.status_code == 204:
             logging.info(f'Spotify: {success_msg}')
+        elif res.status_code == 202:
+            logging.error('Spotify: device temporarily unavailable')
+            raise TimeoutError('Device did not become available')
+        elif res.status_code == 429:
+            logging.error('Spotify: rate limited')
+            logging.debug(res.text)
+            raise _request_failed('Rate limited')
         elif res.status_code == 404:
             logging.error('Spotify: playback device not found')
             logging.debug(res.text)
-            raise RequestFailedError('Playback device not found')
+            raise _request_failed('Playback device not found')
         elif res.status_code == 403:
             logging.error(f'Spotify: {error_msg}')
             logging.debug(res.text)
-            raise RequestFailedError(error_msg)
+            raise _request_failed(error_msg)
         elif res.status_code == 401:
-            self.authenticated = False
+            # Still authenticated: the token is refreshed in the background, so later requests work again
             logging.error('Spotify: access_token is invalid.')
             logging.debug(res.text)
             raise InvalidTokenError('access_token is invalid')
         else:
             logging.error('Spotify: request failed')
             logging.debug(res.text)
-            raise RequestFailedError('Unhandled response code')
+            raise _request_failed('Unhandled response code')
 
     def authenticate(self):
         """
-        Try to authenticate with a refresh token, if found. If not, the user will be redirected to the browser for the OAuth2 process
+        Try to authenticate with a refresh token, if found. The access token of the last run is reused while it is still valid,
+        which saves a request to Spotify. If there is no refresh token, the user will be redirected to the browser for the OAuth2 process
         :raises KeyError: If the response from Spotify does not contain 'scope', 'access_token', and 'refresh_token'
         :raises AssertionError: If the response from Spotify is not 200 or does not match the requested scopes
         :raises OSError: If the a returned refresh_token could not be written to the refresh.token file
         :raises IOError: If the a returned refresh_token could not be written to the refresh.token file
         """
         try:
-            with open('refresh.token', 'r') as token_file:
+            with open(self.token_path, 'r') as token_file:
                 refresh_token = token_file.readline().rstrip()
 
             self.refresh_token = refresh_token
-            self.refresh()
+            if not self._load_access_token():
+                self.refresh()
         except (OSError, IOError, FileNotFoundError, InvalidTokenError) as e:
-            logging.warning('Unable to authenticate with "refresh.token" file')
+            logging.warning(f'Unable to authenticate with "{self.token_path}" file')
             logging.debug(e)
+            import webbrowser  # Only needed the first time the app is authorized
 
             response_type = 'code'
             redirect_uri = 'https://localhost/'
 
-            base_url = 'accounts.spotify.com/authorize'
-            auth_url = (f'https://{base_url}/'
+            auth_url = (f'{self.accounts_url}/authorize/'
                         f'?client_id={self.client_id}'
                         f'&response_type={response_type}'
                         f'&redirect_uri={redirect_uri}'
@@ -167,7 +672,6 @@ class SpotifyClient:
 
             auth_code = input('Please paste the "code" parameter from the URL here: ')
 
-            access_url = 'accounts.spotify.com/api/token'
             grant_type = 'authorization_code'
 
             data = {
@@ -178,17 +682,20 @@ class SpotifyClient:
                 # 'client_secret': self.client_secret
             }
 
-            res = requests.post(f'https://{access_url}', data=data, auth=HTTPBasicAuth(self.client_id, self.client_secret))
+            res = self.session.post(f'{self.accounts_url}/api/token', data=data, auth=HTTPBasicAuth(self.client_id, self.client_secret),
+                                    timeout=self.timeout)
             try:
                 assert res.status_code == 200
                 res_data = json.loads(res.text)
-                assert res_data['scope'].split(' ') == self.scopes
+                assert set(self.scopes) <= set(res_data['scope'].split(' '))
                 access_token = res_data['access_token']
                 refresh_token = res_data['refresh_token']
 
                 self.access_token = access_token
                 self.refresh_token = refresh_token
+                self.expires_at = time.time() + res_data.get('expires_in', 3600)
                 self.authenticated = True
+                self._save_access_token(res_data['scope'])
             except (KeyError, AssertionError) as e:
                 logging.critical('Authentication failed.')
                 logging.debug(f'{res.status_code}: {res.text}')
@@ -196,13 +703,60 @@ class SpotifyClient:
                 raise e
             logging.info('Spotify: Authentication succeeded')
 
-            try:
-                with open('refresh.token', 'w') as token_file:
-                    print(self.refresh_token, file=token_file)
-            except (OSError, IOError) as e:
-                logging.warning('Unable to write to file "refresh.token". Refresh token will not persist')
-                logging.debug(e)
-                raise e
+            self._save_refresh_token()
+
+    def _save_refresh_token(self):
+        """
+        Write the refresh token to the refresh.token file
+        :raises OSError: If the file could not be written
+        :raises IOError: If the file could not be written
+        """
+        try:
+            with open(self.token_path, 'w') as token_file:
+                print(self.refresh_token, file=token_file)
+        except (OSError, IOError) as e:
+            logging.warning(f'Unable to write to file "{self.token_path}". Refresh token will not persist')
+            logging.debug(e)
+            raise e
+
+    def _save_access_token(self, scope: str):
+        """
+        Write the access token, its expiry and its scopes to the access.token file, so the next run can skip the refresh.
+        Failures are only logged, as the token can always be refreshed again
+        :param scope: The space-separated scopes granted to the access token
+        """
+        try:
+            with open(self.access_token_path, 'w') as token_file:
+                print(self.access_token, file=token_file)
+                print(repr(self.expires_at), file=token_file)
+                print(scope, file=token_file)
+        except (OSError, IOError) as e:
+            logging.debug(f'Unable to write to file "{self.access_token_path}". Access token will not persist')
+            logging.debug(e)
+
+    def _load_access_token(self, margin: float = 60.0) -> bool:
+        """
+        Reuse the access token saved by the last run
+        :param margin: How long (in seconds) the token must still be valid for
+        :return: True if the token was loaded, false if it is missing, expired or lacks a required scope
+        """
+        try:
+            with open(self.access_token_path, 'r') as token_file:
+                access_token = token_file.readline().rstrip()
+                expires_at = float(token_file.readline())
+                scopes = token_file.readline().split()
+        except (OSError, IOError, ValueError) as e:
+            logging.debug(f'Unable to read file "{self.access_token_path}"')
+            logging.debug(e)
+            return False
+        if not access_token or expires_at - margin <= time.time() or not set(self.scopes) <= set(scopes):
+            logging.debug('Spotify: Saved access token is expired or lacks a scope')
+            return False
+        self.access_token = access_token
+        self.expires_at = expires_at
+        self.authenticated = True
+        logging.info(f'Spotify: Reusing saved access token ({expires_at - time.time():.0f} seconds left)')
+        return True
 
     def refresh(self):
         """
@@ -216,25 +770,47 @@ class SpotifyClient:
             logging.debug(f'client_id: {self.client_id}, client_secret: {self.client_secret}, refresh_token: {self.refresh_token}')
             raise InvalidClientError
 
-        base_url = 'accounts.spotify.com/api/token'
-
         data = {
             'grant_type': 'refresh_token',
             'refresh_token': self.refresh_token
         }
 
-        res = requests.post(f'https://{base_url}', data=data, auth=HTTPBasicAuth(self.client_id, self.client_secret))
+        res = self.session.post(f'{self.accounts_url}/api/token', data=data, auth=HTTPBasicAuth(self.client_id, self.client_secret),
+                                timeout=self.timeout)
         try:
             assert res.status_code == 200
             res_data = json.loads(res.text)
-            assert res_data['scope'].split(' ') == self.scopes
+            assert set(self.scopes) <= set(res_data['scope'].split(' '))
             access_token = res_data['access_token']
             self.access_token = access_token
+            self.expires_at = time.time() + res_data.get('expires_in', 3600)
             self.authenticated = True
         except (KeyError, AssertionError) as e:
             if res.status_code == 400:
-                logging.info('Spotify: Refresh token is invalid. Please delete file "refresh.token"')
+                logging.info(f'Spotify: Refresh token is invalid. Please delete file "{self.token_path}"')
             logging.debug(f'{res.status_code}: {res.text}')
             logging.debug(e)
             raise InvalidTokenError
         logging.info('Spotify: Authentication with refresh token succeeded')
+        self._save_access_token(res_data['scope'])
+
+        # Spotify may issue a new refresh token, in which case the old one stops working
+        if res_data.get('refresh_token', self.refresh_token) != self.refresh_token:
+            self.refresh_token = res_data['refresh_token']
+            try:
+                self._save_refresh_token()
+            except (OSError, IOError):
+                pass
+
+
+def create_session(pool_size: int = 4) -> requests.Session:
+    """
+    Create a keep-alive session with a connection pool
+    :param pool_size: The maximum number of connections kept open to each host
+    :return: The session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
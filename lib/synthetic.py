@@ -0,0 +1,51 @@
+import time
+from typing import Tuple
+
+import lib.fortnite_lib as fl
+from lib.fortnite_lib import GameState
+from lib.frame_source import Frame, FrameSource
+
+# The color keys painted into the synthetic frame of each state
+STATE_KEYS = {
+    GameState.IN_MENU: ['menu_left', 'menu_middle'],
+    GameState.WAITING: ['waiting'],
+    GameState.LAUNCHING: ['launching'],
+    GameState.CAN_PARACHUTE: ['can_parachute'],
+    GameState.STORM_WAITING: ['storm_waiting'],
+    GameState.UNKNOWN: [],
+}
+
+
+def synthetic_frame(state: GameState, display: Tuple[int, int] = None) -> Frame:
+    """
+    Build a frame in which exactly the pixels of one state have their reference color
+    :param state: The state the frame should be classified as
+    :param display: The size of the display the frame is captured from. Defaults to the reference display
+    :return: The frame
+    """
+    index = fl.display_index(*(display or fl.REFERENCE_DISPLAY))
+    frame = Frame(index.layout)
+    for key in STATE_KEYS[state]:
+        r, g, b = fl._COLORS[key]
+        for x, y in index.pixels[key]:
+            i = index.layout.index(x, y)
+            frame.buffer[i:i + 3] = bytes((b, g, r))
+    return frame
+
+
+class ScriptedFrameSource(FrameSource):
+    def __init__(self, display: Tuple[int, int] = None):
+        """
+        Serves the synthetic frame of whichever state is current, e.g. to walk a rig or the polling loop through a match
+        :param display: The size of the display the frames are captured from. Defaults to the reference display
+        """
+        self.frames = {state: synthetic_frame(state, display) for state in STATE_KEYS}
+        super().__init__(self.frames[GameState.UNKNOWN].layout)
+        self.current: Frame = self.frames[GameState.UNKNOWN]
+
+    def grab(self, frame: Frame = None) -> Frame:
+        if frame is None:
+            frame = Frame(self.layout)
+        frame.buffer[:] = self.current.buffer
+        frame.timestamp = time.time()
+        return frame
@@ -0,0 +1,89 @@
+import json
+import random
+
+import numpy as np
+import pytest
+
+import lib.fortnite_lib as fl
+from lib.calibration import CalibrationProfile, learn
+from lib.fortnite_lib import GameState
+from lib.recording import FrameRecorder, ReplayFrameSource
+from lib.synthetic import STATE_KEYS, synthetic_frame
+
+# How much brighter than the defaults every color is, as with a higher in-game brightness setting
+_SHIFT = 20
+
+
+def _bright_frame(state: GameState, rnd: random.Random):
+    frame = synthetic_frame(state)
+    for key in STATE_KEYS[state]:
+        for x, y in fl._PIXELS[key]:
+            i = fl.LAYOUT.index(x, y)
+            frame.buffer[i:i + 3] = bytes(min(value + _SHIFT + rnd.randint(-2, 2), 255) for value in frame.buffer[i:i + 3])
+    return frame
+
+
+def test_learn_finds_the_shifted_colors():
+    rnd = np.random.default_rng(1)
+    r, g, b = fl._COLORS['waiting']
+    samples = np.clip(np.array((b, g, r, 0)) + _SHIFT + rnd.integers(-2, 3, size=(50, 3, 4)), 0, 255).astype(np.uint8)
+    colors, tolerances = learn({'waiting': samples, 'launching': samples[:5]}, fl._COLORS)
+    assert colors == {'waiting': (r + _SHIFT, g + _SHIFT, b + _SHIFT)}  # Too few frames show "launching"
+    assert 3 <= tolerances['waiting'] <= 12
+
+
+def test_calibrated_profile_detects_brighter_colors(tmp_path):
+    rnd = random.Random(1)
+    path = str(tmp_path / 'bright.rec')
+    with FrameRecorder(path, fl.SAMPLE_LAYOUT) as recorder:
+        for state in list(STATE_KEYS) * 20:
+            recorder.write(_bright_frame(state, rnd))
+    recording = ReplayFrameSource(path)
+    profile = fl.calibrate([recording])
+    recording.close()
+
+    frames = {state: _bright_frame(state, rnd) for state in STATE_KEYS}
+    assert fl.get_state(frames[GameState.WAITING]) == GameState.UNKNOWN
+    try:
+        fl.load_profile(profile)
+        assert {state: fl.get_state(frame) for state, frame in frames.items()} == {state: state for state in STATE_KEYS}
+        assert {state: fl.StateMachine().update(frame) for state, frame in frames.items()} == {state: state for state in STATE_KEYS}
+    finally:
+        fl.load_profile(None)
+
+
+def test_profile_round_trip(tmp_path):
+    path = str(tmp_path / 'calibration')
+    profile = CalibrationProfile(fl._COLORS, {key: 9 for key in fl._COLORS})
+    profile.save(path)
+    loaded = CalibrationProfile.load(path)
+    assert loaded.colors == profile.colors and loaded.tolerances == profile.tolerances
+    assert isinstance(loaded.lut, np.memmap) and np.array_equal(loaded.lut, profile.lut)
+
+
+def test_edited_profile_is_compiled_again(tmp_path):
+    path = str(tmp_path / 'calibration')
+    CalibrationProfile(fl._COLORS, {key: 9 for key in fl._COLORS}).save(path)
+    with open(f'{path}.json') as profile_file:
+        data = json.load(profile_file)
+    data['tolerances']['waiting'] = 4
+    with open(f'{path}.json', 'w') as profile_file:
+        json.dump(data, profile_file)
+
+    loaded = CalibrationProfile.load(path)
+    r, g, b = fl._COLORS['waiting']
+    assert not loaded.lut[(b << 16) | (g << 8) | (r + 5)] & loaded.bits['waiting']  # Inside the old tolerance only
+    with open(f'{path}.json') as profile_file:
+        assert json.load(profile_file)['fingerprint'] != data['fingerprint']  # Saved again
+    reloaded = CalibrationProfile.load(path)
+    assert isinstance(reloaded.lut, np.memmap) and np.array_equal(reloaded.lut, loaded.lut)
+
+
+def test_invalid_profile_is_rejected(tmp_path):
+    path = str(tmp_path / 'calibration')
+    with open(f'{path}.json', 'w') as profile_file:
+        json.dump({'colors': {}}, profile_file)
+    with pytest.raises(ValueError):
+        CalibrationProfile.load(path)
+    with pytest.raises(OSError):
+        CalibrationProfile.load(str(tmp_path / 'missing'))
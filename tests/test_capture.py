@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from lib.capture import CaptureThread, FrameRing
+from lib.frame_source import Frame, FrameLayout, Region
+
+_LAYOUT = FrameLayout([Region(0, 0, 2, 1)])
+
+
+def _capture(ring: FrameRing, value: int, captured_at: float = None):
+    frame = ring.acquire()
+    frame.buffer[0] = value
+    ring.publish(value if captured_at is None else captured_at)
+
+
+def test_reader_gets_the_newest_frame():
+    ring = FrameRing(_LAYOUT, slots=4)
+    assert ring.take() is None
+    for value in (1, 2, 3):
+        _capture(ring, value)
+    frame, captured_at = ring.take()
+    assert frame.buffer[0] == 3 and captured_at == 3
+    assert ring.dropped == 2 and ring.take() is None
+
+
+def test_oldest_unread_frame_is_overwritten():
+    ring = FrameRing(_LAYOUT, slots=3)
+    _capture(ring, 1)
+    frame, _ = ring.take()  # Being read, so never overwritten
+    for value in range(2, 10):
+        _capture(ring, value)
+    assert frame.buffer[0] == 1
+    assert ring.take()[0].buffer[0] == 9
+    assert ring.published == 9 and ring.dropped == 7
+
+
+def test_frames_share_one_buffer():
+    ring = FrameRing(_LAYOUT, slots=3)
+    frames = [ring.acquire() for _ in range(3)]
+    assert all(isinstance(frame.buffer, memoryview) and frame.buffer.obj is ring._memory for frame in frames)
+    with pytest.raises(ValueError):
+        FrameRing(_LAYOUT, slots=2)
+
+
+def test_capture_thread_stops_at_the_end_of_the_frames():
+    values = iter(range(1, 6))
+    ready = threading.Semaphore(0)
+
+    def capture(frame: Frame) -> Frame:
+        try:
+            frame.buffer[0] = next(values)
+        except StopIteration:
+            raise EOFError
+        return frame
+
+    ring = FrameRing(_LAYOUT)
+    thread = CaptureThread(capture, ring, interval=0.0, on_frame=ready.release)
+    thread.start()
+    for _ in range(6):  # Five frames, then the end
+        assert ready.acquire(timeout=2)
+    assert ring.closed and ring.error is None
+    frame, _ = ring.take()
+    assert frame.buffer[0] == 5 and ring.dropped == 4
+
+
+def test_capture_thread_reports_errors():
+    ring = FrameRing(_LAYOUT)
+    stopped = threading.Event()
+    CaptureThread(lambda frame: Frame(_LAYOUT), ring, interval=0.0, on_frame=stopped.set).start()
+    assert stopped.wait(timeout=2)
+    assert ring.closed and isinstance(ring.error, TypeError) and ring.take() is None
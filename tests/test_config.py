@@ -0,0 +1,90 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import fortnite_spotify as fs
+from lib import config as cfg
+from lib.config import ConfigError, Step
+from lib.fortnite_lib import GameState
+from lib.scheduler import PollScheduler
+
+_EVENTS = fs.STATE_MAP.values()
+
+
+def test_default_config_is_valid():
+    steps, polling = cfg.validate(fs.DEFAULT_CONFIG, _EVENTS)
+    assert steps['main_menu'] == (Step('set_volume', (70,)), Step('play', ()))
+    assert steps['parachuting'] == () and polling['latency_budget'] == 0.25
+
+
+def test_events_missing_from_the_config_have_no_steps():
+    steps, polling = cfg.validate({'landed': {'actions': [['pause']]}}, _EVENTS)
+    assert steps['landed'] == (Step('pause', ()),) and steps['main_menu'] == () and polling == {}
+
+
+def test_every_problem_is_reported():
+    config = {
+        'main_menu': {'actions': [['set_volume', 101], ['set_volume', True], ['stop'], ['play', 1]]},
+        'lobby': {'actions': []},
+        'landed': [['pause']],
+        'polling': {'latency_budget': 0, 'poll_faster': True},
+    }
+    with pytest.raises(ConfigError) as error:
+        cfg.validate(config, _EVENTS)
+    problems = str(error.value).split('; ')
+    assert len(problems) == 8
+    assert 'Unknown event "lobby". Expected one of landed, main_menu, parachuting, unknown, waiting_for_players, waiting_to_drop' in problems
+    with pytest.raises(ConfigError):
+        cfg.validate([], _EVENTS)
+
+
+def test_invalid_json_is_a_config_error(tmp_path):
+    path = tmp_path / 'fortnite_spotify.cfg'
+    path.write_text('{"main_menu": ')
+    with pytest.raises(ConfigError, match='not valid JSON'):
+        cfg.load(str(path), _EVENTS)
+    with pytest.raises(OSError):
+        cfg.load(str(tmp_path / 'missing.cfg'), _EVENTS)
+
+
+def test_reload_swaps_in_a_valid_config(tmp_path, monkeypatch):
+    ran = []
+    monkeypatch.setattr(fs, 'CFG_MAP', {name: {'func': lambda *args, name=name: ran.append((name, *args)), 'handled_errors': []}
+                                        for name in cfg.ACTIONS})
+    monkeypatch.setattr(fs, 'PLANS', {})
+    monkeypatch.setattr(fs, 'POLLING', {})
+    monkeypatch.setattr(fs, 'ACTION_PLANS', {})  # The client is ready
+    scheduler = PollScheduler(hot_states=[])
+    path = tmp_path / 'fortnite_spotify.cfg'
+
+    path.write_text(json.dumps({'landed': {'actions': [['set_volume', 20], ['pause']]}, 'polling': {'latency_budget': 0.1}}))
+    assert fs.reload_config(str(path), scheduler)
+    assert fs.PLANS[GameState.STORM_WAITING] == (Step('set_volume', (20,)), Step('pause', ()))
+    assert scheduler.latency_budget == 0.1
+    for action in fs.ACTION_PLANS[GameState.STORM_WAITING]:
+        action()
+    assert ran == [('set_volume', 20), ('pause',)]
+
+    plans, action_plans = fs.PLANS, fs.ACTION_PLANS
+    path.write_text(json.dumps({'landed': {'actions': [['set_volume', 200]]}}))
+    assert not fs.reload_config(str(path), scheduler)
+    assert fs.PLANS is plans and fs.ACTION_PLANS is action_plans and scheduler.latency_budget == 0.1
+
+
+def test_watch_calls_back_on_change(tmp_path):
+    path = tmp_path / 'fortnite_spotify.cfg'
+    path.write_text('{}')
+    changes = []
+
+    async def main():
+        watching = asyncio.ensure_future(cfg.watch(str(path), lambda: changes.append(path.read_text()), interval=0.01))
+        await asyncio.sleep(0.05)
+        path.write_text('{"unknown": {"actions": []}}')
+        os.utime(path, ns=(1, 1))  # Some file systems only store whole seconds
+        await asyncio.sleep(0.05)
+        watching.cancel()
+
+    asyncio.run(main())
+    assert changes == ['{"unknown": {"actions": []}}']
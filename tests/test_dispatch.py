@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import fortnite_spotify as fs
+from lib.dispatch import ActionDispatcher
+from lib.fortnite_lib import GameState
+
+
+class _Action:
+    def __init__(self, name: str, ran: list, seconds: float = 0.05):
+        self.name, self.ran, self.seconds = name, ran, seconds
+
+    def __call__(self):
+        time.sleep(self.seconds)
+        self.ran.append(self.name)
+
+
+def _dispatch(script) -> list:
+    """
+    Run a script of (delay, event name, actions) submissions through a dispatcher
+    :return: The names of the actions that ran, in order
+    """
+    ran = []
+
+    async def main():
+        dispatcher = ActionDispatcher(lambda action: action())
+        task = asyncio.ensure_future(dispatcher.run())
+        for delay, event_name, actions in script:
+            await asyncio.sleep(delay)
+            dispatcher.submit(event_name, [_Action(name, ran) for name in actions])
+        await dispatcher.queue.join()
+        task.cancel()
+
+    asyncio.run(main())
+    return ran
+
+
+def test_event_without_actions_overrides_nothing():
+    ran = _dispatch([
+        (0, 'main_menu', ['set_volume_70', 'play']),
+        (0.01, 'unknown', []),
+        (0, 'waiting_for_players', []),
+    ])
+    assert ran == ['set_volume_70', 'play']
+
+
+def test_newer_event_drops_pending_actions():
+    ran = _dispatch([
+        (0, 'main_menu', ['set_volume_70', 'play']),
+        (0.01, 'waiting_to_drop', ['set_volume_50']),
+        (0, 'landed', ['pause']),
+    ])
+    # set_volume_70 was already running. The rest of main_menu is skipped, and waiting_to_drop never runs after landing
+    assert ran == ['set_volume_70', 'pause']
+
+
+def test_states_entered_before_the_client_is_ready():
+    fs.load_config('does-not-exist.cfg')
+    try:
+        for state in (GameState.IN_MENU, GameState.UNKNOWN, GameState.WAITING, GameState.LAUNCHING):
+            fs.handle_event(state, None)
+        assert fs._pending_state == GameState.LAUNCHING
+        fs.handle_event(GameState.IN_MENU, None)
+        fs.handle_event(GameState.UNKNOWN, None)  # Has no actions, so the menu's still run
+        assert fs._pending_state == GameState.IN_MENU
+    finally:
+        fs._pending_state = None
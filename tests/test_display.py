@@ -0,0 +1,52 @@
+import pytest
+
+import lib.fortnite_lib as fl
+from lib.fortnite_lib import GameState
+from lib.synthetic import STATE_KEYS, synthetic_frame
+
+
+def test_reference_display_round_trip():
+    assert fl.display_index(*fl.REFERENCE_DISPLAY).pixels == fl._PIXELS
+
+
+@pytest.mark.parametrize('display, scale', [((3840, 2160), 2), ((1280, 720), 2 / 3)])
+def test_same_aspect_ratio_scales_every_coordinate(display, scale):
+    pixels = fl.display_index(*display).pixels
+    for key, pairs in fl._PIXELS.items():
+        for (x, y), (scaled_x, scaled_y) in zip(pairs, pixels[key]):
+            assert abs(scaled_x - x * scale) <= scale and abs(scaled_y - y * scale) <= scale, key
+
+
+def test_ultrawide_display_keeps_the_hud_in_the_corner():
+    pixels = fl.display_index(3440, 1440).pixels
+    scale = 1440 / 1080
+    for (x, y), (wide_x, wide_y) in zip(fl._PIXELS['waiting'], pixels['waiting']):
+        assert abs((3440 - wide_x) - (1920 - x) * scale) <= 1 and abs(wide_y - y * scale) <= 1
+    assert pixels['menu_middle'][-1] == (3439, pixels['menu_middle'][-1][1])  # Spread across the full width
+
+
+@pytest.mark.parametrize('display', [(1920, 1080), (2560, 1440), (3440, 1440), (1680, 1050), (1280, 1024), (320, 200)])
+def test_every_state_is_detected(display):
+    index = fl.display_index(*display)
+    for pairs in index.pixels.values():
+        for x, y in pairs:
+            index.layout.index(x, y)
+            index.sample_layout.index(x, y)
+    for state in STATE_KEYS:
+        frame = synthetic_frame(state, display)
+        assert fl.get_state(frame) == state and fl.StateMachine().update(frame) == state
+
+
+def test_unsupported_display_sizes():
+    assert not fl.valid_display(319, 1080) and not fl.valid_display(1920, 8641)
+    with pytest.raises(ValueError):
+        fl.display_index(0, 0)
+
+
+def test_set_display():
+    try:
+        fl.set_display(2560, 1440)
+        assert fl.display().layout is fl.display_index(2560, 1440).layout
+        assert fl.classify(fl.sample([synthetic_frame(GameState.LAUNCHING, (2560, 1440))]))[0] == GameState.LAUNCHING
+    finally:
+        fl.set_display(*fl.REFERENCE_DISPLAY)
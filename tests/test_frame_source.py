@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+import lib.fortnite_lib as fl
+from lib.fortnite_lib import GameState
+from lib.frame_source import FileFrameSource, FrameLayout, Region, ppm_size
+from lib.synthetic import synthetic_frame
+
+
+def _write_ppm(path, width: int, height: int, rgb: bytes, header: bytes = None):
+    with open(path, 'wb') as ppm_file:
+        ppm_file.write(header or f'P6\n{width} {height}\n255\n'.encode())
+        ppm_file.write(rgb)
+
+
+def _gradient(width: int, height: int) -> bytes:
+    return bytes(value % 256 for y in range(height) for x in range(width) for value in (x, y, x + y))
+
+
+def test_regions_are_read_as_bgrx(tmp_path):
+    path = tmp_path / 'shot.ppm'
+    _write_ppm(path, 8, 6, _gradient(8, 6), header=b'P6 # A comment\n8 6\n# Another\n255\n')
+    layout = FrameLayout([Region(1, 2, 3, 2), Region(0, 5, 8, 1)])
+    frame = FileFrameSource(layout, str(path)).grab()
+    assert ppm_size(str(path)) == (8, 6)
+    for x, y in [(1, 2), (3, 3), (0, 5), (7, 5)]:
+        i = layout.index(x, y)
+        assert frame.buffer[i:i + 3] == bytes((x + y, y, x))  # B, G, R
+
+
+def test_screenshot_is_read_again_when_it_changes(tmp_path):
+    path = tmp_path / 'shot.ppm'
+    layout = FrameLayout([Region(0, 0, 2, 1)])
+    source = FileFrameSource(layout, str(path))
+    _write_ppm(path, 2, 1, bytes(6))
+    assert source.grab().pixel(1, 0) == 0
+    _write_ppm(path, 2, 1, bytes((0, 0, 0, 1, 2, 3)))
+    os.utime(path, (1, 1))
+    assert source.grab().pixel(1, 0) == 0x030201
+
+
+def test_invalid_screenshots_are_rejected(tmp_path):
+    path = tmp_path / 'shot.ppm'
+    layout = FrameLayout([Region(0, 0, 4, 4)])
+    _write_ppm(path, 4, 4, bytes(10))
+    with pytest.raises(ValueError, match='truncated'):
+        FileFrameSource(layout, str(path)).grab()
+    _write_ppm(path, 2, 2, bytes(12))
+    with pytest.raises(ValueError, match='does not cover'):
+        FileFrameSource(layout, str(path)).grab()
+    _write_ppm(path, 2, 2, bytes(12), header=b'P3\n2 2\n255\n')
+    with pytest.raises(ValueError, match='P6'):
+        ppm_size(str(path))
+
+
+def test_screenshot_of_the_menu(tmp_path):
+    # A full screenshot, as taken on a 1280x720 display
+    display = (1280, 720)
+    frame = synthetic_frame(GameState.IN_MENU, display)
+    rgb = bytearray(display[0] * display[1] * 3)
+    for x, y in (pair for pairs in fl.display_index(*display).pixels.values() for pair in pairs):
+        i = frame.layout.index(x, y)
+        rgb[(y * display[0] + x) * 3:(y * display[0] + x + 1) * 3] = frame.buffer[i:i + 3][::-1]
+    path = tmp_path / 'menu.ppm'
+    _write_ppm(path, *display, bytes(rgb))
+    assert fl.get_state(FileFrameSource(fl.display_index(*ppm_size(str(path))).layout, str(path)).grab()) == GameState.IN_MENU
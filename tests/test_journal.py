@@ -0,0 +1,62 @@
+import json
+import os
+import time
+from datetime import datetime
+
+from lib import journal
+from lib.journal import Journal, load_index, query
+
+
+def _session(directory, count: int, **kwargs) -> Journal:
+    log = Journal(str(directory), **kwargs)
+    for i in range(count):
+        log.record('transition' if i % 2 else 'action', i=i, ok=i % 3 == 0)
+    log.close()
+    return log
+
+
+def test_query_filters_records(tmp_path):
+    _session(tmp_path, 20)
+    records = list(query(str(tmp_path)))
+    assert [record['i'] for record in records] == list(range(20))
+    assert [record['i'] for record in query(str(tmp_path), kind='transition', ok=True)] == [3, 9, 15]
+    since, until = records[5]['t'], records[12]['t']
+    assert [record['i'] for record in query(str(tmp_path), since=since, until=until)] == [
+        record['i'] for record in records if since <= record['t'] <= until]
+    assert list(query(str(tmp_path), since=time.time() + 60)) == []
+
+
+def test_segments_are_rotated(tmp_path):
+    log = _session(tmp_path, 100, max_bytes=300, max_segments=4)
+    index = load_index(str(tmp_path))
+    assert len(index) == 4 and all(entry['end'] is not None for entry in index)
+    assert sorted(name for name in os.listdir(tmp_path) if name.startswith('segment-')) == sorted(entry['file'] for entry in index)
+    kept = [record['i'] for record in query(str(tmp_path))]
+    assert kept == list(range(100 - len(kept), 100)) and sum(entry['records'] for entry in index) == len(kept) < log.records
+
+
+def test_every_session_starts_a_segment(tmp_path):
+    _session(tmp_path, 3)
+    _session(tmp_path, 2)
+    assert [entry['records'] for entry in load_index(str(tmp_path))] == [3, 2]
+    assert [record['i'] for record in query(str(tmp_path))] == [0, 1, 2, 0, 1]
+
+
+def test_unclean_shutdown_is_recovered(tmp_path):
+    _session(tmp_path, 5)
+    entry = load_index(str(tmp_path))[0]
+    with open(tmp_path / entry['file'], 'a') as segment_file:
+        segment_file.write('{"t": 1, "kind": "act')  # Cut short by a crash
+    with open(tmp_path / 'index.json', 'w') as index_file:
+        json.dump({'version': journal._INDEX_VERSION, 'segments': [{**entry, 'end': None, 'records': 0}]}, index_file)
+
+    _session(tmp_path, 1)  # The next session rescans the open segment
+    assert [entry['records'] for entry in load_index(str(tmp_path))] == [5, 1]
+    os.remove(tmp_path / 'index.json')
+    assert [entry['records'] for entry in load_index(str(tmp_path))] == [5, 1]  # Rebuilt from the segments
+    assert len(list(query(str(tmp_path)))) == 6
+
+
+def test_parse_time():
+    assert abs(journal.parse_time('2h') - (time.time() - 7200)) < 1
+    assert journal.parse_time('2024-05-01 18:30') == datetime(2024, 5, 1, 18, 30).timestamp()
@@ -0,0 +1,61 @@
+import sys
+
+import pytest
+
+from lib import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    fresh = metrics.Registry()
+    monkeypatch.setattr(metrics, 'REGISTRY', fresh)
+    return fresh
+
+
+def _work(x: int) -> int:
+    return x * 2
+
+
+def test_nothing_is_counted_while_disabled(registry):
+    requests = metrics.Counter('requests_total', 'Requests', ['code'])
+    seconds = metrics.Histogram('request_seconds', 'Request time')
+    requests.inc('200')
+    seconds.observe(0.1)
+    assert requests.value('200') == 0 and seconds.count() == 0
+    registry.enable()
+    requests.inc('200')
+    seconds.observe(0.1)
+    assert requests.value('200') == 1 and seconds.count() == 1
+
+
+def test_exposition_format(registry):
+    requests = metrics.Counter('requests_total', 'Requests', ['path'])
+    seconds = metrics.Histogram('request_seconds', 'Request time', buckets=(0.1, 1.0))
+    registry.enable()
+    requests.inc('/a"b', amount=2)
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    assert registry.expose().splitlines() == [
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{path="/a\\"b"} 2',
+        '# HELP request_seconds Request time',
+        '# TYPE request_seconds histogram',
+        'request_seconds_bucket{le="0.1"} 1',
+        'request_seconds_bucket{le="1"} 2',
+        'request_seconds_bucket{le="+Inf"} 2',
+        'request_seconds_sum 0.55',
+        'request_seconds_count 2',
+    ]
+
+
+def test_timed_function_is_rebound_on_enable(registry, monkeypatch):
+    module = sys.modules[__name__]
+    work = module._work
+    monkeypatch.setattr(module, '_work', work)  # Restores the plain function afterwards
+    seconds = metrics.Histogram('work_seconds', 'Work time')
+    registry.timed(seconds)(work)
+    assert module._work is work
+    registry.enable()
+    assert module._work is not work and module._work.__wrapped__ is work
+    assert module._work(21) == 42 and seconds.count() == 1
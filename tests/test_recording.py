@@ -0,0 +1,55 @@
+import pytest
+
+import lib.fortnite_lib as fl
+from lib.fortnite_lib import GameState
+from lib.recording import FrameRecorder, RecordingError, ReplayFrameSource
+from lib.synthetic import STATE_KEYS, synthetic_frame
+
+
+def _record(path, states, layout=fl.SAMPLE_LAYOUT):
+    with FrameRecorder(str(path), layout) as recorder:
+        for i, state in enumerate(states):
+            frame = synthetic_frame(state)
+            frame.timestamp = 100.0 + i * 0.25
+            recorder.write(frame)
+
+
+def test_round_trip(tmp_path):
+    states = list(STATE_KEYS) * 3
+    _record(tmp_path / 'session.rec', states)
+    recording = ReplayFrameSource(str(tmp_path / 'session.rec'))
+    try:
+        assert len(recording) == len(states) and recording.layout.display == fl.REFERENCE_DISPLAY
+        assert recording.layout.regions == fl.SAMPLE_LAYOUT.regions
+        for i, state in enumerate(states):
+            frame = recording.grab()
+            assert frame.timestamp == 100.0 + i * 0.25
+            for x, y in (pair for pairs in fl._PIXELS.values() for pair in pairs):
+                assert frame.pixel(x, y) == synthetic_frame(state).pixel(x, y)
+            assert fl.get_state(frame) == state
+        with pytest.raises(EOFError):
+            recording.grab()
+
+        timestamps, classified = fl.classify_recording(recording, chunk_size=4)
+        assert list(timestamps) == [100.0 + i * 0.25 for i in range(len(states))]
+        assert list(classified) == states
+    finally:
+        recording.close()
+
+
+def test_full_frames_are_recorded_as_is(tmp_path):
+    _record(tmp_path / 'full.rec', [GameState.WAITING], layout=fl.LAYOUT)
+    recording = ReplayFrameSource(str(tmp_path / 'full.rec'), loop=True)
+    try:
+        for _ in range(3):  # Loops around
+            assert bytes(recording.grab().buffer) == bytes(synthetic_frame(GameState.WAITING).buffer)
+    finally:
+        recording.close()
+
+
+def test_other_files_are_rejected(tmp_path):
+    (tmp_path / 'empty.rec').write_bytes(b'')
+    (tmp_path / 'other.rec').write_bytes(b'FNSREC1\0' + bytes(64))
+    for name in ('empty.rec', 'other.rec'):
+        with pytest.raises(RecordingError):
+            ReplayFrameSource(str(tmp_path / name))
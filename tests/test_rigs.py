@@ -0,0 +1,106 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+import lib.fortnite_lib as fl
+from lib import rigs
+from lib.fortnite_lib import GameState
+from lib.rigs import HELLO_BAD_DISPLAY, HELLO_BAD_LAYOUT, HELLO_UNKNOWN_USER, RigAgent, RigError, RigServer
+from lib.synthetic import ScriptedFrameSource
+
+
+def _serve(script, users=None) -> list:
+    """
+    Run a script on a worker thread while a rig server accepts and classifies rigs
+    :param script: Called with the server and its address
+    :return: The (rig name, previous state, new state) of every transition
+    """
+    transitions = []
+
+    async def main():
+        server = RigServer(lambda rig, previous, state: transitions.append((rig.name, previous, state)), users=users, interval=0.01)
+        address = await server.start()
+        classifying = asyncio.ensure_future(server.run())
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, script, server, address)
+        finally:
+            classifying.cancel()
+
+    asyncio.run(main())
+    return transitions
+
+
+def _wait_for(condition, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'Timed out'
+        time.sleep(0.005)
+
+
+def _show(server: RigServer, agent: RigAgent, state: GameState):
+    agent.source.current = agent.source.frames[state]
+    agent.send()
+    _wait_for(lambda: agent.name in server.rigs and server.rigs[agent.name].state == state)
+
+
+def _hello(address, width: int, height: int, pixels: int) -> int:
+    with socket.create_connection(address) as connection:
+        connection.sendall(rigs._HELLO.pack(rigs._MAGIC, width, height, pixels, 3, 5) + b'rigalice')
+        return connection.recv(1)[0]
+
+
+def test_rigs_are_classified_separately():
+    def script(server, address):
+        agents = [RigAgent(address, 'rig-0', 'alice', ScriptedFrameSource()),
+                  RigAgent(address, 'rig-1', 'bob', ScriptedFrameSource((2560, 1440)))]
+        for agent in agents:
+            agent.connect()
+            _show(server, agent, GameState.IN_MENU)
+        _show(server, agents[0], GameState.WAITING)
+        _show(server, agents[1], GameState.LAUNCHING)
+        _show(server, agents[0], GameState.LAUNCHING)
+        for agent in agents:
+            agent.close()
+
+    assert _serve(script) == [
+        ('rig-0', GameState.IN_MENU, GameState.WAITING),
+        ('rig-1', GameState.IN_MENU, GameState.LAUNCHING),
+        ('rig-0', GameState.WAITING, GameState.LAUNCHING),
+    ]
+
+
+def test_unknown_user_is_refused():
+    def script(server, address):
+        RigAgent(address, 'rig-0', 'alice', ScriptedFrameSource()).connect()
+        with pytest.raises(RigError, match=f'status {HELLO_UNKNOWN_USER}'):
+            RigAgent(address, 'rig-1', 'mallory', ScriptedFrameSource()).connect()
+
+    _serve(script, users=['alice'])
+
+
+def test_bad_layout_and_display_are_refused():
+    def script(server, address):
+        pixels = len(fl.SAMPLE_LAYOUT.regions)
+        assert _hello(address, *fl.REFERENCE_DISPLAY, pixels + 1) == HELLO_BAD_LAYOUT
+        assert _hello(address, *fl.REFERENCE_DISPLAY, 0) == HELLO_BAD_LAYOUT
+        assert _hello(address, 2 ** 31, 1080, pixels) == HELLO_BAD_DISPLAY
+        assert _hello(address, 1920, 0, pixels) == HELLO_BAD_DISPLAY
+        assert not server.rigs
+
+    _serve(script)
+
+
+def test_reconnect_keeps_the_previous_state():
+    def script(server, address):
+        agent = RigAgent(address, 'rig-0', 'alice', ScriptedFrameSource())
+        agent.connect()
+        _show(server, agent, GameState.LAUNCHING)
+        agent.close()
+        _wait_for(lambda: not server.rigs)
+        agent.connect()
+        _show(server, agent, GameState.CAN_PARACHUTE)  # Changed while the rig was disconnected
+        agent.close()
+
+    assert _serve(script) == [('rig-0', GameState.LAUNCHING, GameState.CAN_PARACHUTE)]
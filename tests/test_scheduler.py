@@ -0,0 +1,54 @@
+import pytest
+
+from lib.scheduler import PollScheduler
+
+
+def _poll(scheduler: PollScheduler, states, duration: float = 0.001, start: float = 0.0) -> list:
+    """
+    Poll a sequence of states, each poll starting when the previous one asked to wait until
+    :return: How long the scheduler asked to wait after each poll
+    """
+    waits = []
+    now = start
+    for state in states:
+        wait = scheduler.poll_finished(state, duration, now=now)
+        waits.append(wait)
+        now += duration + wait
+    return waits
+
+
+def test_hot_state_is_polled_at_the_latency_budget():
+    scheduler = PollScheduler(hot_states=['waiting'], latency_budget=0.25, idle_interval=2.0, cpu_budget=0)
+    assert _poll(scheduler, ['waiting'] * 200) == [pytest.approx(0.249)] * 200
+
+
+def test_cold_state_backs_off_once_settled():
+    scheduler = PollScheduler(hot_states=['waiting'], latency_budget=0.25, idle_interval=2.0, cpu_budget=0, settle_time=1.0)
+    waits = _poll(scheduler, ['menu'] * 20)
+    assert waits[:4] == [pytest.approx(0.249)] * 4  # Not settled yet
+    assert all(later >= earlier for earlier, later in zip(waits, waits[1:]))
+    assert waits[-1] == pytest.approx(1.999)
+    # A transition drops straight back to the latency budget
+    assert _poll(scheduler, ['waiting'], start=100.0) == [pytest.approx(0.249)]
+
+
+def test_cpu_budget_stretches_the_interval():
+    scheduler = PollScheduler(hot_states=['waiting'], latency_budget=0.25, cpu_budget=0.02)
+    assert _poll(scheduler, ['waiting'] * 5, duration=0.01)[-1] == pytest.approx(0.01 / 0.02 - 0.01)
+
+
+def test_transition_latency_is_measured():
+    scheduler = PollScheduler(hot_states=['waiting'], latency_budget=0.25, cpu_budget=0)
+    scheduler.poll_finished('menu', 0.01, now=0.0)
+    scheduler.poll_finished('menu', 0.01, now=0.25)
+    scheduler.poll_finished('waiting', 0.01, now=0.5)
+    assert scheduler.transitions == 1 and scheduler.last_latency == pytest.approx(0.26)
+    assert scheduler.report()['max_latency'] == pytest.approx(0.26)
+
+
+def test_configure_applies_from_the_next_poll():
+    scheduler = PollScheduler(hot_states=['waiting'], latency_budget=0.25, idle_interval=2.0, cpu_budget=0)
+    _poll(scheduler, ['waiting'])
+    scheduler.configure(latency_budget=0.1, idle_interval=0.05, cpu_budget=0)
+    assert scheduler.idle_interval == 0.1  # Never below the latency budget
+    assert _poll(scheduler, ['waiting'], start=1.0) == [pytest.approx(0.099)]
@@ -0,0 +1,140 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+import fortnite_spotify as fs
+from lib import metrics, spotify_lib
+from lib.mock_spotify import MockSpotifyServer
+from lib.spotify_lib import PlayerStateCache, SpotifyClient
+
+
+@pytest.fixture
+def server():
+    with MockSpotifyServer(connect_delay=0.0) as mock:
+        mock.start()
+        yield mock
+        mock.stop()
+
+
+def _new_client(server, token_path: str, scopes=fs.SCOPES) -> SpotifyClient:
+    cl = SpotifyClient('mock-id', 'mock-secret', scopes, api_url=f'{server.url}/v1', accounts_url=server.url, token_path=token_path)
+    cl.scheduler.base_delay = 0.01
+    return cl
+
+
+@pytest.fixture
+def client(server):
+    with tempfile.TemporaryDirectory() as directory:
+        cl = _new_client(server, os.path.join(directory, 'refresh.token'))
+        cl.refresh_token = 'mock-refresh-token'
+        cl.refresh()
+        yield cl
+        cl.close()
+
+
+def _volumes(server) -> list:
+    return [int(params['volume_percent'][0]) for path, params in server.log if path == '/v1/me/player/volume']
+
+
+def test_burst_is_coalesced_to_the_newest_value(server, client):
+    client.resolve_device().result()
+    server.response_delay = 0.02  # Keeps the worker busy, so the burst queues up
+    futures = [client.set_volume(volume) for volume in range(1, 21)]
+    for future in futures:
+        future.result()
+    assert server.player['volume_percent'] == 20
+    assert _volumes(server)[-1] == 20 and len(_volumes(server)) < 20
+
+
+def test_coalesced_call_keeps_its_order(server, client):
+    client.resolve_device().result()
+    server.response_delay = 0.05
+    busy = client.set_volume(10)  # Keeps the worker busy, so the next calls queue up
+    futures = [client.play(), client.pause(), client.play()]
+    for future in [busy] + futures:
+        future.result()
+    assert server.player['is_playing'] and client.player.is_playing
+    assert [path for path, _ in server.log][-2:] == ['/v1/me/player/pause', '/v1/me/player/play']
+
+
+def test_rate_limit_waits_for_retry_after(server, client):
+    server.script('/v1/me/player/volume', (429, {'Retry-After': '0.3'}))
+    start = time.monotonic()
+    client.set_volume(30).result()
+    assert time.monotonic() - start >= 0.3
+    assert _volumes(server) == [30, 30]  # The retry keeps its params
+    assert server.player['volume_percent'] == 30
+
+
+def test_device_lookup_is_retried(server, client):
+    server.script('/v1/me/player/devices', (429, {'Retry-After': '0.05'}), (503, {}))
+    client.play().result()
+    assert client.device_id == 'mock-device' and server.player['is_playing']
+
+
+def test_failed_refresh_after_rejection_is_retried(server, client):
+    client.start_auto_refresh(retry_delay=0.2)
+    server.expire_tokens()
+    server.script('/api/token', (500, {}))
+    with pytest.raises(Exception):
+        client.pause().result()
+    assert client.authenticated
+    time.sleep(0.5)
+    client.pause().result()  # The background refresh got a new token in the meantime
+    assert server.tokens_issued == 2
+
+
+def test_cache_fields_age_separately():
+    cache = PlayerStateCache(ttl=0.1)
+    cache.update(is_playing=True)
+    time.sleep(0.15)
+    cache.update(volume=50)
+    assert not cache.lookup('is_playing', True)
+    assert cache.lookup('volume', 50)
+
+
+def test_cache_lookups_are_counted(monkeypatch):
+    monkeypatch.setattr(metrics.REGISTRY, 'enabled', True)
+    before = {result: spotify_lib._CACHE_LOOKUPS.value('volume', result) for result in ('hit', 'miss')}
+    cache = PlayerStateCache()
+    cache.update(volume=50)
+    assert cache.lookup('volume', 50) and not cache.lookup('volume', 60)
+    assert {result: spotify_lib._CACHE_LOOKUPS.value('volume', result) - before[result] for result in before} == {'hit': 1, 'miss': 1}
+
+
+def test_play_is_sent_after_a_pause_in_the_app(server, client):
+    server.player['is_playing'] = True
+    client.player.ttl = 0.1
+    client.sync_player_state()
+    server.player['is_playing'] = False  # Paused in the Spotify app
+    time.sleep(0.15)
+    client.set_volume(40).result()
+    client.play().result()
+    assert server.player['is_playing']
+
+
+def test_saved_access_token_is_reused(server, client):
+    client._save_refresh_token()
+    second = _new_client(server, client.token_path)
+    try:
+        second.authenticate()
+        assert second.access_token == client.access_token and server.tokens_issued == 1
+        second.pause().result()
+    finally:
+        second.close()
+
+
+def test_saved_access_token_is_not_reused_when_it_cannot_be_used(server, client):
+    client._save_refresh_token()
+    for granted, expires_in in [(fs.SCOPES[:1], 3600), (fs.SCOPES, 30)]:  # A missing scope, then too little time left
+        client.expires_at = time.time() + expires_in
+        client._save_access_token(' '.join(granted))
+        issued = server.tokens_issued
+        other = _new_client(server, client.token_path)
+        try:
+            other.authenticate()
+            assert server.tokens_issued == issued + 1 and other.access_token != client.access_token
+        finally:
+            other.close()
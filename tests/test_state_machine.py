@@ -0,0 +1,55 @@
+import random
+
+import lib.fortnite_lib as fl
+from lib.calibration import CalibrationProfile
+from lib.fortnite_lib import GameState
+from lib.frame_source import Frame
+from lib.synthetic import STATE_KEYS, synthetic_frame
+
+
+def _noisy_frames(count: int, seed: int = 1) -> list:
+    """
+    A sequence of frames that hold each state for a while, with some checked pixels off by a little or by a lot,
+    so that check results are both reused and invalidated
+    """
+    rnd = random.Random(seed)
+    clean = {state: synthetic_frame(state) for state in STATE_KEYS}
+    offsets = [offset for pairs in fl._PIXELS.values() for offset in (fl.LAYOUT.index(x, y) for x, y in pairs)]
+    frames = []
+    state = GameState.IN_MENU
+    while len(frames) < count:
+        if rnd.random() < 0.1:
+            state = rnd.choice(list(clean))
+        frame = Frame(fl.LAYOUT, bytearray(clean[state].buffer))
+        for offset in rnd.sample(offsets, rnd.randrange(3)):
+            channel = offset + rnd.randrange(3)
+            frame.buffer[channel] = rnd.choice((frame.buffer[channel] ^ 1, rnd.randrange(256)))
+        frames.extend([frame] * rnd.randrange(1, 4))  # The same frame again, as on a still screen
+    return frames[:count]
+
+
+def test_state_machine_matches_get_state():
+    machine = fl.StateMachine(sweep_interval=1000)
+    for i, frame in enumerate(_noisy_frames(5000)):
+        assert machine.update(frame) == fl.get_state(frame), f'frame {i}'
+    assert machine.reused and machine.skipped
+
+
+def test_single_frame_path_matches_batched_classify():
+    frames = _noisy_frames(2000, seed=2)
+    try:
+        for profile in (None, CalibrationProfile(dict(fl._COLORS), {key: fl._DISTANCE + 8 for key in fl._COLORS})):
+            fl.load_profile(profile)
+            classifier = fl._classifier(fl.LAYOUT)
+            assert [classifier.classify_frame(frame) for frame in frames] == list(fl.classify(fl.sample(frames)))
+    finally:
+        fl.load_profile(None)
+
+
+def test_unexpected_jump_is_seen_on_the_same_poll():
+    # Dying while parachuting goes straight back to the menu, which CAN_PARACHUTE does not expect
+    machine = fl.StateMachine()
+    assert machine.update(synthetic_frame(GameState.CAN_PARACHUTE)) == GameState.CAN_PARACHUTE
+    assert machine.update(synthetic_frame(GameState.IN_MENU)) == GameState.IN_MENU
+    assert machine.update(synthetic_frame(GameState.UNKNOWN)) == GameState.UNKNOWN
+    assert machine.update(synthetic_frame(GameState.LAUNCHING)) == GameState.LAUNCHING